@@ -1,4 +1,22 @@
-from setuptools import setup
+from setuptools import Extension, setup
+from setuptools.command.build_ext import build_ext
+
+
+class optional_build_ext(build_ext):
+    """ The compiled collector is optional, so carry on without it if it can't be built. """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            print("Not building the optional compiled collector: {}".format(e))
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            print("Not building the optional compiled collector: {}".format(e))
+
 
 setup(
     name='wahi-korero',
@@ -9,8 +27,16 @@ setup(
     author_email='info@tehiku.nz',
     license='Kaitiakitanga License',
     packages=['wahi_korero'],
+    ext_modules=[Extension('wahi_korero._collector', sources=['wahi_korero/_collector.c'], optional=True)],
+    cmdclass={'build_ext': optional_build_ext},
+    # The lazy imports in `__init__.py` (PEP 562) and the server's `ThreadingHTTPServer` need 3.7.
+    python_requires='>=3.7',
     install_requires=[
-        'pydub==0.22.1',
-        'webrtcvad==2.0.10',
+        # `_webrtcvad.process(vad, rate, buf, length)` is used directly where it's there; see `segment.py`.
+        'webrtcvad>=2.0.10,<3',
     ],
+    extras_require={
+        # `Segmenter.speech_flags`, `Segmenter.pack_stream` and `AudioSlice.as_numpy`
+        'numpy': ['numpy'],
+    },
 )
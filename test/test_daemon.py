@@ -0,0 +1,142 @@
+# Make `wahi_korero` visible on sys.path
+import sys
+sys.path.append("..")
+
+import json
+import os
+from os import path
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from wahi_korero import default_segmenter
+from wahi_korero.daemon import SpoolDaemon
+
+
+class SpoolDaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dirs = {}
+        for name in ["spool", "out", "dead", "done"]:
+            self.dirs[name] = path.join(self.tmp_dir, name)
+            os.mkdir(self.dirs[name])
+        self.daemon = SpoolDaemon(default_segmenter(), self.dirs["spool"], self.dirs["out"], self.dirs["dead"],
+                                  done_dir=self.dirs["done"], workers=2, poll_interval_s=0.05, min_age_s=0)
+
+    def tearDown(self):
+        self.daemon.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_spool(self):
+        for name in ["a.wav", "b.wav"]:
+            shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], name))
+        with open(path.join(self.dirs["spool"], "broken.wav"), "wb") as f:
+            f.write(b"this is not audio")
+        with open(path.join(self.dirs["spool"], "notes.txt"), "w") as f:
+            f.write("unsupported formats are left alone")
+
+        self.daemon.drain()
+
+        for name in ["a.wav", "b.wav"]:
+            with open(path.join(self.dirs["out"], name, "segments.json")) as f:
+                self.assertEqual(json.load(f)["track_name"], name)
+        self.assertEqual(sorted(os.listdir(self.dirs["done"])), ["a.wav", "b.wav"])
+        self.assertEqual(sorted(os.listdir(self.dirs["dead"])), ["broken.wav", "broken.wav.error"])
+        self.assertEqual(sorted(os.listdir(self.dirs["out"])), ["a.wav", "b.wav"],
+                         "No temporary output should be left behind.")
+        self.assertEqual(sorted(os.listdir(self.dirs["spool"])), [".claimed", "notes.txt"])
+
+    def test_reupload_while_processing(self):
+        os.mkdir(path.join(self.dirs["out"], "a.wav"))
+        with open(path.join(self.dirs["out"], "a.wav", "stale.txt"), "w") as f:
+            f.write("left over from an earlier upload")
+        shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], "a.wav"))
+        self.daemon.poll()
+        shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], "a.wav"))
+        self.assertEqual(self.daemon.poll(), 1, "Two files of the same name shouldn't be segmented at once.")
+        self.daemon.drain()
+
+        self.assertEqual(os.listdir(self.dirs["out"]), ["a.wav"], "No temporary output should be left behind.")
+        self.assertEqual(os.listdir(path.join(self.dirs["out"], "a.wav")), ["segments.json"])
+        self.assertEqual(sorted(os.listdir(self.dirs["done"])), ["a-1.wav", "a.wav"])
+        self.assertEqual(os.listdir(self.dirs["dead"]), [])
+        self.assertEqual(os.listdir(path.join(self.dirs["spool"], ".claimed")), [])
+
+    def test_same_name_dead_lettered(self):
+        for text in ["first", "second"]:
+            with open(path.join(self.dirs["spool"], "broken.wav"), "w") as f:
+                f.write(text)
+            self.daemon.drain()
+        self.assertEqual(sorted(os.listdir(self.dirs["dead"])),
+                         ["broken-1.wav", "broken-1.wav.error", "broken.wav", "broken.wav.error"])
+        for name, text in [("broken.wav", "first"), ("broken-1.wav", "second")]:
+            with open(path.join(self.dirs["dead"], name)) as f:
+                self.assertEqual(f.read(), text)
+            with open(path.join(self.dirs["dead"], name + ".error")) as f:
+                self.assertIn("Traceback", f.read())
+
+    def test_worker_killed(self):
+        shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], "a.wav"))
+        self.daemon.poll()
+        for process in list(self.daemon._executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+        self.daemon.drain()
+
+        self.assertTrue(path.exists(path.join(self.dirs["out"], "a.wav", "segments.json")))
+        self.assertEqual(os.listdir(self.dirs["done"]), ["a.wav"])
+        self.assertEqual(os.listdir(self.dirs["dead"]), [])
+
+        # The new pool should take new files too.
+        shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], "b.wav"))
+        self.daemon.drain()
+        self.assertEqual(sorted(os.listdir(self.dirs["done"])), ["a.wav", "b.wav"])
+
+    def test_recover(self):
+        shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], ".claimed", "left.wav"))
+        self.daemon.recover()
+        self.daemon.drain()
+        self.assertTrue(path.exists(path.join(self.dirs["out"], "left.wav", "segments.json")))
+
+    def test_recover_keeps_newer_upload(self):
+        with open(path.join(self.dirs["spool"], ".claimed", "a.wav"), "w") as f:
+            f.write("old")
+        with open(path.join(self.dirs["spool"], "a.wav"), "w") as f:
+            f.write("new")
+        self.daemon.recover()
+        self.assertEqual(sorted(os.listdir(self.dirs["spool"])), [".claimed", "a-1.wav", "a.wav"])
+        for name, text in [("a.wav", "new"), ("a-1.wav", "old")]:
+            with open(path.join(self.dirs["spool"], name)) as f:
+                self.assertEqual(f.read(), text)
+
+    def test_close_while_files_arrive(self):
+        shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], "a.wav"))
+        self.daemon.poll()
+
+        stop_uploading = threading.Event()
+
+        def upload():
+            n = 0
+            while not stop_uploading.is_set():
+                shutil.copy("sounds/hello.wav", path.join(self.dirs["spool"], "new-{}.wav".format(n)))
+                n += 1
+                time.sleep(0.01)
+
+        uploader = threading.Thread(target=upload)
+        uploader.start()
+        try:
+            closer = threading.Thread(target=self.daemon.close)
+            closer.start()
+            closer.join(timeout=30)
+            self.assertFalse(closer.is_alive(), "`close` shouldn't claim files that arrive while it waits.")
+        finally:
+            stop_uploading.set()
+            uploader.join()
+        self.assertEqual(os.listdir(self.dirs["done"]), ["a.wav"])
+        self.assertIn("new-0.wav", os.listdir(self.dirs["spool"]))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,96 @@
+# Make `wahi_korero` visible on sys.path
+import sys
+sys.path.append("..")
+
+import os
+from os import path
+import shutil
+import subprocess
+import tempfile
+import unittest
+import wave
+
+# How long the synthetic long track is, and how much more memory (in KiB) processing it may take than a short one.
+LONG_TRACK_HOURS = 2
+RSS_CEILING_KIB = 16 * 1024
+
+# Run in a fresh interpreter, so that the peak RSS belongs to the workload alone.
+WORKLOAD = """
+import resource, sys
+sys.path.insert(0, {root!r})
+import wahi_korero
+workload, fpath, output_dir = sys.argv[1:]
+segmenter = wahi_korero.default_segmenter()
+if workload == "segment_stream":
+    for _ in segmenter.segment_stream(fpath):
+        pass
+elif workload == "segment_audio":
+    segmenter.segment_audio(fpath, output_dir, output_audio=False, verbose=False)
+elif workload == "frame_audio":
+    wahi_korero.frame_audio(30, fpath, output_dir, output_audio=False, verbose=False)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+""".format(root=path.abspath(".."))
+
+
+def _make_track(source_fpath, output_fpath, seconds):
+    """ Write a mono 16kHz wav of the given length by looping `source_fpath`, a chunk at a time. """
+    with open(os.devnull, "w") as DEVNULL:
+        loop_fpath = output_fpath + ".loop.wav"
+        subprocess.check_call(["ffmpeg", "-y", "-i", source_fpath, "-ac", "1", "-ar", "16000",
+                               "-acodec", "pcm_s16le", loop_fpath], stdout=DEVNULL, stderr=DEVNULL)
+    reader = wave.open(loop_fpath, "rb")
+    loop = reader.readframes(reader.getnframes())
+    reader.close()
+    os.remove(loop_fpath)
+
+    writer = wave.open(output_fpath, "wb")
+    writer.setnchannels(1)
+    writer.setsampwidth(2)
+    writer.setframerate(16000)
+    remaining = seconds * 16000 * 2
+    while remaining > 0:
+        chunk = loop[:remaining]
+        writer.writeframesraw(chunk)
+        remaining -= len(chunk)
+    writer.close()
+
+
+class MemoryTests(unittest.TestCase):
+    """ Peak memory should depend on the buffer sizes, not on how long the track is. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.short_fpath = path.join(cls.tmp_dir, "short.wav")
+        cls.long_fpath = path.join(cls.tmp_dir, "long.wav")
+        _make_track("sounds/hello.wav", cls.short_fpath, 60)
+        _make_track("sounds/hello.wav", cls.long_fpath, LONG_TRACK_HOURS * 3600)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def _peak_rss(self, workload, fpath):
+        output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        output = subprocess.check_output([sys.executable, "-c", WORKLOAD, workload, fpath, output_dir])
+        return int(output.decode("utf-8").split()[-1])
+
+    def _check(self, workload):
+        short_rss = self._peak_rss(workload, self.short_fpath)
+        long_rss = self._peak_rss(workload, self.long_fpath)
+        self.assertLess(long_rss - short_rss, RSS_CEILING_KIB,
+                        "`{}` used {} KiB on a {} hour track but {} KiB on a minute-long one."
+                        .format(workload, long_rss, LONG_TRACK_HOURS, short_rss))
+
+    def test_segment_stream(self):
+        self._check("segment_stream")
+
+    def test_segment_audio(self):
+        self._check("segment_audio")
+
+    def test_frame_audio(self):
+        self._check("frame_audio")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -3,16 +3,40 @@
 import sys
 sys.path.append("..")
 
+import array
+import collections
+import gc
 import json
 import os
 from os import path
-from pydub import AudioSegment
+import shutil
+import subprocess
+import tarfile
+import tempfile
 import unittest
-from wahi_korero import ConfigError, default_segmenter, FormatError
+import wave
+import weakref
+import zipfile
+from wahi_korero import (Cancelled, CancelToken, ConfigError, DecoderPool, DEFAULT_CONFIG, default_segmenter,
+                         FormatError, Segmenter)
+from wahi_korero import segment
+from wahi_korero.index import INDEX_FNAME, IndexWriter, SegmentIndex
+from wahi_korero.segment import _collector, frame_audio, frame_stream, merge_channels
+from wahi_korero.utils import open_audio
 
 output_dir = "out"
 
 
+def _write_excerpt(fpath, num_samples):
+    """ Save the first `num_samples` samples of the test track as a wav at `fpath`. """
+    reader = wave.open("sounds/hello.wav", "rb")
+    writer = wave.open(fpath, "wb")
+    writer.setparams(reader.getparams())
+    writer.writeframes(reader.readframes(num_samples))
+    writer.close()
+    reader.close()
+
+
 class SegmenterIntegrationTests(unittest.TestCase):
 
     def setUp(self):
@@ -26,6 +50,36 @@ class SegmenterIntegrationTests(unittest.TestCase):
     def test_segmenting(self):
         self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False)
 
+    def test_shorter_than_a_frame(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        for num_samples in [220, 0]:  # about 40 samples, or none, once squashed
+            fpath = path.join(tmp_dir, "short.wav")
+            _write_excerpt(fpath, num_samples)
+            for kwargs in [{}, dict(native=False), dict(hop_ms=5), dict(refine_hop_ms=2), dict(lookahead_ms=100)]:
+                segmenter = Segmenter(**dict(DEFAULT_CONFIG, **kwargs))
+                self.assertEqual(list(segmenter.segment_stream(fpath)), [], str(kwargs))
+
+    def test_frame_count(self):
+        # Every whole frame up to the end of the track, so the last 10ms frame ends at 11.92s of the 11.93s track.
+        # Before the frame count was shared with the VAD paths, the 10ms frames stopped one short, at 11.91s.
+        frames = [seg for seg, _ in frame_stream(10, "sounds/hello.wav")]
+        self.assertEqual(len(frames), 1192)
+        self.assertEqual(frames[-1], (11.91, 11.92))
+        frames = [seg for seg, _ in frame_stream(25, "sounds/hello.wav")]
+        self.assertEqual(len(frames), 477)
+        self.assertEqual(frames[-1], (11.9, 11.925))
+
+        frame_audio(10, "sounds/hello.wav", output_dir, output_audio=False, verbose=False)
+        with open(path.join(output_dir, "segments.json")) as f:
+            self.assertEqual(len(json.load(f)["segments"]), 1192)
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        short_fpath = path.join(tmp_dir, "short.wav")
+        _write_excerpt(short_fpath, 440)
+        self.assertEqual(list(frame_stream(10, short_fpath)), [])
+
     def test_json_output(self):
         self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False)
         stream = self.segmenter.segment_stream("sounds/hello.wav")
@@ -71,6 +125,24 @@ class SegmenterIntegrationTests(unittest.TestCase):
             self.assertEqual(round(seg1[0], 3), round(seg1[0], 3), "Segments should be same in stream as in json.")
             self.assertEqual(round(seg1[1], 3), round(seg1[1], 3), "Segments should be same in stream as in json.")
 
+    def test_lazy_audio_handles(self):
+        stream = self.segmenter.segment_stream("sounds/hello.wav", output_audio=True)
+        for (start, end), audio in stream:
+            self.assertEqual((audio.start, audio.end), (start, end), "Handle should record where the segment is.")
+            data = audio.read()
+            num_samples = len(data) // (audio.sample_width * audio.channels)
+            self.assertAlmostEqual(num_samples / float(audio.frame_rate), end - start, places=2,
+                                   msg="Reading a handle should give the segment's audio.")
+
+    def test_handle_export(self):
+        _, audio = next(self.segmenter.segment_stream("sounds/hello.wav", output_audio=True))
+        wav_fpath = audio.export(path.join(output_dir, "handle.wav"), format="wav")
+        flac_fpath = audio.export(path.join(output_dir, "handle.flac"), format="flac")
+        self.assertEqual(len(open_audio(wav_fpath)[:]), len(audio))
+        self.assertAlmostEqual(len(open_audio(flac_fpath)[:]), len(audio), delta=5)
+        self.assertEqual(len(open_audio(flac_fpath)[:].read()), len(open_audio(wav_fpath)[:].read()),
+                         "Compressed sources should decode to the same PCM as wav sources.")
+
     def test_non_audio(self):
         try:
             self.segmenter.segment_audio("test_segmenter.py", "out")
@@ -85,11 +157,714 @@ class SegmenterIntegrationTests(unittest.TestCase):
         self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False)
 
     def test_captioning_min_length(self):
-        audio_seg = AudioSegment.from_file("sounds/hello.wav", format="wav")
-        audio_len = len(audio_seg)
+        audio_len = int(open_audio("sounds/hello.wav").duration_milliseconds)
         self.segmenter.enable_captioning(audio_len, min_caption_len_ms=audio_len)
         caption_stream = self.segmenter.segment_stream("sounds/hello.wav")
         self.assertEqual(len(list(caption_stream)), 1, "Should have one caption") # one caption, the whole length of the track
 
+
+_Frame = collections.namedtuple("_Frame", ["bytes", "timestamp", "duration"])
+
+
+class _ScriptedVad(object):
+    """ Stands in for a webrtcvad detector, giving a fixed sequence of decisions. """
+
+    def __init__(self, decisions):
+        self.decisions = iter(decisions)
+
+    def is_speech(self, buf, sample_rate):
+        return next(self.decisions)
+
+
+class HysteresisTests(unittest.TestCase):
+
+    def test_hysteresis_segments(self):
+        segmenter = Segmenter(**dict(DEFAULT_CONFIG, lookahead_ms=100, onset_ratio=0.6, offset_ratio=0.2))
+        segments = [seg for seg, _ in segmenter.segment_stream("sounds/hello.wav")]
+        self.assertTrue(segments, "Should find some speech in the track.")
+        previous_end = 0
+        for start, end in segments:
+            self.assertLess(start, end, "Segments should have positive length.")
+            self.assertLessEqual(previous_end, start, "Segments should be in order and shouldn't overlap.")
+            previous_end = end
+
+    def test_hysteresis_no_overlap(self):
+        # A gap short enough that the next onset's window still holds voiced frames from the previous segment.
+        decisions = [1] * 10 + [0, 0, 0, 0, 0, 0, 1, 0, 1, 0] + [1] * 6 + [0] * 10
+        frames = [_Frame(b"", round(i * 0.01, 3), 0.01) for i in range(len(decisions))]
+        segmenter = Segmenter(**dict(DEFAULT_CONFIG, lookahead_ms=100, onset_ratio=0.6, offset_ratio=0.2))
+        segments = list(segmenter._hysteresis_collector(8000, _ScriptedVad(decisions), frames))
+        self.assertEqual(len(segments), 2)
+        self.assertLessEqual(segments[0][1], segments[1][0], "Segments shouldn't overlap.")
+        self.assertEqual(segments, [(0.0, 0.19), (0.2, 0.26)])
+
+    def test_hysteresis_config(self):
+        with self.assertRaises(ConfigError):
+            Segmenter(**dict(DEFAULT_CONFIG, lookahead_ms=100, onset_ratio=0.2, offset_ratio=0.6))
+        with self.assertRaises(ConfigError):
+            Segmenter(**dict(DEFAULT_CONFIG, lookahead_ms=15))
+
+
+@unittest.skipIf(_collector is None, "The compiled collector hasn't been built.")
+class NativeCollectorTests(unittest.TestCase):
+
+    def test_matches_python(self):
+        configs = [
+            DEFAULT_CONFIG,
+            dict(DEFAULT_CONFIG, aggression=1, threshold_voice_ms=50, threshold_silence_ms=100),
+            dict(DEFAULT_CONFIG, frame_duration_ms=20, buffer_length_ms=200, threshold_voice_ms=100,
+                 threshold_silence_ms=60, squash_rate=None),
+        ]
+        for config in configs:
+            python = Segmenter(native=False, **config)
+            native = Segmenter(native=True, **config)
+            self.assertEqual(list(native.segment_stream("sounds/hello.wav")),
+                             list(python.segment_stream("sounds/hello.wav")),
+                             "The compiled collector should give the same segments with config {}".format(config))
+
+    def test_direct_vad(self):
+        # The test track's samples are read in-process and treated as 16kHz, which keeps ffmpeg out of this.
+        with wave.open("sounds/hello.wav", "rb") as reader:
+            pcm = reader.readframes(reader.getnframes())
+        rate = 16000
+        segmenter = default_segmenter()
+        frame_bytes = 2 * rate * segmenter.frame_duration_ms // 1000
+        num_frames = len(pcm) // frame_bytes
+        python = segment._PyCollector(segment._vad_process, segment._Vad(3)._vad, rate, frame_bytes, 30, 27, 3)
+        collector = segmenter._new_collector(segment._Vad(3), rate, frame_bytes)
+        if segment._direct_vad:
+            self.assertTrue(collector.direct, "The compiled collector should call webrtcvad directly.")
+        else:
+            self.assertIsInstance(collector, segment._PyCollector,
+                                  "Without a direct call to webrtcvad, the compiled collector shouldn't be used.")
+        self.assertEqual(collector.speech_flags(pcm, num_frames), python.speech_flags(pcm, num_frames))
+
+    def test_feed_flags(self):
+        flags = bytearray([0, 1, 1, 1, 0, 1, 1, 1, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1])
+        python = segment._PyCollector(segment._vad_process, segment._Vad(3)._vad, 8000, 160, 5, 3, 3)
+        native = _collector.Collector(segment._vad_process, segment._Vad(3)._vad, 8000, 160, 5, 3, 3)
+        self.assertEqual([native.feed_flags(flags[:10]), native.feed_flags(flags[10:]), native.finish()],
+                         [python.feed_flags(flags[:10]), python.feed_flags(flags[10:]), python.finish()])
+
+    def test_reference_cycle_collected(self):
+        class Process(object):
+            def __call__(self, vad, rate, buf, length):
+                return False
+
+        process = Process()
+        process.collector = _collector.Collector(process, segment._Vad(3)._vad, 8000, 160, 10, 3, 3)
+        self.assertFalse(process.collector.direct)
+        ref = weakref.ref(process)
+        del process
+        gc.collect()
+        self.assertIsNone(ref(), "A cycle through the collector's `process` should be collected.")
+
+
+class ChannelTests(unittest.TestCase):
+
+    def setUp(self):
+        # A stereo track with the speech on the right channel starting three seconds after the left.
+        if not path.exists(output_dir):
+            os.mkdir(output_dir)
+        self.stereo_fpath = path.join(output_dir, "stereo.wav")
+        with open(os.devnull, "w") as DEVNULL:
+            subprocess.check_call(["ffmpeg", "-y", "-i", "sounds/hello.wav", "-filter_complex",
+                                   "[0:a]pan=mono|c0=c0,asplit[l][r];[r]adelay=3000,atrim=0:11.93[d];"
+                                   "[l][d]amerge=inputs=2", "-ac", "2", self.stereo_fpath],
+                                  stdout=DEVNULL, stderr=DEVNULL)
+        self.segmenter = default_segmenter()
+
+    def test_channels_segmented_separately(self):
+        tagged = [(channel, seg) for channel, seg, _ in self.segmenter.segment_channels(self.stereo_fpath)]
+        left = [seg for channel, seg in tagged if channel == 0]
+        right = [seg for channel, seg in tagged if channel == 1]
+        self.assertTrue(left and right, "Both channels have speech.")
+        self.assertAlmostEqual(right[0][0] - left[0][0], 3, places=1,
+                               msg="The right channel's speech starts three seconds later.")
+
+    def test_channel_audio(self):
+        _, (start, end), audio = next(self.segmenter.segment_channels(self.stereo_fpath, output_audio=True))
+        self.assertEqual(audio.output_channels, 1)
+        num_samples = int(round(end * audio.frame_rate)) - int(round(start * audio.frame_rate))
+        self.assertEqual(len(audio.read()) // 2, num_samples, "Only one channel should be read.")
+
+    def test_per_channel_json(self):
+        self.segmenter.segment_audio(self.stereo_fpath, output_dir, output_audio=False, verbose=False,
+                                     per_channel=True)
+        with open(path.join(output_dir, "segments.json")) as f:
+            data = json.load(f)
+        self.assertEqual(set(seg["channel"] for seg in data["segments"]), {0, 1})
+        self.assertTrue(data["merged"])
+
+    def test_merge_channels(self):
+        merged = merge_channels([(0, (0.0, 2.0)), (1, (1.0, 3.0)), (0, (4.0, 5.0)), (1, (4.5, 5.0))])
+        self.assertEqual(merged, [(0.0, 1.0, [0]), (1.0, 2.0, [0, 1]), (2.0, 3.0, [1]),
+                                  (4.0, 4.5, [0]), (4.5, 5.0, [0, 1])])
+
+
+class DecoderPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = DecoderPool(size=1)
+        self.segmenter = default_segmenter()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_pooled_segments_match(self):
+        expected = list(self.segmenter.segment_stream("sounds/hello.wav"))
+        self.segmenter.decoder = self.pool
+        for _ in range(2):  # the second run uses a warm process
+            self.assertEqual(list(self.segmenter.segment_stream("sounds/hello.wav")), expected,
+                             "Decoding through the pool shouldn't change the segments.")
+
+    def test_failed_decode_reaped(self):
+        self.pool.warm(1, 4000)
+        proc = self.pool._warm[(1, 4000, ())][0]
+        unraisable = []
+        hook = sys.unraisablehook
+        sys.unraisablehook = unraisable.append
+        try:
+            for src_fpath, dst_fpath in [("sounds/no-such-file.wav", path.join(output_dir, "decoded.wav")),
+                                         ("sounds/hello.wav", path.join(output_dir, "no-such-dir", "decoded.wav"))]:
+                with self.assertRaises(FileNotFoundError):
+                    self.pool.decode(src_fpath, dst_fpath, 1, 4000)
+                self.assertIsNotNone(proc.returncode, "The ffmpeg process should have been killed and waited on.")
+                self.pool.warm(1, 4000)
+                proc = self.pool._warm[(1, 4000, ())][0]
+            gc.collect()
+        finally:
+            sys.unraisablehook = hook
+        self.assertEqual(unraisable, [], "Only the original error should be raised.")
+
+    def test_closed_pool(self):
+        self.pool.close()
+        self.segmenter.decoder = self.pool
+        with self.assertRaises(ValueError):
+            list(self.segmenter.segment_stream("sounds/hello.wav"))
+
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        if not path.exists(output_dir):
+            os.mkdir(output_dir)
+        self.segmenter = default_segmenter()
+        self.index_fpath = path.join(output_dir, INDEX_FNAME)
+        self.segmenter.segment_audio("sounds/hello.wav", output_dir, output_audio=False, verbose=False,
+                                     write_index=True)
+
+    def test_index_doesnt_change_segments(self):
+        with open(path.join(output_dir, "segments.json")) as f:
+            segments = [(seg["start"], seg["end"]) for seg in json.load(f)["segments"]]
+        self.assertEqual(segments, [seg for seg, _ in self.segmenter.segment_stream("sounds/hello.wav")])
+
+    def test_resegment(self):
+        configs = [
+            DEFAULT_CONFIG,
+            dict(DEFAULT_CONFIG, threshold_voice_ms=50, threshold_silence_ms=100),
+            dict(DEFAULT_CONFIG, buffer_length_ms=500, threshold_voice_ms=200, threshold_silence_ms=300),
+        ]
+        for config in configs:
+            segmenter = Segmenter(**config)
+            self.assertEqual(list(segmenter.resegment(self.index_fpath)),
+                             [seg for seg, _ in segmenter.segment_stream("sounds/hello.wav")],
+                             "Re-segmenting from the index should match config {}".format(config))
+
+    def test_resegment_mismatch(self):
+        with self.assertRaises(ConfigError):
+            Segmenter(**dict(DEFAULT_CONFIG, aggression=1)).resegment(self.index_fpath)
+        with self.assertRaises(FormatError):
+            self.segmenter.resegment("sounds/hello.wav")
+
+    def test_envelope_without_numpy(self):
+        with wave.open("sounds/hello.wav", "rb") as reader:
+            samples = array.array("h", reader.readframes(reader.getnframes()))
+
+        def write_index():
+            fpath = path.join(output_dir, "envelope.wkix")
+            with IndexWriter(fpath, 16000, 10, 3, 0, len(samples)) as writer:
+                for start in range(0, len(samples), 1000):  # not a whole number of blocks at a time
+                    writer.add_samples(samples[start:start + 1000])
+            with open(fpath, "rb") as f:
+                return f.read()
+
+        with_numpy = write_index()
+        numpy = sys.modules.get("numpy")
+        sys.modules["numpy"] = None  # `import numpy` now raises ImportError
+        try:
+            self.assertEqual(write_index(), with_numpy, "The envelope shouldn't depend on whether numpy is installed.")
+        finally:
+            if numpy is None:
+                del sys.modules["numpy"]
+            else:
+                sys.modules["numpy"] = numpy
+
+    def test_envelope(self):
+        index = SegmentIndex(self.index_fpath)
+        try:
+            finest = index.envelope(0)
+            coarsest = index.envelope(len(index.levels) - 1)
+            for block_samples, num_blocks, _ in index.levels:
+                self.assertEqual(num_blocks, -(-index.num_samples // block_samples))
+            self.assertEqual(min(finest[0]), min(coarsest[0]))
+            self.assertEqual(max(finest[1]), max(coarsest[1]))
+            self.assertEqual(len(index.waveform(100)), 100)
+            del finest, coarsest
+        finally:
+            index.close()
+
+
+class ExportTests(unittest.TestCase):
+
+    def setUp(self):
+        if not path.exists(output_dir):
+            os.mkdir(output_dir)
+        for f in os.listdir(output_dir):
+            os.remove(path.join(output_dir, f))
+        self.segmenter = default_segmenter()
+        self.expected = [seg for seg, _ in self.segmenter.segment_stream("sounds/hello.wav")]
+
+    def test_compressed_segments(self):
+        for audio_format in ["flac", "opus"]:
+            self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False, audio_format=audio_format)
+            with open(path.join(output_dir, "segments.json")) as f:
+                segments = json.load(f)["segments"]
+            self.assertEqual([(seg["start"], seg["end"]) for seg in segments], self.expected)
+            for seg in segments:
+                self.assertTrue(seg["fname"].endswith("." + audio_format))
+                pcm = subprocess.check_output(["ffmpeg", "-v", "error", "-i", path.join(output_dir, seg["fname"]),
+                                               "-ac", "1", "-ar", "16000", "-f", "s16le", "-"])
+                duration = len(pcm) / 2 / 16000.0
+                self.assertGreaterEqual(duration, seg["end"] - seg["start"] - 0.001)
+                self.assertLessEqual(duration, seg["end"] - seg["start"] + 0.025,
+                                     "Segments should be padded by less than one encoder frame.")
+
+    def test_archives(self):
+        self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False, audio_format="flac",
+                                     archive="tar")
+        self.assertEqual(os.listdir(output_dir), ["segments.tar"])
+        with tarfile.open(path.join(output_dir, "segments.tar")) as tar:
+            names = tar.getnames()
+            segments = json.loads(tar.extractfile("segments.json").read().decode("utf-8"))["segments"]
+        self.assertEqual(names, ["segments.json"] + [seg["fname"] for seg in segments])
+
+        os.remove(path.join(output_dir, "segments.tar"))
+        self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False, archive="zip")
+        self.assertEqual(os.listdir(output_dir), ["segments.zip"])
+        with zipfile.ZipFile(path.join(output_dir, "segments.zip")) as zf:
+            self.assertEqual(len(zf.namelist()), len(self.expected) + 1)
+            self.assertTrue(all(name.endswith(".wav") for name in zf.namelist()[1:]))
+
+    def test_bad_format(self):
+        with self.assertRaises(ConfigError):
+            self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False, audio_format="mp3")
+        with self.assertRaises(ConfigError):
+            self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False, archive="rar")
+
+
+class PackingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.segmenter = default_segmenter()
+        self.expected = [seg for seg, _ in self.segmenter.segment_stream("sounds/hello.wav")]
+
+    def test_chunks(self):
+        batches = list(self.segmenter.pack_stream("sounds/hello.wav", max_chunk_s=3, batch_size=1))
+        self.assertTrue(all(len(batch) == 1 for batch in batches))
+        chunks = [chunk for batch in batches for chunk in batch]
+        self.assertEqual([seg for boundaries, _ in chunks for seg in boundaries], self.expected,
+                         "Short segments should be packed as they are, in order.")
+        for boundaries, pcm in chunks:
+            self.assertLessEqual(boundaries[-1][1] - boundaries[0][0], 3)
+            self.assertEqual(pcm.ndim, 1)
+            self.assertAlmostEqual(len(pcm), (boundaries[-1][1] - boundaries[0][0]) * 16000, delta=32)
+
+    def test_long_segments_split(self):
+        batches = list(self.segmenter.pack_stream("sounds/hello.wav", max_chunk_s=0.5, batch_size=4))
+        self.assertTrue(all(len(batch) == 4 for batch in batches[:-1]))
+        pieces = [seg for batch in batches for boundaries, _ in batch for seg in boundaries]
+        self.assertTrue(all(end - start <= 0.5 for start, end in pieces))
+
+        # Joining the pieces back up gives the original segments.
+        joined = []
+        for start, end in pieces:
+            if joined and joined[-1][1] == start:
+                joined[-1] = (joined[-1][0], end)
+            else:
+                joined.append((start, end))
+        self.assertEqual(joined, self.expected)
+
+    def test_bad_config(self):
+        with self.assertRaises(ConfigError):
+            next(self.segmenter.pack_stream("sounds/hello.wav", max_chunk_s=0.01))
+        with self.assertRaises(ConfigError):
+            next(self.segmenter.pack_stream("sounds/hello.wav", batch_size=0))
+
+    def test_without_numpy(self):
+        numpy = sys.modules.get("numpy")
+        sys.modules["numpy"] = None  # `import numpy` now raises ImportError
+        try:
+            with self.assertRaisesRegex(ImportError, "wahi-korero\\[numpy\\]"):
+                next(self.segmenter.pack_stream("sounds/hello.wav"))
+            with self.assertRaisesRegex(ImportError, "speech_flags"):
+                self.segmenter.speech_flags("sounds/hello.wav")
+        finally:
+            if numpy is None:
+                del sys.modules["numpy"]
+            else:
+                sys.modules["numpy"] = numpy
+
+
+class _CancellingReader(object):
+    """ A file-like object which cancels `token` once some of `data` has been read. """
+
+    def __init__(self, data, token):
+        self.data = data
+        self.token = token
+        self.position = 0
+        self.name = "hello.wav"
+
+    def read(self, size=-1):
+        if self.position > 0:
+            self.token.cancel()
+        size = len(self.data) if size < 0 else size
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+class ProgressTests(unittest.TestCase):
+
+    def setUp(self):
+        self.segmenter = default_segmenter()
+        self.expected = [seg for seg, _ in self.segmenter.segment_stream("sounds/hello.wav")]
+
+    def test_progress(self):
+        for native in [True, False]:
+            self.segmenter.native = native
+            reports = []
+            segments = [seg for seg, _ in self.segmenter.segment_stream("sounds/hello.wav", progress=reports.append)]
+            self.assertEqual(segments, self.expected)
+            self.assertAlmostEqual(reports[-1].total_seconds, 11.93, delta=0.02)
+            self.assertEqual(reports[-1].processed_seconds, reports[-1].total_seconds)
+            self.assertEqual(reports[-1].eta_seconds, 0)
+            self.assertGreater(reports[-1].frames_per_second, 0)
+
+    def test_cancel_in_frame_loop(self):
+        token = CancelToken()
+        audio = open_audio("sounds/hello.wav")
+        self.segmenter.native = False  # checks every 1000 frames, rather than every 4096
+        stream = self.segmenter.segment_stream(audio, progress=lambda report: token.cancel(), cancel=token)
+        with self.assertRaises(Cancelled):
+            list(stream)
+        self.assertFalse(path.exists(audio.tmp_file), "The transcoded copy should be deleted.")
+
+    def test_cancel_while_decoding(self):
+        with open("sounds/hello.wav", "rb") as f:
+            data = f.read()
+        for decoder in [None, DecoderPool(size=1)]:
+            token = CancelToken()
+            audio = open_audio(_CancellingReader(data, token), decoder=decoder)
+            with self.assertRaises(Cancelled):
+                list(self.segmenter.segment_stream(audio, cancel=token))
+            self.assertTrue(audio.tmp_file is None or not path.exists(audio.tmp_file))
+            if decoder is not None:
+                decoder.close()
+
+    def test_cancel_segment_audio(self):
+        token = CancelToken()
+        token.cancel()
+        output_dir = tempfile.mkdtemp()
+        with self.assertRaises(Cancelled):
+            self.segmenter.segment_audio("sounds/hello.wav", output_dir, verbose=False, cancel=token)
+        self.assertEqual(os.listdir(output_dir), [])
+        os.rmdir(output_dir)
+
+
+class _CountingSegmenter(Segmenter):
+    """ Counts how many tracks it has actually segmented. """
+
+    def _segments(self, *args, **kwargs):
+        self.segmented = getattr(self, "segmented", 0) + 1
+        return Segmenter._segments(self, *args, **kwargs)
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = path.join(self.tmp_dir, "in")
+        self.output_dir = path.join(self.tmp_dir, "out")
+        os.mkdir(self.input_dir)
+        os.mkdir(self.output_dir)
+        self.fpaths = [path.join(self.input_dir, name) for name in ["hello.wav", "copy.flac", "short.wav"]]
+        with open(os.devnull, "w") as DEVNULL:
+            subprocess.check_call(["ffmpeg", "-y", "-i", "sounds/hello.wav", self.fpaths[0]],
+                                  stdout=DEVNULL, stderr=DEVNULL)
+            subprocess.check_call(["ffmpeg", "-y", "-i", "sounds/hello.wav", self.fpaths[1]],
+                                  stdout=DEVNULL, stderr=DEVNULL)
+            subprocess.check_call(["ffmpeg", "-y", "-i", "sounds/hello.wav", "-t", "5", self.fpaths[2]],
+                                  stdout=DEVNULL, stderr=DEVNULL)
+        self.segmenter = _CountingSegmenter(**DEFAULT_CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _load(self, name):
+        with open(path.join(self.output_dir, name, "segments.json")) as f:
+            return json.load(f)
+
+    def test_failure_closes_audio(self):
+        sources = []
+
+        def fail(first_dir, source, *args):
+            sources.append(source)
+            raise RuntimeError("the disk is full")
+
+        self.segmenter._copy_segments = fail
+        with self.assertRaises(RuntimeError):
+            self.segmenter.segment_batch(self.fpaths, self.output_dir, verbose=False)
+        self.assertEqual(len(sources), 1)
+        self.assertFalse(path.exists(sources[0].tmp_file), "The transcode should have been deleted.")
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["hello.wav"], "No directory should be left behind.")
+
+    def test_unreadable_file(self):
+        broken_fpath = path.join(self.input_dir, "broken.wav")
+        with open(broken_fpath, "wb") as f:
+            f.write(b"this is not audio")
+        for dedupe in [True, False]:
+            with self.assertRaises(FormatError):
+                self.segmenter.segment_batch([broken_fpath], self.output_dir, verbose=False, dedupe=dedupe)
+            self.assertEqual(os.listdir(self.output_dir), [], "No directory should be left behind.")
+
+    def test_duplicates_segmented_once(self):
+        groups = self.segmenter.segment_batch(self.fpaths, self.output_dir, output_audio=True, verbose=False)
+        self.assertEqual(groups, [self.fpaths[:2], self.fpaths[2:]])
+        self.assertEqual(self.segmenter.segmented, 2)
+
+        original, copy = self._load("hello.wav"), self._load("copy.flac")
+        self.assertEqual(copy["track_name"], "copy.flac")
+        self.assertEqual(copy["duplicate_of"], "hello.wav")
+        self.assertNotIn("duplicate_of", original)
+        self.assertEqual(copy["segments"], original["segments"])
+        for seg in copy["segments"]:
+            self.assertTrue(path.exists(path.join(self.output_dir, "copy.flac", seg["fname"])))
+        self.assertLess(self._load("short.wav")["track_duration"], 5.1)
+
+    def test_without_dedupe(self):
+        groups = self.segmenter.segment_batch(self.fpaths, self.output_dir, verbose=False, dedupe=False)
+        self.assertEqual(groups, [[fpath] for fpath in self.fpaths])
+        self.assertEqual(self.segmenter.segmented, 3)
+        self.assertEqual(self._load("copy.flac")["segments"], self._load("hello.wav")["segments"])
+
+    def test_same_names(self):
+        with self.assertRaises(ConfigError):
+            self.segmenter.segment_batch([self.fpaths[0], self.fpaths[0]], self.output_dir, verbose=False)
+
+
+class SpeechFlagsTests(unittest.TestCase):
+
+    def setUp(self):
+        if not path.exists(output_dir):
+            os.mkdir(output_dir)
+        self.segmenter = default_segmenter()
+
+    def test_matches_index(self):
+        import numpy as np
+        flags, hop_s = self.segmenter.speech_flags("sounds/hello.wav")
+        self.assertEqual(flags.dtype, np.bool_)
+        self.assertEqual(hop_s, 0.01)
+        self.assertTrue(flags.any() and not flags.all())
+
+        self.segmenter.segment_audio("sounds/hello.wav", output_dir, output_audio=False, verbose=False,
+                                     write_index=True)
+        indexed, _ = self.segmenter.speech_flags(path.join(output_dir, INDEX_FNAME))
+        self.assertTrue(np.array_equal(flags, indexed))
+
+        self.segmenter.native = False
+        self.assertTrue(np.array_equal(flags, self.segmenter.speech_flags("sounds/hello.wav")[0]))
+
+    def test_packed(self):
+        import numpy as np
+        flags, _ = self.segmenter.speech_flags("sounds/hello.wav")
+        packed, _ = self.segmenter.speech_flags("sounds/hello.wav", packed=True)
+        self.assertEqual(len(packed), -(-len(flags) // 8))
+        self.assertTrue(np.array_equal(np.unpackbits(packed)[:len(flags)].view(np.bool_), flags))
+
+
+class HopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.coarse = [seg for seg, _ in default_segmenter().segment_stream("sounds/hello.wav")]
+
+    def test_same_hop_as_frame(self):
+        segmenter = Segmenter(hop_ms=10, **DEFAULT_CONFIG)
+        self.assertEqual([seg for seg, _ in segmenter.segment_stream("sounds/hello.wav")], self.coarse)
+
+    def test_whole_track_counted(self):
+        # Loop the test track and stop it just after the speech in the last copy, so that any path which stopped
+        # short of the end of the track would lose the last segment.
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            long_fpath = path.join(tmp_dir, "long.wav")
+            reader = wave.open("sounds/hello.wav", "rb")
+            pcm = reader.readframes(reader.getnframes())
+            writer = wave.open(long_fpath, "wb")
+            writer.setparams(reader.getparams())
+            copies = 8
+            for _ in range(copies - 1):
+                writer.writeframes(pcm)
+            last_copy_s = (copies - 1) * reader.getnframes() / float(reader.getframerate())
+            writer.writeframes(pcm[:int(10.3 * reader.getframerate()) * reader.getsampwidth() * reader.getnchannels()])
+            writer.close()
+            reader.close()
+
+            default = [seg for seg, _ in default_segmenter().segment_stream(long_fpath)]
+            self.assertAlmostEqual(default[-1][1], last_copy_s + self.coarse[-1][1], delta=0.02)
+            for kwargs in [dict(hop_ms=10), dict(native=False)]:
+                segmenter = Segmenter(**dict(DEFAULT_CONFIG, **kwargs))
+                self.assertEqual([seg for seg, _ in segmenter.segment_stream(long_fpath)], default, str(kwargs))
+            flags, _ = default_segmenter().speech_flags(long_fpath)
+            self.assertEqual(len(flags), len(Segmenter(hop_ms=10, **DEFAULT_CONFIG).speech_flags(long_fpath)[0]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_overlapping_frames(self):
+        segmenter = Segmenter(hop_ms=5, **DEFAULT_CONFIG)
+        segments = [seg for seg, _ in segmenter.segment_stream("sounds/hello.wav")]
+        # The first segment ends earlier than the coarse one, at a pause the finer hop resolves: frames from 1.145s
+        # to 1.175s are unvoiced, which is 7 frames and so over the 6 that `threshold_silence_ms` allows at a 5ms hop.
+        # At a 10ms hop, only the frames at 1.15s, 1.16s and 1.17s are, which isn't over 3.
+        self.assertEqual(segments, [(0.815, 1.175), (1.66, 2.28), (2.285, 2.7), (8.6, 9.07), (9.075, 10.085)])
+
+        segmenter.native = False
+        self.assertEqual([seg for seg, _ in segmenter.segment_stream("sounds/hello.wav")], segments)
+
+        flags, hop_s = segmenter.speech_flags("sounds/hello.wav")
+        self.assertEqual(hop_s, 0.005)
+        self.assertEqual([bool(f) for f in flags[228:237]], [True] + [False] * 7 + [True])
+        coarse_flags, _ = default_segmenter().speech_flags("sounds/hello.wav")
+        self.assertEqual([bool(f) for f in coarse_flags[114:119]], [True, False, False, False, True])
+        reader = wave.open("sounds/hello.wav", "rb")
+        duration_s = reader.getnframes() / float(reader.getframerate())
+        reader.close()
+        self.assertAlmostEqual(len(flags) * hop_s, duration_s, delta=0.01)
+
+    def test_refinement(self):
+        segmenter = Segmenter(refine_hop_ms=2, **DEFAULT_CONFIG)
+        segments = [seg for seg, _ in segmenter.segment_stream("sounds/hello.wav")]
+        # The refinement's detectors are new, so their decisions aren't quite those of the full pass: they hear the
+        # second segment end at 2.16s, 120ms before the coarse pass does. That is more than a coarse hop away, so the
+        # boundary is left where it was, as are the ends of the first and last segments.
+        self.assertEqual(segments, [(0.812, 1.48), (1.67, 2.28), (2.29, 2.698), (8.592, 9.064), (9.07, 10.09)])
+        step_s = DEFAULT_CONFIG["frame_duration_ms"] / 1000.0
+        previous_end = 0.0
+        for (start, end), (coarse_start, coarse_end) in zip(segments, self.coarse):
+            self.assertLessEqual(previous_end, start)
+            self.assertLess(start, end)
+            self.assertLessEqual(abs(start - coarse_start), step_s)
+            self.assertLessEqual(abs(end - coarse_end), step_s)
+            previous_end = end
+
+    def test_bad_config(self):
+        for kwargs in [dict(hop_ms=3), dict(hop_ms=20), dict(refine_hop_ms=10), dict(hop_ms=5, refine_hop_ms=5),
+                       dict(hop_ms=5, lookahead_ms=500)]:
+            with self.assertRaises(ConfigError, msg=str(kwargs)):
+                Segmenter(**dict(DEFAULT_CONFIG, **kwargs))
+        with self.assertRaises(ConfigError):
+            Segmenter(hop_ms=5, **DEFAULT_CONFIG).segment_audio("sounds/hello.wav", output_dir, verbose=False,
+                                                                write_index=True)
+
+
+class _CountingReader(object):
+    """ Wraps a `wave` reader, counting the PCM frames read through it. """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.frames_read = 0
+
+    def readframes(self, n):
+        pcm = self.reader.readframes(n)
+        self.frames_read += len(pcm) // (self.reader.getsampwidth() * self.reader.getnchannels())
+        return pcm
+
+    def __getattr__(self, attr):
+        return getattr(self.reader, attr)
+
+
+class AutoTuneTests(unittest.TestCase):
+
+    def setUp(self):
+        if not path.exists(output_dir):
+            os.mkdir(output_dir)
+        self.segmenter = Segmenter(auto_tune=True, **DEFAULT_CONFIG)
+
+    def test_parameters_in_json(self):
+        self.segmenter.segment_audio("sounds/hello.wav", output_dir, output_audio=False, verbose=False)
+        with open(path.join(output_dir, "segments.json")) as f:
+            data = json.load(f)
+        chosen = data["auto_tune"]
+        self.assertIn(chosen["aggression"], [1, 2, 3])
+        tuned = Segmenter(**dict(DEFAULT_CONFIG, aggression=chosen["aggression"],
+                                 threshold_voice_ms=chosen["threshold_voice_ms"],
+                                 threshold_silence_ms=chosen["threshold_silence_ms"]))
+        self.assertEqual([(seg["start"], seg["end"]) for seg in data["segments"]],
+                         [seg for seg, _ in tuned.segment_stream("sounds/hello.wav")],
+                         "The segments should be those the chosen parameters give.")
+
+    def test_sampling_budget(self):
+        # Loop the test track out to five minutes.
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        long_fpath = path.join(tmp_dir, "long.wav")
+        reader = wave.open("sounds/hello.wav", "rb")
+        writer = wave.open(long_fpath, "wb")
+        writer.setparams(reader.getparams())
+        pcm = reader.readframes(reader.getnframes())
+        for _ in range(int(300 / (reader.getnframes() / float(reader.getframerate()))) + 1):
+            writer.writeframes(pcm)
+        writer.close()
+        reader.close()
+
+        chosen = self.segmenter.tune(long_fpath)
+        self.assertLessEqual(chosen["sampled_seconds"], 0.05 * 300)
+        self.assertGreater(chosen["speech_ratio"], 0)
+
+        # Count the audio read by tuning, against the full pass over the same preprocessed audio.
+        audio = self.segmenter._preprocess_audio(open_audio(long_fpath))
+        self.addCleanup(audio.close)
+        reader = audio.wave_reader = _CountingReader(audio.get_wave_reader())
+        self.segmenter._tune(audio)
+        tuning_read = reader.frames_read
+        reader.frames_read = 0
+        list(default_segmenter()._segments(audio))
+        self.assertGreaterEqual(reader.frames_read, reader.getnframes() - audio.frame_rate // 100)
+        self.assertLessEqual(tuning_read, 0.05 * reader.frames_read)
+
+    def test_shorter_than_a_frame(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        short_fpath = path.join(tmp_dir, "short.wav")
+        for num_samples in [220, 0]:
+            _write_excerpt(short_fpath, num_samples)
+            chosen = self.segmenter.tune(short_fpath)
+            for key in ["aggression", "threshold_voice_ms", "threshold_silence_ms"]:
+                self.assertEqual(chosen[key], DEFAULT_CONFIG[key])
+            self.assertEqual(chosen["sampled_seconds"], 0)
+
+            # The whole segment_audio path, index and all, should give an empty segmentation.
+            track_dir = path.join(tmp_dir, "out-%d" % num_samples)
+            os.mkdir(track_dir)
+            self.segmenter.segment_audio(short_fpath, track_dir, verbose=False, write_index=True)
+            with open(path.join(track_dir, "segments.json")) as f:
+                data = json.load(f)
+            self.assertEqual(data["segments"], [])
+            self.assertEqual(data["auto_tune"]["aggression"], DEFAULT_CONFIG["aggression"])
+            self.assertEqual(sorted(os.listdir(track_dir)), ["segments.json", "segments.wkix"])
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
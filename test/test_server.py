@@ -0,0 +1,191 @@
+# Make `wahi_korero` visible on sys.path
+import sys
+sys.path.append("..")
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os import path
+import signal
+import socket
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from wahi_korero import default_segmenter
+from wahi_korero import server
+from wahi_korero.audiosegment import MyAudioSegment
+from wahi_korero.decoder import DecoderPool
+from wahi_korero.server import SegmentationServer
+
+
+def _worker_decoder(config):
+    """ Run in a worker process, to check that its segmenters are given a `DecoderPool`. """
+    return isinstance(server._warm_segmenter(config).decoder, DecoderPool)
+
+
+class SegmentationServerTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = SegmentationServer(workers=2, shared_roots=[path.abspath("sounds")]).start()
+        with open("sounds/hello.wav", "rb") as f:
+            cls.audio = f.read()
+        cls.expected = [list(seg) for seg, _ in default_segmenter().segment_stream("sounds/hello.wav")]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def _post(self, query="", data=None, content_type="audio/wav"):
+        request = Request(self.server.url + "/segment" + query, data=self.audio if data is None else data,
+                          headers={"Content-Type": content_type})
+        response = urlopen(request)
+        return json.loads(response.read().decode("utf-8"))
+
+    def _segments(self, data):
+        return [[seg["start"], seg["end"]] for seg in data["segments"]]
+
+    def test_upload(self):
+        data = self._post("?name=hello.wav")
+        self.assertEqual(data["track_name"], "hello.wav")
+        self.assertEqual(data["num_segments"], len(self.expected))
+        self.assertEqual(self._segments(data), self.expected)
+
+    def test_concurrent_uploads(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: self._post(), range(32)))
+        for data in results:
+            self.assertEqual(self._segments(data), self.expected)
+
+    def test_streamed(self):
+        # Every `AudioSegment` probes its file when it is made, so counting them counts the probes.
+        probed = []
+        init = MyAudioSegment.__init__
+
+        def counting_init(audio, file_path, *args, **kwargs):
+            probed.append(file_path)
+            init(audio, file_path, *args, **kwargs)
+        MyAudioSegment.__init__ = counting_init
+        try:
+            for query, stream_threshold_s in [("?stream=1", 60), ("", 10)]:  # asked to, or over the threshold
+                self.server.stream_threshold_s = stream_threshold_s
+                del probed[:]
+                data = self._post(query)
+                self.assertEqual(data["num_segments"], len(self.expected))
+                self.assertEqual(self._segments(data), self.expected)
+                self.assertEqual(data["track_duration"], 11.93)
+                self.assertEqual(len(probed), 1, "The upload should only be probed once.")
+        finally:
+            MyAudioSegment.__init__ = init
+            self.server.stream_threshold_s = 60
+
+    def test_warm_decoder(self):
+        self.assertIsInstance(self.server.warm_segmenter(server.DEFAULT_CONFIG).decoder, DecoderPool)
+        self.assertTrue(self.server.executor.submit(_worker_decoder, server.DEFAULT_CONFIG).result(),
+                        "Worker processes should decode with a `DecoderPool`.")
+
+    def test_stream_flag(self):
+        hello = path.abspath("sounds/hello.wav")
+        for body, chunked in [({"path": hello, "stream": False}, False), ({"path": hello, "stream": True}, True),
+                              ({"path": hello, "config": {"stream": "no"}}, False)]:
+            request = Request(self.server.url + "/segment", data=json.dumps(body).encode("utf-8"),
+                              headers={"Content-Type": "application/json"})
+            response = urlopen(request)
+            self.assertEqual(response.headers.get("Transfer-Encoding") == "chunked", chunked, body)
+            self.assertEqual(self._segments(json.loads(response.read().decode("utf-8"))), self.expected)
+        with self.assertRaises(HTTPError) as context:
+            self._post("?stream=sometimes")
+        self.assertEqual(context.exception.code, 400)
+
+    def test_config(self):
+        segments = self._segments(self._post("?lookahead_ms=100"))
+        self.assertNotEqual(segments, self.expected, "Parameters should be passed on to the segmenter.")
+        with self.assertRaises(HTTPError) as context:
+            self._post("?frame_duration_ms=7")
+        self.assertEqual(context.exception.code, 400)
+        with self.assertRaises(HTTPError) as context:
+            self._post("?nonsense=1")
+        self.assertEqual(context.exception.code, 400)
+
+    def test_shared_path(self):
+        body = json.dumps({"path": path.abspath("sounds/hello.wav")}).encode("utf-8")
+        self.assertEqual(self._segments(self._post(data=body, content_type="application/json")), self.expected)
+
+        body = json.dumps({"path": path.abspath("test_server.py")}).encode("utf-8")
+        with self.assertRaises(HTTPError) as context:
+            self._post(data=body, content_type="application/json")
+        self.assertEqual(context.exception.code, 403)
+
+    def test_worker_killed(self):
+        self.assertEqual(self._segments(self._post()), self.expected)
+        executor = self.server.executor
+        for process in list(executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+        for _ in range(3):
+            self.assertEqual(self._segments(self._post()), self.expected,
+                             "The pool should be restarted after a worker dies.")
+        self.assertIsNot(self.server.executor, executor)
+
+    def test_shared_root(self):
+        for root in ["/", path.abspath("sounds") + os.sep]:
+            with SegmentationServer(workers=1, shared_roots=[root]) as other:
+                self.assertEqual(other.check_shared_path("sounds/hello.wav"), path.abspath("sounds/hello.wav"))
+                with self.assertRaises(PermissionError if root != "/" else FileNotFoundError):
+                    other.check_shared_path("no-such-file.wav")
+
+    def test_bad_json(self):
+        for body in [[1, 2], {"path": path.abspath("sounds/hello.wav"), "config": [1]}, {"path": 7}, "{"]:
+            data = (body if isinstance(body, str) else json.dumps(body)).encode("utf-8")
+            with self.assertRaises(HTTPError) as context:
+                self._post(data=data, content_type="application/json")
+            self.assertEqual(context.exception.code, 400, body)
+
+    def test_short_body(self):
+        for content_type, body in [("audio/wav", self.audio[:1000]), ("application/json", b'{"path": ')]:
+            connection = socket.create_connection(("127.0.0.1", self.server.port))
+            try:
+                connection.sendall("POST /segment HTTP/1.1\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n"
+                                   .format(content_type, len(body) + 1000).encode("ascii") + body)
+                connection.shutdown(socket.SHUT_WR)  # as if the client had gone away part way through
+                response = connection.makefile("rb").read().decode("utf-8")
+            finally:
+                connection.close()
+            self.assertTrue(response.startswith("HTTP/1.1 400"), response)
+            self.assertIn("ended after {} of its {} bytes".format(len(body), len(body) + 1000), response)
+
+    def test_unexpected_error(self):
+        # A `ValueError` from deep inside segmenting isn't the client's fault either.
+        for error in [RuntimeError("the worker went away"), ValueError("the decoder gave up")]:
+            def fail(*args):
+                raise error
+            self.server.batcher.submit = fail
+            try:
+                with self.assertRaises(HTTPError) as context:
+                    self._post()
+            finally:
+                del self.server.batcher.submit
+            self.assertEqual(context.exception.code, 500)
+            self.assertIn(type(error).__name__, json.loads(context.exception.read().decode("utf-8"))["error"])
+
+    def test_streamed_error(self):
+        warm_segmenter = self.server.warm_segmenter
+
+        class Failing(object):
+            decoder = None
+
+            def segment_stream(self, fpath):
+                yield (0.5, 1.0), None
+                raise RuntimeError("the decoder went away")
+
+        self.server.warm_segmenter = lambda config: Failing()
+        try:
+            data = self._post("?stream=1")
+        finally:
+            self.server.warm_segmenter = warm_segmenter
+        self.assertEqual(self._segments(data), [[0.5, 1.0]])
+        self.assertNotIn("num_segments", data)
+        self.assertIn("decoder went away", data["error"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,124 @@
+# Make `wahi_korero` visible on sys.path
+import sys
+sys.path.append("..")
+
+import json
+import os
+from os import path
+import statistics
+import subprocess
+import unittest
+
+# What a cold start loads. `loaded` is what importing `wahi_korero` pulls in of the modules that are slow to import,
+# and `segmenting` is every module which segmenting a file imports once `warmup` has been called.
+_COLD_START = """
+import json, sys
+import wahi_korero
+loaded = sorted(m for m in ("wahi_korero.segment", "webrtcvad", "_webrtcvad", "pkg_resources", "urllib.request")
+                if m in sys.modules)
+with wahi_korero.DecoderPool(size=1) as pool:
+    segmenter = wahi_korero.default_segmenter()
+    segmenter.decoder = pool
+    wahi_korero.warmup(segmenter)
+    waiting = sum(len(procs) for procs in pool._warm.values())
+    vad = "_webrtcvad" in sys.modules
+    warmed = set(sys.modules)
+    segments = [seg for seg, _ in segmenter.segment_stream("test/sounds/hello.wav")]
+print(json.dumps({"loaded": loaded, "waiting": waiting, "vad": vad, "segments": len(segments),
+                  "segmenting": sorted(set(sys.modules) - warmed)}))
+"""
+
+# Segments hello.wav as if `webrtcvad` had no `_webrtcvad` module to import, so that the public `webrtcvad.Vad` is used.
+_PUBLIC_VAD = """
+import json, sys
+import webrtcvad
+sys.modules["_webrtcvad"] = None  # `import _webrtcvad` now raises ImportError
+from wahi_korero import segment
+segmenter = segment.default_segmenter()
+segments = [seg for seg, _ in segmenter.segment_stream("test/sounds/hello.wav")]
+segmenter.native = False
+assert [seg for seg, _ in segmenter.segment_stream("test/sounds/hello.wav")] == segments
+print(json.dumps({"fallback": segment._webrtcvad is None, "segments": segments}))
+"""
+
+# Times a cold import of `wahi_korero` and a call to `warmup`, in seconds.
+_TIMED_START = """
+import json, time
+started = time.perf_counter()
+import wahi_korero
+imported = time.perf_counter()
+with wahi_korero.DecoderPool(size=1) as pool:
+    segmenter = wahi_korero.default_segmenter()
+    segmenter.decoder = pool
+    wahi_korero.warmup(segmenter)
+    warmed = time.perf_counter()
+print(json.dumps({"import": imported - started, "warmup": warmed - imported}))
+"""
+
+# Budgets for the start-up benchmark, in seconds, which the medians of `_BENCHMARK_RUNS` cold starts are checked
+# against. They are five times the limits the first version of these tests had, so that only a real regression, such
+# as `webrtcvad` or `urllib.request` being imported eagerly again, goes over them.
+IMPORT_BUDGET_S = 0.25
+WARMUP_BUDGET_S = 2.5
+_BENCHMARK_RUNS = 5
+
+
+def _cold_start():
+    """ Run `_COLD_START` in a fresh interpreter, so that nothing has been imported yet. """
+    output = subprocess.check_output([sys.executable, "-c", _COLD_START],
+                                     cwd=path.dirname(path.dirname(path.abspath(__file__))))
+    return json.loads(output.decode("utf-8"))
+
+
+class StartupTests(unittest.TestCase):
+
+    def test_lazy_import(self):
+        self.assertEqual(_cold_start()["loaded"], [], "Nothing heavy should be imported until it's used.")
+
+    def test_warmup(self):
+        result = _cold_start()
+        self.assertTrue(result["vad"])
+        self.assertEqual(result["waiting"], 1, "The decoder pool should have a process waiting.")
+        self.assertGreater(result["segments"], 0)
+        self.assertEqual(result["segmenting"], [], "Warming up should import everything segmenting needs.")
+
+    @unittest.skipUnless(os.environ.get("WAHI_KORERO_BENCHMARK"), "Set WAHI_KORERO_BENCHMARK=1 to time start-up.")
+    def test_startup_budget(self):
+        runs = []
+        for _ in range(_BENCHMARK_RUNS):
+            output = subprocess.check_output([sys.executable, "-c", _TIMED_START],
+                                             cwd=path.dirname(path.dirname(path.abspath(__file__))))
+            runs.append(json.loads(output.decode("utf-8")))
+        import_s = statistics.median(run["import"] for run in runs)
+        warmup_s = statistics.median(run["warmup"] for run in runs)
+        print("\nimport wahi_korero: {:.3f}s, warmup(): {:.3f}s".format(import_s, warmup_s))
+        self.assertLess(import_s, IMPORT_BUDGET_S)
+        self.assertLess(warmup_s, WARMUP_BUDGET_S)
+
+    def test_public_vad_fallback(self):
+        from wahi_korero import default_segmenter
+        output = subprocess.check_output([sys.executable, "-c", _PUBLIC_VAD],
+                                         cwd=path.dirname(path.dirname(path.abspath(__file__))))
+        result = json.loads(output.decode("utf-8"))
+        self.assertTrue(result["fallback"])
+        self.assertEqual([tuple(seg) for seg in result["segments"]],
+                         [seg for seg, _ in default_segmenter().segment_stream("sounds/hello.wav")])
+
+    def test_public_names(self):
+        import wahi_korero
+        for name in wahi_korero.__all__:
+            self.assertTrue(hasattr(wahi_korero, name), name)
+        with self.assertRaises(AttributeError):
+            wahi_korero.no_such_name
+
+    def test_submodules(self):
+        # In a fresh interpreter, so that the submodules haven't been imported yet.
+        output = subprocess.check_output(
+            [sys.executable, "-c", "import wahi_korero; print(wahi_korero.segment.Segmenter.__name__, "
+                                   "wahi_korero.daemon.SpoolDaemon.__name__)"],
+            cwd=path.dirname(path.dirname(path.abspath(__file__))))
+        self.assertEqual(output.decode("utf-8").split(), ["Segmenter", "SpoolDaemon"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,219 @@
+# Make `wahi_korero` visible on sys.path
+import sys
+sys.path.append("..")
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import os
+from os import path
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from wahi_korero import DecoderPool, default_segmenter, FormatError
+from wahi_korero.audiosegment import HEAD_BYTES, MyAudioSegment
+from wahi_korero.utils import open_audio
+
+
+class _AudioHandler(BaseHTTPRequestHandler):
+    """ Serves the files in `server.files` without a Content-Length, a chunk at a time, like a streaming store. """
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        for i in range(0, len(data), 8192):
+            self.wfile.write(data[i:i + 8192])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _GatedReader(object):
+    """ A file object which holds back everything after `gate_at` bytes until `gate` is set, or `timeout_s` passes. """
+
+    def __init__(self, data, gate_at, timeout_s=30):
+        self.data = data
+        self.gate_at = gate_at
+        self.timeout_s = timeout_s
+        self.gate = threading.Event()
+        self.pos = 0
+
+    def read(self, size=-1):
+        if self.pos >= self.gate_at:
+            self.gate.wait(self.timeout_s)
+        end = len(self.data) if size is None or size < 0 else self.pos + size
+        if self.pos < self.gate_at:
+            end = min(end, self.gate_at)
+        chunk = self.data[self.pos:end]
+        self.pos += len(chunk)
+        return chunk
+
+
+class StreamInputTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.flac_fpath = path.join(cls.tmp_dir, "hello.flac")
+        with open(os.devnull, "w") as DEVNULL:
+            subprocess.check_call(["ffmpeg", "-y", "-i", "sounds/hello.wav", cls.flac_fpath],
+                                  stdout=DEVNULL, stderr=DEVNULL)
+        files = {}
+        for url_path, fpath in [("/hello.wav", "sounds/hello.wav"), ("/audio/1234", cls.flac_fpath),
+                                ("/notes.txt", None)]:
+            if fpath is None:
+                files[url_path] = b"these aren't the sounds you're looking for\n" * 100
+            else:
+                with open(fpath, "rb") as f:
+                    files[url_path] = f.read()
+
+        cls.server = HTTPServer(("127.0.0.1", 0), _AudioHandler)
+        cls.server.files = files
+        cls.url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmp_dir)
+
+    def setUp(self):
+        self.segmenter = default_segmenter()
+        self.expected = [seg for seg, _ in self.segmenter.segment_stream("sounds/hello.wav")]
+
+    def test_url(self):
+        segments = [seg for seg, _ in self.segmenter.segment_stream(self.url + "/hello.wav")]
+        self.assertEqual(segments, self.expected)
+
+    def test_sniffed_format(self):
+        expected = [seg for seg, _ in self.segmenter.segment_stream(self.flac_fpath)]
+        segments = [seg for seg, _ in self.segmenter.segment_stream(self.url + "/audio/1234")]
+        self.assertEqual(segments, expected, "The format should be sniffed when the URL has no extension.")
+
+    def test_decoder_pool(self):
+        with DecoderPool(size=1) as pool:
+            self.segmenter.decoder = pool
+            segments = [seg for seg, _ in self.segmenter.segment_stream(self.url + "/hello.wav")]
+        self.assertEqual(segments, self.expected)
+
+    def test_file_object(self):
+        with open("sounds/hello.wav", "rb") as f:
+            segments = [seg for seg, _ in self.segmenter.segment_stream(f)]
+            self.assertFalse(f.closed, "A file object belongs to the caller, so it shouldn't be closed.")
+        self.assertEqual(segments, self.expected)
+
+        source = io.BytesIO(b"these aren't the sounds you're looking for\n" * 100)
+        with self.assertRaises(FormatError):
+            open_audio(source)
+        self.assertFalse(source.closed, "A file object shouldn't be closed when its format is unknown either.")
+
+    def test_segments_before_stream_ends(self):
+        with open("sounds/hello.wav", "rb") as f:
+            data = f.read()
+        for decoder in [None, DecoderPool(size=1)]:
+            self.segmenter.decoder = decoder
+            source = _GatedReader(data, len(data) // 2)
+            stream = self.segmenter.segment_stream(source)
+            try:
+                self.assertEqual(next(stream)[0], self.expected[0])
+                self.assertLess(source.pos, len(data), "The first segment shouldn't wait for the whole stream.")
+                source.gate.set()
+                self.assertEqual([seg for seg, _ in stream], self.expected[1:])
+            finally:
+                source.gate.set()
+                if decoder is not None:
+                    decoder.close()
+
+    def test_bounded_read_ahead(self):
+        with open("sounds/hello.wav", "rb") as f:
+            data = f.read()
+        source = io.BytesIO(data)
+        audio = open_audio(source)
+        self.assertEqual(source.tell(), min(HEAD_BYTES, len(data)), "Only the head is read until the audio is used.")
+        self.assertIsNone(audio.duration_seconds)
+        local = open_audio("sounds/hello.wav")
+        self.assertEqual((audio.source_channels, audio.source_frame_rate),
+                         (local.source_channels, local.source_frame_rate))
+
+    def test_segment_audio_from_url(self):
+        output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        self.segmenter.segment_audio(self.url + "/hello.wav", output_dir, verbose=False)
+        with open(path.join(output_dir, "segments.json")) as f:
+            data = json.load(f)
+        self.assertEqual(data["track_name"], "hello.wav")
+        self.assertAlmostEqual(data["track_duration"], 11.93, places=2)
+        self.assertEqual([(seg["start"], seg["end"]) for seg in data["segments"]], self.expected)
+
+        # Without the audio of the segments, the stream is segmented as it is decoded, and its length found at the end.
+        piped_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        self.segmenter.segment_audio(self.url + "/hello.wav", piped_dir, output_audio=False, verbose=False)
+        with open(path.join(piped_dir, "segments.json")) as f:
+            piped = json.load(f)
+        self.assertEqual(piped["track_duration"], data["track_duration"])
+        self.assertEqual([(seg["start"], seg["end"]) for seg in piped["segments"]], self.expected)
+
+        first = data["segments"][0]
+        local = next(self.segmenter.segment_stream("sounds/hello.wav", output_audio=True))[1]
+        with open(path.join(output_dir, first["fname"]), "rb") as f:
+            self.assertEqual(f.read(), open_audio_bytes(local), "Segments cut from a stream should be lossless.")
+
+    def test_closed_on_error(self):
+        def failing_progress(report):
+            raise RuntimeError("The progress callback failed.")
+        output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        opened = []
+        init = MyAudioSegment.__init__
+
+        def recording_init(audio, file_path, *args, **kwargs):
+            opened.append(audio)
+            init(audio, file_path, *args, **kwargs)
+        MyAudioSegment.__init__ = recording_init
+        try:
+            with self.assertRaises(RuntimeError):
+                self.segmenter.segment_audio(self.url + "/hello.wav", output_dir, output_audio=True, verbose=False,
+                                             progress=failing_progress)
+        finally:
+            MyAudioSegment.__init__ = init
+        audio, = opened
+        self.assertTrue(audio.stream._stream.closed, "The connection to a URL should be closed.")
+        self.assertFalse(path.exists(audio.tmp_file), "The decoded audio should be deleted.")
+        self.assertIsNone(audio.source_dir, "The saved copy of the stream should be deleted.")
+
+        # Audio handed in is the caller's to close.
+        audio = open_audio(self.url + "/hello.wav", keep_source=True)
+        with self.assertRaises(RuntimeError):
+            self.segmenter.segment_audio(audio, output_dir, output_audio=True, verbose=False,
+                                         progress=failing_progress)
+        self.assertTrue(path.exists(audio.tmp_file))
+        self.assertTrue(path.isdir(audio.source_dir))
+        audio.close()
+
+    def test_unsupported_content(self):
+        with self.assertRaises(FormatError):
+            open_audio(self.url + "/notes.txt")
+
+
+def open_audio_bytes(audio_slice):
+    """ Export an `AudioSlice` to a wav file and read it back. """
+    fd, fpath = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    try:
+        audio_slice.export(fpath)
+        with open(fpath, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(fpath)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -1,4 +1,39 @@
-
 name = "wahi_korero"
 
-from .segment import ConfigError, DEFAULT_CONFIG, default_segmenter, FormatError, Segmenter, frame_audio, frame_stream
+import importlib
+from .exceptions import Cancelled, ConfigError, FormatError
+
+# The rest of the public API is imported the first time it's used, so that `import wahi_korero` stays cheap for
+# command line tools and short-lived processes that might never segment anything.
+_LAZY = {
+    "CancelToken": "progress",
+    "DecoderPool": "decoder",
+    "DEFAULT_CONFIG": "segment",
+    "default_segmenter": "segment",
+    "Segmenter": "segment",
+    "frame_audio": "segment",
+    "frame_stream": "segment",
+    "merge_channels": "segment",
+    "Progress": "progress",
+    "warmup": "segment",
+}
+
+__all__ = ["Cancelled", "ConfigError", "FormatError"] + sorted(_LAZY)
+
+
+def __getattr__(attr):
+    if attr not in _LAZY:
+        # Submodules, such as `wahi_korero.segment`, are imported the first time they're used too.
+        try:
+            return importlib.import_module("." + attr, __name__)
+        except ModuleNotFoundError as e:
+            if e.name != __name__ + "." + attr:
+                raise
+        raise AttributeError("module `{}` has no attribute `{}`".format(__name__, attr))
+    value = getattr(importlib.import_module("." + _LAZY[attr], __name__), attr)
+    globals()[attr] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,560 @@
+/*
+ * A compiled version of `Segmenter._vad_collector`. It slices PCM into frames, runs webrtcvad on each one and runs the
+ * ring buffer that decides where segments start and end.
+ *
+ * Once `bind_webrtcvad` has been given the private `_webrtcvad` module, a collector whose `process` is
+ * `_webrtcvad.process` calls the library's `WebRtcVad_Process` directly, with the pointers inside its handles, so a
+ * frame doesn't cost any Python calls or objects at all. Otherwise, each frame costs a call to `process` through
+ * `PyObject_CallFunctionObjArgs`, with a memoryview over the frame and a Python int for its length. If the direct call
+ * fails, `process` is called on the same frame so that it raises the error it always has.
+ *
+ * Segment boundaries are returned as frame indices; `segment.py` turns them into timestamps. This module is optional,
+ * and must give exactly the same results as the Python implementation.
+ *
+ * When frames overlap, `vad` is a tuple of webrtcvad handles which take the frames in turn. Each one then sees frames
+ * that follow on from each other, as it would without the overlap, which keeps its adaptive state meaningful.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <structmember.h>
+#include <stdint.h>
+#include <stdlib.h>
+#ifndef _WIN32
+#include <dlfcn.h>
+#endif
+
+/* The prototype of `WebRtcVad_Process` in the copy of webrtc that webrtcvad 2.0.x is built from
+ * (`cbits/webrtc/common_audio/vad/include/webrtc_vad.h`). `frame_length` is an `int` there, though later versions of
+ * webrtc made it a `size_t`, so `segment.py` only binds versions whose prototype has been checked against this one. */
+typedef int (*vad_process_fn)(void *handle, int fs, const int16_t *audio_frame, int frame_length);
+
+/* Set by `bind_webrtcvad`: `WebRtcVad_Process`, and the `_webrtcvad.process` it stands in for. */
+static vad_process_fn webrtcvad_process = NULL;
+static PyObject *webrtcvad_process_obj = NULL;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *process;      /* _webrtcvad.process */
+    PyObject *vads;         /* tuple of webrtcvad handles passed to `process`, one frame each in turn */
+    Py_ssize_t next_vad;    /* index in `vads` of the handle for the next frame */
+    PyObject *rate;         /* sample rate, as a Python int */
+    long rate_value;        /* the same, as a C long */
+    void **handles;         /* the `VadInst` pointers in `vads`, if `WebRtcVad_Process` can be called directly */
+    char direct;            /* whether `handles` is set */
+    Py_ssize_t frame_bytes; /* size of a whole frame in bytes */
+    Py_ssize_t hop_bytes;   /* distance between the starts of successive frames, in bytes */
+    int threshold_voice;
+    int threshold_silence;
+
+    /* Ring buffer of is_speech flags for the most recent frames. */
+    unsigned char *ring;
+    int buffer_len;
+    int head;               /* where the next flag goes */
+    int count;              /* number of flags in the ring */
+    int num_voiced;         /* number of set flags in the ring */
+
+    long long frame_index;  /* index of the next frame to be fed */
+    int collecting;
+    long long segment_start;
+    long long segment_end;
+} Collector;
+
+static void ring_clear(Collector *c)
+{
+    c->head = 0;
+    c->count = 0;
+    c->num_voiced = 0;
+}
+
+/* Append a flag, dropping the oldest one if the ring is full, like a `deque` with a `maxlen`. */
+static void ring_append(Collector *c, int is_speech)
+{
+    if (c->count == c->buffer_len) {
+        c->num_voiced -= c->ring[c->head];
+    } else {
+        c->count++;
+    }
+    c->ring[c->head] = (unsigned char)is_speech;
+    c->num_voiced += is_speech;
+    c->head = (c->head + 1) % c->buffer_len;
+}
+
+static int Collector_init(Collector *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"process", "vad", "sample_rate", "frame_bytes", "buffer_len", "threshold_voice",
+                             "threshold_silence", "hop_bytes", NULL};
+    PyObject *process, *vad, *vads, *rate_obj;
+    unsigned char *ring;
+    void **handles = NULL;
+    long rate;
+    Py_ssize_t frame_bytes, hop_bytes = 0, i;
+    int buffer_len, threshold_voice, threshold_silence;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOlniii|n", kwlist, &process, &vad, &rate, &frame_bytes,
+                                     &buffer_len, &threshold_voice, &threshold_silence, &hop_bytes)) {
+        return -1;
+    }
+    if (hop_bytes == 0) {
+        hop_bytes = frame_bytes;
+    }
+    if (buffer_len < 1 || frame_bytes < 2 || hop_bytes < 2 || hop_bytes > frame_bytes) {
+        PyErr_SetString(PyExc_ValueError, "buffer_len must be at least 1, frame_bytes at least 2, and hop_bytes "
+                                          "between 2 and frame_bytes");
+        return -1;
+    }
+
+    if (PyTuple_Check(vad)) {
+        if (PyTuple_GET_SIZE(vad) < 1) {
+            PyErr_SetString(PyExc_ValueError, "vad must not be an empty tuple");
+            return -1;
+        }
+        Py_INCREF(vad);
+        vads = vad;
+    } else {
+        vads = PyTuple_Pack(1, vad);
+        if (vads == NULL) {
+            return -1;
+        }
+    }
+    rate_obj = PyLong_FromLong(rate);
+    if (rate_obj == NULL) {
+        Py_DECREF(vads);
+        return -1;
+    }
+    ring = (unsigned char *)calloc((size_t)buffer_len, 1);
+    if (ring == NULL) {
+        Py_DECREF(vads);
+        Py_DECREF(rate_obj);
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    /* `WebRtcVad_Process` is only called directly if `process` is the function it is behind, and every handle is one
+     * of that module's capsules. Anything else goes through `process`. */
+    if (webrtcvad_process != NULL && process == webrtcvad_process_obj) {
+        handles = (void **)calloc((size_t)PyTuple_GET_SIZE(vads), sizeof(void *));
+        if (handles == NULL) {
+            Py_DECREF(vads);
+            Py_DECREF(rate_obj);
+            free(ring);
+            PyErr_NoMemory();
+            return -1;
+        }
+        for (i = 0; i < PyTuple_GET_SIZE(vads); i++) {
+            PyObject *capsule = PyTuple_GET_ITEM(vads, i);
+            const char *name;
+            if (!PyCapsule_CheckExact(capsule)) {
+                break;
+            }
+            name = PyCapsule_GetName(capsule);
+            handles[i] = PyCapsule_GetPointer(capsule, name);
+            if (handles[i] == NULL) {
+                PyErr_Clear();
+                break;
+            }
+        }
+        if (i < PyTuple_GET_SIZE(vads)) {
+            free(handles);
+            handles = NULL;
+        }
+    }
+
+    /* `__init__` can be called again on a collector which is already set up, so let go of its old state once the
+     * new state is in place. */
+    free(self->ring);
+    self->ring = ring;
+    free(self->handles);
+    self->handles = handles;
+    self->direct = handles != NULL;
+    Py_INCREF(process);
+    Py_XSETREF(self->process, process);
+    Py_XSETREF(self->vads, vads);
+    Py_XSETREF(self->rate, rate_obj);
+    self->rate_value = rate;
+    self->next_vad = 0;
+    self->frame_bytes = frame_bytes;
+    self->hop_bytes = hop_bytes;
+    self->buffer_len = buffer_len;
+    self->threshold_voice = threshold_voice;
+    self->threshold_silence = threshold_silence;
+    ring_clear(self);
+    self->frame_index = 0;
+    self->collecting = 0;
+    self->segment_start = 0;
+    self->segment_end = 0;
+    return 0;
+}
+
+static int Collector_traverse(Collector *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->process);
+    Py_VISIT(self->vads);
+    return 0;
+}
+
+/* Drops the Python objects the collector holds, and the handles taken from them, so that reference cycles through
+ * `process` can be broken. A cleared collector can't be used until `__init__` is called again. */
+static int Collector_clear(Collector *self)
+{
+    free(self->handles);
+    self->handles = NULL;
+    self->direct = 0;
+    Py_CLEAR(self->process);
+    Py_CLEAR(self->vads);
+    Py_CLEAR(self->rate);
+    return 0;
+}
+
+static void Collector_dealloc(Collector *self)
+{
+    PyObject_GC_UnTrack(self);
+    Collector_clear(self);
+    free(self->ring);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/* Raises an error and returns -1 if the collector hasn't been set up by `__init__`, or has been cleared since. */
+static int check_ready(Collector *self)
+{
+    if (self->vads == NULL || self->ring == NULL) {
+        PyErr_SetString(PyExc_ValueError, "The collector hasn't been initialised.");
+        return -1;
+    }
+    return 0;
+}
+
+static int append_boundary(PyObject *boundaries, long long start, long long end)
+{
+    PyObject *pair = Py_BuildValue("(LL)", start, end);
+    int result;
+    if (pair == NULL) {
+        return -1;
+    }
+    result = PyList_Append(boundaries, pair);
+    Py_DECREF(pair);
+    return result;
+}
+
+/* Run webrtcvad on one frame, with the next handle in turn. Returns 1 or 0, or -1 with an exception set. */
+static int is_speech(Collector *self, const char *data, Py_ssize_t length)
+{
+    PyObject *view, *length_obj, *result;
+    Py_ssize_t index = self->next_vad;
+    int truth;
+
+    self->next_vad = (self->next_vad + 1) % PyTuple_GET_SIZE(self->vads);
+
+    if (self->handles != NULL) {
+        truth = webrtcvad_process(self->handles[index], (int)self->rate_value, (const int16_t *)data,
+                                  (int)(length / 2));
+        if (truth >= 0) {
+            return truth;
+        }
+    }
+
+    view = PyMemoryView_FromMemory((char *)data, length, PyBUF_READ);
+    if (view == NULL) {
+        return -1;
+    }
+    length_obj = PyLong_FromSsize_t(length / 2);
+    if (length_obj == NULL) {
+        Py_DECREF(view);
+        return -1;
+    }
+    result = PyObject_CallFunctionObjArgs(self->process, PyTuple_GET_ITEM(self->vads, index), self->rate, view,
+                                          length_obj, NULL);
+    Py_DECREF(view);
+    Py_DECREF(length_obj);
+    if (result == NULL) {
+        return -1;
+    }
+    truth = PyObject_IsTrue(result);
+    Py_DECREF(result);
+    return truth;
+}
+
+/* Put the decision for the next frame through the ring buffer, appending to `boundaries` if it ends a segment.
+ * Returns 0, or -1 with an exception set. */
+static int collect(Collector *self, int speech, PyObject *boundaries)
+{
+    long long index = self->frame_index++;
+
+    if (!self->collecting) {
+        ring_append(self, speech);
+        if (self->num_voiced > self->threshold_voice) {
+            self->collecting = 1;
+            self->segment_start = index - self->count + 1;
+            self->segment_end = index;
+            ring_clear(self);
+        }
+    } else {
+        self->segment_end = index;
+        ring_append(self, speech);
+        if (self->count - self->num_voiced > self->threshold_silence) {
+            self->collecting = 0;
+            if (append_boundary(boundaries, self->segment_start, self->segment_end) < 0) {
+                return -1;
+            }
+            ring_clear(self);
+        }
+    }
+    return 0;
+}
+
+PyDoc_STRVAR(Collector_feed_doc,
+"feed(pcm, num_frames)\n\n"
+"Run `num_frames` frames of `pcm` through the collector. Frames start every `hop_bytes`. The last frame may be cut\n"
+"short by the end of `pcm`.\n"
+"Returns a list of `(start, end)` frame indices for each segment completed.");
+
+static PyObject *Collector_feed(Collector *self, PyObject *args)
+{
+    Py_buffer pcm;
+    Py_ssize_t num_frames, i;
+    PyObject *boundaries;
+
+    if (check_ready(self) < 0 || !PyArg_ParseTuple(args, "y*n", &pcm, &num_frames)) {
+        return NULL;
+    }
+    boundaries = PyList_New(0);
+    if (boundaries == NULL) {
+        PyBuffer_Release(&pcm);
+        return NULL;
+    }
+
+    for (i = 0; i < num_frames; i++) {
+        Py_ssize_t offset = i * self->hop_bytes;
+        Py_ssize_t length = self->frame_bytes;
+        int speech;
+
+        if (offset > pcm.len) {
+            offset = pcm.len;
+        }
+        if (offset + length > pcm.len) {
+            length = pcm.len - offset;
+        }
+        speech = is_speech(self, (const char *)pcm.buf + offset, length);
+        if (speech < 0 || collect(self, speech, boundaries) < 0) {
+            goto error;
+        }
+    }
+
+    PyBuffer_Release(&pcm);
+    return boundaries;
+
+error:
+    PyBuffer_Release(&pcm);
+    Py_DECREF(boundaries);
+    return NULL;
+}
+
+PyDoc_STRVAR(Collector_speech_flags_doc,
+"speech_flags(pcm, num_frames)\n\n"
+"Run webrtcvad over `num_frames` frames of `pcm`, without touching the ring buffer. Returns a `bytearray` with a\n"
+"0 or 1 for each frame.");
+
+static PyObject *Collector_speech_flags(Collector *self, PyObject *args)
+{
+    Py_buffer pcm;
+    Py_ssize_t num_frames, i;
+    PyObject *flags;
+    char *out;
+
+    if (check_ready(self) < 0 || !PyArg_ParseTuple(args, "y*n", &pcm, &num_frames)) {
+        return NULL;
+    }
+    flags = PyByteArray_FromStringAndSize(NULL, num_frames);
+    if (flags == NULL) {
+        PyBuffer_Release(&pcm);
+        return NULL;
+    }
+    out = PyByteArray_AS_STRING(flags);
+
+    for (i = 0; i < num_frames; i++) {
+        Py_ssize_t offset = i * self->hop_bytes;
+        Py_ssize_t length = self->frame_bytes;
+        int speech;
+
+        if (offset > pcm.len) {
+            offset = pcm.len;
+        }
+        if (offset + length > pcm.len) {
+            length = pcm.len - offset;
+        }
+        speech = is_speech(self, (const char *)pcm.buf + offset, length);
+        if (speech < 0) {
+            PyBuffer_Release(&pcm);
+            Py_DECREF(flags);
+            return NULL;
+        }
+        out[i] = (char)speech;
+    }
+
+    PyBuffer_Release(&pcm);
+    return flags;
+}
+
+PyDoc_STRVAR(Collector_feed_flags_doc,
+"feed_flags(flags)\n\n"
+"Like `feed`, but for frames whose VAD decisions have already been made, given as a bytes-like object with a 0 or 1\n"
+"for each frame.");
+
+static PyObject *Collector_feed_flags(Collector *self, PyObject *args)
+{
+    Py_buffer flags;
+    Py_ssize_t i;
+    PyObject *boundaries;
+
+    if (check_ready(self) < 0 || !PyArg_ParseTuple(args, "y*", &flags)) {
+        return NULL;
+    }
+    boundaries = PyList_New(0);
+    if (boundaries == NULL) {
+        PyBuffer_Release(&flags);
+        return NULL;
+    }
+    for (i = 0; i < flags.len; i++) {
+        if (collect(self, ((const unsigned char *)flags.buf)[i] != 0, boundaries) < 0) {
+            PyBuffer_Release(&flags);
+            Py_DECREF(boundaries);
+            return NULL;
+        }
+    }
+    PyBuffer_Release(&flags);
+    return boundaries;
+}
+
+PyDoc_STRVAR(Collector_finish_doc,
+"finish()\n\n"
+"Returns a list holding the `(start, end)` frame indices of any segment still being gathered, and resets it.");
+
+static PyObject *Collector_finish(Collector *self, PyObject *unused)
+{
+    PyObject *boundaries = PyList_New(0);
+    if (boundaries == NULL) {
+        return NULL;
+    }
+    if (self->collecting) {
+        self->collecting = 0;
+        if (append_boundary(boundaries, self->segment_start, self->segment_end) < 0) {
+            Py_DECREF(boundaries);
+            return NULL;
+        }
+    }
+    return boundaries;
+}
+
+static PyMethodDef Collector_methods[] = {
+    {"feed", (PyCFunction)Collector_feed, METH_VARARGS, Collector_feed_doc},
+    {"speech_flags", (PyCFunction)Collector_speech_flags, METH_VARARGS, Collector_speech_flags_doc},
+    {"feed_flags", (PyCFunction)Collector_feed_flags, METH_VARARGS, Collector_feed_flags_doc},
+    {"finish", (PyCFunction)Collector_finish, METH_NOARGS, Collector_finish_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyMemberDef Collector_members[] = {
+    {"direct", T_BOOL, offsetof(Collector, direct), READONLY,
+     "Whether frames go straight to `WebRtcVad_Process`, rather than through `process`."},
+    {NULL}
+};
+
+PyDoc_STRVAR(bind_webrtcvad_doc,
+"bind_webrtcvad(module)\n\n"
+"Look up `WebRtcVad_Process` in the private `_webrtcvad` module, so that collectors made afterwards with\n"
+"`module.process` can call it directly. The module must be built from webrtc with the prototype of `vad_process_fn`.\n"
+"Returns whether the symbol was found.");
+
+static PyObject *bind_webrtcvad(PyObject *unused, PyObject *module)
+{
+#ifdef _WIN32
+    Py_RETURN_FALSE;
+#else
+    PyObject *file, *process, *encoded;
+    void *library;
+    vad_process_fn fn;
+
+    file = PyObject_GetAttrString(module, "__file__");
+    if (file == NULL) {
+        return NULL;
+    }
+    if (!PyUnicode_FSConverter(file, &encoded)) {
+        Py_DECREF(file);
+        return NULL;
+    }
+    Py_DECREF(file);
+    process = PyObject_GetAttrString(module, "process");
+    if (process == NULL) {
+        Py_DECREF(encoded);
+        return NULL;
+    }
+
+    /* The module has already been loaded, so this only finds it again. It is never closed, as it is never unloaded. */
+#ifdef RTLD_NOLOAD
+    library = dlopen(PyBytes_AS_STRING(encoded), RTLD_NOW | RTLD_NOLOAD);
+#else
+    library = dlopen(PyBytes_AS_STRING(encoded), RTLD_NOW);
+#endif
+    Py_DECREF(encoded);
+    fn = library != NULL ? (vad_process_fn)dlsym(library, "WebRtcVad_Process") : NULL;
+    if (fn == NULL) {
+        Py_DECREF(process);
+        Py_RETURN_FALSE;
+    }
+    webrtcvad_process = fn;
+    Py_XSETREF(webrtcvad_process_obj, process);
+    Py_RETURN_TRUE;
+#endif
+}
+
+static PyMethodDef module_methods[] = {
+    {"bind_webrtcvad", (PyCFunction)bind_webrtcvad, METH_O, bind_webrtcvad_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject CollectorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "wahi_korero._collector.Collector",     /* tp_name */
+    sizeof(Collector),                      /* tp_basicsize */
+};
+
+static struct PyModuleDef collector_module = {
+    PyModuleDef_HEAD_INIT,
+    "_collector",
+    "Compiled frame loop for `Segmenter._vad_collector`.",
+    -1,
+    module_methods
+};
+
+PyMODINIT_FUNC PyInit__collector(void)
+{
+    PyObject *module;
+
+    CollectorType.tp_dealloc = (destructor)Collector_dealloc;
+    CollectorType.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC;
+    CollectorType.tp_traverse = (traverseproc)Collector_traverse;
+    CollectorType.tp_clear = (inquiry)Collector_clear;
+    CollectorType.tp_free = PyObject_GC_Del;
+    CollectorType.tp_doc = "Collector(process, vad, sample_rate, frame_bytes, buffer_len, threshold_voice, "
+                           "threshold_silence, hop_bytes=frame_bytes)\n\n"
+                           "The ring-buffer state machine of `Segmenter._vad_collector`. `vad` may be a tuple of\n"
+                           "webrtcvad handles, which take the frames in turn.";
+    CollectorType.tp_methods = Collector_methods;
+    CollectorType.tp_members = Collector_members;
+    CollectorType.tp_init = (initproc)Collector_init;
+    CollectorType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&CollectorType) < 0) {
+        return NULL;
+    }
+
+    module = PyModule_Create(&collector_module);
+    if (module == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&CollectorType);
+    if (PyModule_AddObject(module, "Collector", (PyObject *)&CollectorType) < 0) {
+        Py_DECREF(&CollectorType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
@@ -7,26 +7,232 @@ as required rather than loading up the whole thing.
 '''
 import subprocess
 import os
+import shutil
 import tempfile
 import wave
 import errno
+import array
+import io
+from .decoder import _copy_to_pipe, open_pcm, PIPE_UNFRIENDLY_FORMATS
+from .exceptions import FormatError
+from .progress import wait
+
+try:
+    import soundfile  # optional; lets us read file attributes without starting ffprobe
+except ImportError:
+    soundfile = None
+
+
+def _import_numpy(feature):
+    """
+    Import numpy, which only a few features need.
+
+    :param feature: the name of the feature, for the error message.
+    :raise ImportError: if numpy isn't installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("{} needs numpy, which isn't installed. Install it with `pip install wahi-korero[numpy]`."
+                          .format(feature))
+    return numpy
+
+
+def _probe_in_process(file_path):
+    """
+    Read the duration, channel count and sample rate of an audio file without starting a new process.
+
+    :param file_path: location of the audio.
+    :return: a tuple `(duration_seconds, channels, frame_rate)`, or `None` if the file can't be read in-process.
+    """
+    try:
+        reader = wave.open(file_path, 'rb')
+        try:
+            rate = reader.getframerate()
+            return float(reader.getnframes()) / rate, reader.getnchannels(), rate
+        finally:
+            reader.close()
+    except (wave.Error, EOFError, ZeroDivisionError):
+        pass
 
+    if soundfile is not None:
+        try:
+            info = soundfile.info(file_path)
+            return float(info.duration), info.channels, info.samplerate
+        except Exception:
+            pass
 
-class MyAudioSegment():
+    return None
+
+
+def _ffprobe(file_path, data=None, format=None):
+    """
+    Read the duration, channel count and sample rate of an audio file with a single call to ffprobe.
+
+    :param file_path: location of the audio, or a name for it if `data` is given.
+    :param data: if given, the start of the audio as `bytes`, which is probed instead of `file_path`. The duration
+        can't be known from this, so it is returned as `None`.
+    :param format: the format of `data`, if it is known.
+    :return: a tuple `(duration_seconds, channels, frame_rate)`.
+    :raise FormatError: if ffprobe couldn't read the file.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+           '-show_entries', 'format=duration:stream=channels,sample_rate',
+           '-of', 'default=noprint_wrappers=1']
+    if data is None:
+        cmd.append(file_path)
+    else:
+        cmd += (['-f', _DEMUXERS.get(format, format)] if format else []) + ['pipe:0']
+    with open(os.devnull, "w") as DEVNULL:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=DEVNULL)
+        output, errors = p.communicate(data)
+
+    values = {}
+    for line in output.decode("utf-8").splitlines():
+        key, _, value = line.partition("=")
+        values[key.strip()] = value.strip()
+    try:
+        duration = float(values["duration"]) if data is None else None
+        return duration, int(values["channels"]), int(values["sample_rate"])
+    except (KeyError, ValueError):
+        raise FormatError("ffprobe couldn't read `{}`".format(file_path))
+
+
+# How much of a stream is read up front, to sniff its format and probe it.
+HEAD_BYTES = 64 * 1024
+
+# The names ffmpeg gives the demuxers for formats which aren't named after them.
+_DEMUXERS = {"m4a": "mov", "mp4": "mov", "wma": "asf"}
+
+
+def sniff_format(head):
+    """
+    Guess the format of some audio from its first few bytes.
+
+    :param head: the start of the audio, as `bytes`.
+    :return: one of the extensions in `utils.SUPPORTED_FORMATS`, or `None` if the format isn't recognised.
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"FORM" and head[8:12] in (b"AIFF", b"AIFC"):
+        return "aiff"
+    if head[:3] == b"FLV":
+        return "flv"
+    if head[:16] == b"\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9\x00\xaa\x00\x62\xce\x6c":
+        return "wma"
+    if head[4:8] == b"ftyp":
+        return "mp4" if head[8:11] in (b"iso", b"mp4", b"avc") else "m4a"
+    if head[:3] == b"ID3":
+        return "mp3"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # An MPEG audio frame sync. Layer bits of 0 mean it's ADTS, i.e. AAC.
+        return "aac" if head[1] & 0x06 == 0 else "mp3"
+    return None
+
+
+class AudioStream(object):
+    """
+    A source of audio which can only be read once, from start to finish, like an HTTP response. The first `HEAD_BYTES`
+    are read up front, so that the format can be sniffed and the audio probed. After that, data is passed straight
+    through as it is asked for, so only a chunk at a time is held in memory.
+
+    :param stream: a file-like object with a `read` method.
+    :param name: a name for the audio, which is used as its track name.
+    :param format: a fallback for the format, if it can't be sniffed from the data.
+    :param owns_stream: whether `close` closes `stream`. Leave this unset for a file object that belongs to the
+        caller, and set it for one the library opened itself, like the response for a URL.
+    """
+
+    def __init__(self, stream, name="stream", format=None, owns_stream=False):
+        self.name = name
+        self._stream = stream
+        self._owns_stream = owns_stream
+        self._head = b""
+        while len(self._head) < HEAD_BYTES:
+            data = stream.read(HEAD_BYTES - len(self._head))
+            if not data:
+                break
+            self._head += data
+        self._pos = 0
+        self.format = sniff_format(self._head) or format
+        self.tee = None  # if set, a file which everything read is copied to
+        self.consumed = False
+
+    @property
+    def head(self):
+        return self._head
+
+    def read(self, size=-1):
+        if self._pos < len(self._head):
+            end = len(self._head) if size is None or size < 0 else self._pos + size
+            data = self._head[self._pos:end]
+            self._pos += len(data)
+        else:
+            data = self._stream.read(size)
+        if data and self.tee is not None:
+            self.tee.write(data)
+        return data
+
+    def close(self):
+        """ Close the underlying stream if it was opened by the library. A caller's file object is left open. """
+        if self._owns_stream:
+            self._stream.close()
 
-    def __init__(self, file_path, **kwargs):
+
+class MyAudioSegment():
+    '''
+    The audio at `file_path`, which can also be an `AudioStream`. A stream is read once, by the first `convert` or
+    `open_pcm`, which feed it straight into ffmpeg; until then its duration is `None`. `convert` only returns once the
+    whole stream has been read, whereas the PCM from `open_pcm` can be used as it is decoded. If `keep_source` is set, a copy of the
+    stream is saved as it is read so that it can be sliced; otherwise slicing a stream isn't possible.
+    '''
+
+    def __init__(self, file_path, decoder=None, keep_source=False, **kwargs):
+        self.stream = None
+        self.source_dir = None  # holds the saved copy of a stream, if there is one
+        if isinstance(file_path, AudioStream):
+            self.stream = file_path
+            file_path = None
         self.file_path = file_path
+        self.decoder = decoder  # optional `DecoderPool` used for transcoding
+        self.keep_source = keep_source
         self.use_tmp = False
         self.tmp_file = None
         self.tmp_dir = None
-        self.base_name = os.path.basename(self.file_path)
+        self.base_name = os.path.basename(file_path) if file_path is not None else self.stream.name
         self.wave_reader = None
+        if self.stream is not None and self.stream.format in PIPE_UNFRIENDLY_FORMATS:
+            self._save_stream()  # ffmpeg needs to seek around these, so they can't be piped in
         self.set_durations()
-        self.set_channels()
-        self.set_frame_rate()
         self.sample_width = 2
+        self.preprocessed = None  # set by a `Segmenter` once it has transcoded the audio for segmenting
+
+        # Remember what the original looked like, since transcoding changes the attributes above.
+        self.source_channels = self.channels
+        self.source_frame_rate = self.frame_rate
+        self.source_duration_ms = self.duration_milliseconds
 
     def __del__(self):
+        self.close()
+
+    def close(self, keep_source=False):
+        """
+        Delete the temporary copies of the audio, and close the stream it came from if the library opened it. Slices
+        of a saved stream can't be read afterwards, unless `keep_source` is set; the saved copy is then deleted along
+        with this segment instead.
+        """
+        if self.wave_reader:
+            self.wave_reader.close()
+            self.wave_reader = None
+        if self.stream is not None:
+            self.stream.close()
+        if self.source_dir is not None and not keep_source:
+            shutil.rmtree(self.source_dir, ignore_errors=True)
+            self.source_dir = None
         try:
             os.remove(self.tmp_file)
             try:
@@ -42,6 +248,8 @@ class MyAudioSegment():
         return MyAudioSegment(file_path)
 
     def get_base_name(self):
+        if self.get_file_path() is None:
+            return self.base_name  # a stream which hasn't been read yet
         return os.path.basename(self.get_file_path())
 
     def get_file_path(self):
@@ -51,111 +259,188 @@ class MyAudioSegment():
             return self.tmp_file
 
     def get_duration_seconds(self):
-        return self.duration_se
+        return self.duration_seconds
+
+    def _unread_stream(self):
+        """ The stream this audio comes from, if it hasn't been read yet. """
+        if self.stream is not None and not self.stream.consumed:
+            return self.stream
+        return None
+
+    def _source_copy_path(self):
+        self.source_dir = tempfile.mkdtemp()
+        name, _ = os.path.splitext(self.base_name)
+        return os.path.join(self.source_dir, (name or "stream") + "." + (self.stream.format or "bin"))
+
+    def _save_stream(self):
+        """ Read the whole stream into a temporary file, which takes its place as the source. """
+        self.file_path = self._source_copy_path()
+        with open(self.file_path, "wb") as f:
+            shutil.copyfileobj(self.stream, f)
+        self.stream.consumed = True
+        self.stream.close()
 
     def set_durations(self):
-
-        p = subprocess.Popen(
-            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-             '-of', 'default=noprint_wrappers=1:nokey=1',
-             self.get_file_path()],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-
-        output, errors = p.communicate()
-        print(output)
-        self.duration_seconds = float(output)
-        self.duration_milliseconds = float(output)*1000.0
+        """ Probe the audio for its duration, channel count and sample rate, using as few processes as possible. """
+
+        stream = self._unread_stream()
+        if stream is not None:
+            # Only the start of the stream is available, so the duration isn't known until it has been decoded.
+            info = _probe_in_process(io.BytesIO(stream.head))
+            if info is None:
+                info = _ffprobe(stream.name, data=stream.head, format=stream.format)
+            _, self.channels, self.frame_rate = info
+            self.duration_seconds = None
+            self.duration_milliseconds = None
+            return
+
+        info = _probe_in_process(self.get_file_path())
+        if info is None:
+            info = _ffprobe(self.get_file_path())
+        duration, self.channels, self.frame_rate = info
+        self.duration_seconds = duration
+        self.duration_milliseconds = duration*1000.0
 
     def set_channels(self, channels=None):
         if not channels:
-            command = [
-                'ffprobe',  '-show_entries', 'stream=channels',
-                '-select_streams', 'a', '-of', 'compact=p=0:nk=1', '-v', '0',
-                self.get_file_path()]
-
-            p = subprocess.Popen(
-                command,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-
-            output, errors = p.communicate()
-            print(output)
-            self.channels = int(output)
+            self.set_durations()
         else:
-            # Convert audio to new channel amount
-            tmp_dir = tempfile.mkdtemp()
-            tmp_file = os.path.join(tmp_dir, self.get_base_name())
-
-            try:
-                ffmpeg_cmd = ["ffmpeg",
-                              "-y",  # overwrite output files without asking
-                              "-i", self.get_file_path(),
-                              "-ac", str(channels),  # 1 channel
-                              tmp_file]
-
-                print(ffmpeg_cmd)
-                # Redirect stdout and stderr to DEVNULL to silence output. Do explicitly for Python 2 compatibility.
-                with open(os.devnull, "w") as DEVNULL:
-                    subprocess.call(ffmpeg_cmd, stdout=DEVNULL, stderr=DEVNULL)
-            finally:
-
-                if self.use_tmp:
-                    # Delete old tmp file
-                    os.remove(self.tmp_file)
-                    try:
-                        os.rmdir(self.tmp_dir)
-                    except OSError as e:
-                        if e.errno != errno.ENOENT:
-                            raise e
-
-                self.tmp_file = tmp_file
-                self.tmp_dir = tmp_dir
-                self.use_tmp = True
-                self.channels = channels
+            self.convert(channels=channels)
 
     def set_frame_rate(self, rate=None):
         if not rate:
-            command = [
-                'ffprobe',  '-show_entries', 'stream=sample_rate',
-                '-select_streams', 'a', '-of', 'compact=p=0:nk=1', '-v', '0',
-                self.get_file_path()]
-            p = subprocess.Popen(
-                command,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-            print(command)
-            output, errors = p.communicate()
-            print(output)
-            self.frame_rate = int(output)
+            self.set_durations()
         else:
-            # Convert audio to new frame rate
-            tmp_dir = tempfile.mkdtemp()
-            tmp_file = os.path.join(tmp_dir, self.get_base_name())
+            self.convert(frame_rate=rate)
+
+    def _replace_tmp(self, tmp_file, tmp_dir):
+        """ Swap the current working copy of the audio for a new one, deleting the old one. """
 
+        if self.use_tmp:
+            # Delete old tmp file
+            os.remove(self.tmp_file)
             try:
+                os.rmdir(self.tmp_dir)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise e
+
+        if self.wave_reader:
+            self.wave_reader.close()
+            self.wave_reader = None
+
+        self.tmp_file = tmp_file
+        self.tmp_dir = tmp_dir
+        self.use_tmp = True
+
+    def convert(self, channels=None, frame_rate=None, filters=None, cancel=None):
+        """
+        Transcode the audio into a 16 bit PCM wav file in a single pass, optionally changing the number of channels
+        and the sample rate. If this segment has a `decoder`, the job is sent to it; otherwise ffmpeg is started
+        directly.
+
+        :param channels: number of channels in the output. Defaults to the current number.
+        :param frame_rate: sample rate of the output. Defaults to the current sample rate.
+        :param filters: optional list of ffmpeg audio filters, applied before changing the channels and sample rate.
+        :param cancel: an optional `CancelToken`. If it is cancelled, ffmpeg is killed, and the partial output is
+            deleted along with this segment.
+        :return: `None`
+        :raise Cancelled: if `cancel` was cancelled.
+        :raise FormatError: if ffmpeg couldn't decode the audio.
+        """
+        channels = channels or self.channels
+        frame_rate = frame_rate or self.frame_rate
+
+        base_name, _ = os.path.splitext(self.get_base_name())
+        tmp_dir = tempfile.mkdtemp()
+        tmp_file = os.path.join(tmp_dir, base_name + '.wav')
+
+        # A stream is fed to ffmpeg as it is read, copying it aside on the way if it needs to be kept.
+        stream = self._unread_stream()
+        if stream is not None and self.keep_source:
+            stream.tee = open(self._source_copy_path(), "wb")
+
+        try:
+            if self.decoder is not None and (stream is not None or self.decoder.accepts(self.get_file_path())):
+                self.decoder.decode(stream or self.get_file_path(), tmp_file, channels, frame_rate, filters, cancel)
+            else:
                 ffmpeg_cmd = ["ffmpeg",
-                              "-y",  # overwrite output files without asking
-                              "-i", self.get_file_path(),
-                              "-ar", str(rate),
-                              tmp_file]
-                print(ffmpeg_cmd)
-                # Redirect stdout and stderr to DEVNULL to silence output.
-                # Do explicitly for Python 2 compatibility.
-                with open(os.devnull, "w") as DEVNULL:
-                    subprocess.call(ffmpeg_cmd, stdout=DEVNULL, stderr=DEVNULL)
-            finally:
+                              "-y"]  # overwrite output files without asking
+                if stream is None:
+                    ffmpeg_cmd += ["-i", self.get_file_path()]
+                else:
+                    if stream.format:
+                        ffmpeg_cmd += ["-f", _DEMUXERS.get(stream.format, stream.format)]
+                    ffmpeg_cmd += ["-i", "pipe:0"]
+                if filters:
+                    ffmpeg_cmd += ["-af", ",".join(filters)]
+                ffmpeg_cmd += ["-ac", str(channels),
+                               "-ar", str(frame_rate),
+                               "-acodec", "pcm_s16le",
+                               "-f", "wav",
+                               tmp_file]
 
-                if self.use_tmp:
-                    # Delete old tmp file
-                    os.remove(self.tmp_file)
+                # Redirect stdout and stderr to DEVNULL to silence output. Do explicitly for Python 2 compatibility.
+                with open(os.devnull, "w") as DEVNULL:
+                    p = subprocess.Popen(ffmpeg_cmd, stdin=None if stream is None else subprocess.PIPE,
+                                         stdout=DEVNULL, stderr=DEVNULL)
                     try:
-                        os.rmdir(self.tmp_dir)
-                    except OSError as e:
-                        if e.errno != errno.ENOENT:
-                            raise e
-
-                self.tmp_file = tmp_file
-                self.tmp_dir = tmp_dir
-                self.use_tmp = True
-                self.frame_rate = rate
+                        if stream is not None:
+                            _copy_to_pipe(stream, p.stdin, cancel)
+                        returncode = wait(p, cancel)
+                    finally:
+                        if p.poll() is None:
+                            p.kill()
+                            p.wait()
+                    if cancel is not None:
+                        cancel.check()  # a cancelled stream stops early, which ffmpeg doesn't treat as an error
+                    if returncode != 0:
+                        raise FormatError("ffmpeg couldn't decode `{}`".format(self.get_file_path() or self.base_name))
+        finally:
+            self._replace_tmp(tmp_file, tmp_dir)
+            if stream is not None:
+                stream.consumed = True
+                stream.close()
+                if stream.tee is not None:
+                    stream.tee.close()
+                    self.file_path = stream.tee.name
+                    stream.tee = None
+
+        # The output is a PCM wav file, so this is read in-process rather than with ffprobe.
+        self.set_durations()
+        if self.source_duration_ms is None:
+            self.source_duration_ms = self.duration_milliseconds
+
+    def open_pcm(self, channels, frame_rate, filters=None, cancel=None):
+        """
+        Start decoding an unread stream to 16 bit PCM, to be read from ffmpeg as it is decoded instead of from a
+        temporary wav. Nothing is saved, so the stream can't be sliced afterwards. Once the PCM has been read to the
+        end, `set_decoded_length` should be called with the number of PCM frames there were.
+
+        :param channels: number of channels in the output.
+        :param frame_rate: sample rate of the output.
+        :param filters: optional list of ffmpeg audio filters.
+        :param cancel: an optional `CancelToken`.
+        :return: a `decoder.PcmPipe`.
+        :raise ValueError: if this isn't a stream, or it has already been read.
+        """
+        stream = self._unread_stream()
+        if stream is None:
+            raise ValueError("Only a stream which hasn't been read yet can be decoded as it is read.")
+        if self.decoder is not None:
+            pipe = self.decoder.open_pcm(stream, channels, frame_rate, filters, cancel)
+        else:
+            pipe = open_pcm(stream, channels, frame_rate, filters,
+                            _DEMUXERS.get(stream.format, stream.format) if stream.format else None, cancel)
+        stream.consumed = True
+        return pipe
+
+    def set_decoded_length(self, num_frames, frame_rate):
+        """ Record the length of a stream which was decoded with `open_pcm`, now that it is known. """
+        self.duration_seconds = num_frames / float(frame_rate)
+        self.duration_milliseconds = self.duration_seconds * 1000.0
+        if self.source_duration_ms is None:
+            self.source_duration_ms = self.duration_milliseconds
 
     def set_format(self, format, ext=None):
         # Convert audio to new format
@@ -164,7 +449,7 @@ class MyAudioSegment():
             base_name, _ = os.path.splitext(self.get_base_name())
             base_name = base_name + '.' + ext
         else:
-            base_name = self.self.get_base_name()
+            base_name = self.get_base_name()
 
         tmp_dir = tempfile.mkdtemp()
         tmp_file = os.path.join(tmp_dir, base_name)
@@ -174,24 +459,11 @@ class MyAudioSegment():
                           "-y",  # overwrite output files without asking
                           "-i", self.get_file_path()] + format + [tmp_file]
 
-            print(ffmpeg_cmd)
             # Redirect stdout and stderr to DEVNULL to silence output. Do explicitly for Python 2 compatibility.
             with open(os.devnull, "w") as DEVNULL:
                 subprocess.call(ffmpeg_cmd, stdout=DEVNULL, stderr=DEVNULL)
         finally:
-
-            if self.use_tmp:
-                # Delete old tmp file
-                os.remove(self.tmp_file)
-                try:
-                    os.rmdir(self.tmp_dir)
-                except OSError as e:
-                    if e.errno != errno.ENOENT:
-                        raise e
-
-            self.tmp_file = tmp_file
-            self.tmp_dir = tmp_dir
-            self.use_tmp = True
+            self._replace_tmp(tmp_file, tmp_dir)
 
     def export(self, destination, format='wav'):
         '''
@@ -202,28 +474,44 @@ class MyAudioSegment():
         :result destination of exported file
         '''
 
-        # Ensure desitnation has proper extention
+        # Ensure destination has proper extension
         dest, ext = os.path.splitext(destination)
         ext = ext.lstrip(".")  # Get rid of leading dot
 
-        if fmt is 'wav':
-            if ext is not 'wav':
-                desitnation = dest + '.wav'
+        if format == 'wav' and ext != 'wav':
+            destination = dest + '.wav'
 
         ffmpeg_cmd = [
             "ffmpeg",
             "-y",
-            "-i", self.fpath,
-            "-f", "wav",
+            "-i", self.get_file_path(),
+            "-f", format,
             destination
         ]
 
         with open(os.devnull, "w") as DEVNULL:
             subprocess.call(ffmpeg_cmd, stdout=DEVNULL, stderr=DEVNULL)
 
-        # then this just works?
         return destination
 
+    def __getitem__(self, millisecond):
+        '''
+        Slice the original audio by milliseconds, like pydub does. Nothing is read; the result is an `AudioSlice`
+        handle on the source file.
+        '''
+        if not isinstance(millisecond, slice):
+            raise TypeError("`MyAudioSegment` can only be sliced, e.g. `audio[start_ms:end_ms]`.")
+        if self.file_path is None:
+            raise ValueError("`{}` is a stream which wasn't kept, so it can't be sliced. Open it with "
+                             "`keep_source=True`.".format(self.base_name))
+        start = (millisecond.start or 0) / 1000.0
+        end = (millisecond.stop if millisecond.stop is not None else self.source_duration_ms) / 1000.0
+        audio_slice = AudioSlice(self.file_path, start, end,
+                                 channels=self.source_channels, frame_rate=self.source_frame_rate)
+        if self.source_dir is not None:
+            audio_slice._owner = self  # the saved copy of a stream is deleted along with this segment
+        return audio_slice
+
     def get_wave_reader(self):
         '''Return a wave_reader. This is usefule for webrtcvad. We
         should check that we actually have a wave file before doing this?
@@ -232,3 +520,149 @@ class MyAudioSegment():
         if not self.wave_reader:
             self.wave_reader = wave.open(self.get_file_path(), 'rb')
         return self.wave_reader
+
+
+def _open_pcm_wave(file_path):
+    """
+    Open `file_path` with the `wave` module if it's a 16 bit PCM wav file, so that it can be seeked into directly.
+
+    :return: a `wave` reader, or `None` if the file isn't 16 bit PCM wav.
+    """
+    try:
+        reader = wave.open(file_path, 'rb')
+    except (wave.Error, EOFError, IOError, OSError):
+        return None
+    if reader.getsampwidth() != 2:
+        reader.close()
+        return None
+    return reader
+
+
+class AudioSlice(object):
+    '''
+    A lazy handle on the section of an audio file between `start` and `end` (in seconds). Nothing is decoded until
+    `read`, `as_numpy` or `export` is called. 16 bit PCM wav sources are seeked into directly; anything else is cut
+    out by ffmpeg.
+    '''
+
+    def __init__(self, file_path, start, end, channels, frame_rate, channel=None):
+        self.file_path = file_path
+        self.start = start
+        self.end = end
+        self.channels = channels
+        self.frame_rate = frame_rate
+        self.sample_width = 2
+        self.channel = channel  # if set, only this channel (counting from 0) is read or exported
+
+    def __len__(self):
+        """ Length of the slice in milliseconds, like pydub. """
+        return int(round((self.end - self.start) * 1000))
+
+    def __repr__(self):
+        return "AudioSlice({!r}, start={}, end={})".format(self.file_path, self.start, self.end)
+
+    @property
+    def duration_seconds(self):
+        return self.end - self.start
+
+    @property
+    def output_channels(self):
+        """ Number of channels in what `read` returns. """
+        return 1 if self.channel is not None else self.channels
+
+    def _pcm_chunks(self, reader, chunk_frames=64 * 1024):
+        """ Generate the slice's PCM data from an open `wave` reader, a chunk at a time. """
+        rate = reader.getframerate()
+        first = min(int(round(self.start * rate)), reader.getnframes())
+        remaining = min(int(round(self.end * rate)), reader.getnframes()) - first
+        reader.setpos(first)
+        while remaining > 0:
+            data = reader.readframes(min(chunk_frames, remaining))
+            if not data:
+                break
+            remaining -= len(data) // (reader.getsampwidth() * reader.getnchannels())
+            yield data
+
+    def _ffmpeg_input(self):
+        args = ["-ss", "%.3f" % self.start, "-t", "%.3f" % self.duration_seconds, "-i", self.file_path]
+        if self.channel is not None:
+            args += ["-af", "pan=mono|c0=c{}".format(self.channel)]
+        return args
+
+    def _select_channel(self, data, channels):
+        """ Pick `channel` out of interleaved 16 bit PCM, if it is set. """
+        if self.channel is None or channels == 1:
+            return data
+        return array.array('h', data)[self.channel::channels].tobytes()
+
+    def read(self, channels=None, frame_rate=None):
+        """
+        Read the slice as raw 16 bit little-endian PCM, with channels interleaved.
+
+        :param channels: number of channels to mix to. Defaults to `output_channels`.
+        :param frame_rate: sample rate to resample to. Defaults to the sample rate of the source.
+        :return: `bytes`
+        :raise FormatError: if the source couldn't be decoded.
+        """
+        channels = channels or self.output_channels
+        frame_rate = frame_rate or self.frame_rate
+        converted = (channels, frame_rate) != (self.output_channels, self.frame_rate)
+        reader = None if converted else _open_pcm_wave(self.file_path)
+        if reader is not None:
+            try:
+                return b"".join(self._select_channel(data, reader.getnchannels()) for data in self._pcm_chunks(reader))
+            finally:
+                reader.close()
+
+        ffmpeg_cmd = ["ffmpeg", "-v", "error"] + self._ffmpeg_input() + \
+            ["-ac", str(channels), "-ar", str(frame_rate), "-acodec", "pcm_s16le", "-f", "s16le", "pipe:1"]
+        with open(os.devnull, "w") as DEVNULL:
+            p = subprocess.Popen(ffmpeg_cmd, stdin=DEVNULL, stdout=subprocess.PIPE, stderr=DEVNULL)
+            output, _ = p.communicate()
+        if p.returncode != 0:
+            raise FormatError("ffmpeg couldn't decode `{}`".format(self.file_path))
+        return output
+
+    def as_numpy(self, channels=None, frame_rate=None):
+        """
+        Read the slice into a numpy array. Requires numpy to be installed.
+
+        :param channels: number of channels to mix to. Defaults to `output_channels`.
+        :param frame_rate: sample rate to resample to. Defaults to the sample rate of the source.
+        :return: an `int16` array with shape `(samples, channels)`.
+        :raise ImportError: if numpy isn't installed.
+        """
+        np = _import_numpy("AudioSlice.as_numpy")
+        return np.frombuffer(self.read(channels, frame_rate), dtype="<i2").reshape(-1, channels or self.output_channels)
+
+    def export(self, destination, format='wav'):
+        """
+        Save the slice to a file.
+
+        :param destination: path to save the file to.
+        :param format: format to save in; anything ffmpeg can write.
+        :return: `destination`
+        :raise FormatError: if the source couldn't be decoded.
+        """
+        if format == 'wav':
+            reader = _open_pcm_wave(self.file_path)
+            if reader is not None:
+                try:
+                    writer = wave.open(destination, 'wb')
+                    try:
+                        writer.setnchannels(1 if self.channel is not None else reader.getnchannels())
+                        writer.setsampwidth(2)
+                        writer.setframerate(reader.getframerate())
+                        for data in self._pcm_chunks(reader):
+                            writer.writeframesraw(self._select_channel(data, reader.getnchannels()))
+                    finally:
+                        writer.close()
+                finally:
+                    reader.close()
+                return destination
+
+        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "error"] + self._ffmpeg_input() + ["-f", format, destination]
+        with open(os.devnull, "w") as DEVNULL:
+            if subprocess.call(ffmpeg_cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) != 0:
+                raise FormatError("ffmpeg couldn't decode `{}`".format(self.file_path))
+        return destination
@@ -0,0 +1,353 @@
+'''
+A daemon which watches a spool directory and segments audio files as they arrive.
+
+Files are claimed by renaming them into a directory of their own under a hidden `.claimed` directory inside the spool.
+The rename is atomic, so several daemons can share a spool without processing a file twice. A re-upload is left in the
+spool until the copy of the same name has been finished with. Each claimed file is segmented by a bounded pool of
+worker processes into a temporary directory, which is swapped into place once `segments.json` has been written.
+Files which fail are moved to a dead-letter directory, alongside a `.error` file describing what went wrong.
+
+It can be run from the command line with `python3 -m wahi_korero.daemon SPOOL_DIR OUTPUT_DIR DEAD_LETTER_DIR`.
+'''
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+from os import path
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from .segment import default_segmenter
+from .utils import is_format_supported
+
+CLAIMED_DIR = ".claimed"
+
+# How many times a file is tried when a worker process dies while it is being segmented, before it is dead-lettered.
+# Every file in progress is tried again when any worker dies, as they are all lost with the pool.
+MAX_ATTEMPTS = 3
+
+_log = logging.getLogger(__name__)
+
+
+def _segment_file(segmenter, fpath, output_dir, output_audio):
+    """
+    Segment the file at `fpath` into a new directory under `output_dir`, named after the file. This runs in a worker
+    process.
+
+    :return: the directory the segments were written to.
+    """
+    name = path.basename(fpath)
+    final_dir = path.join(output_dir, name)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-{}-".format(name), dir=output_dir)
+    try:
+        segmenter.segment_audio(fpath, tmp_dir, output_audio=output_audio, verbose=False)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # A re-upload replaces the old segments. They are moved aside before the new ones are put in their place, so
+    # that one copy or the other is always on disk, and only deleted once the swap has been made. A daemon doesn't
+    # segment two files of the same name at once, but another daemon sharing the output directory might, so if
+    # either rename fails the error is raised, and neither the new segments nor the old ones are left behind.
+    old_dir = path.join(output_dir, ".old-{}-{}".format(name, uuid.uuid4().hex))
+    try:
+        os.rename(final_dir, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_dir, final_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if old_dir is not None:
+            try:
+                os.rename(old_dir, final_dir)
+            except OSError:
+                # Someone else's segments are there now, so the old ones aren't needed.
+                shutil.rmtree(old_dir, ignore_errors=True)
+        raise
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return final_dir
+
+
+def _unused_path(directory, entry, suffixes=("",)):
+    """
+    Find a name for `entry` in `directory` which won't overwrite anything there, numbering it before its extension if
+    need be. The name is reserved by creating an empty file for it with each of `suffixes`, so that another daemon
+    sharing the directory can't take it too.
+
+    :return: the path for `entry`, without any of the suffixes.
+    """
+    stem, ext = path.splitext(entry)
+    number = 0
+    while True:
+        name = entry if number == 0 else "{}-{}{}".format(stem, number, ext)
+        created = []
+        try:
+            for suffix in suffixes:
+                fpath = path.join(directory, name + suffix)
+                with open(fpath, "x"):
+                    pass
+                created.append(fpath)
+            return path.join(directory, name)
+        except FileExistsError:
+            for fpath in created:
+                os.remove(fpath)
+            number += 1
+
+
+class SpoolDaemon(object):
+    """
+    Watches `spool_dir` and segments any supported audio files that appear in it, writing the results under
+    `output_dir`.
+
+    :param segmenter: the `Segmenter` to use. It is sent to the worker processes, so it can't have a `decoder` set.
+    :param spool_dir: directory to watch for new files.
+    :param output_dir: each file `name` is segmented into `output_dir/name/`.
+    :param dead_letter_dir: files which can't be segmented are moved here. If there is already a file of the same
+        name, a number is added to the new one's, as in `name-1.wav`.
+    :param done_dir: if set, files are moved here once they have been segmented, and numbered in the same way.
+        Otherwise, they are deleted.
+    :param workers: the maximum number of files to segment at once.
+    :param poll_interval_s: how often to look for new files.
+    :param min_age_s: files modified more recently than this are left alone, in case they are still being written.
+    :param output_audio: whether to save the audio of each segment as well as `segments.json`.
+    """
+
+    def __init__(self, segmenter, spool_dir, output_dir, dead_letter_dir, done_dir=None, workers=2,
+                 poll_interval_s=0.5, min_age_s=1.0, output_audio=False):
+        for d in [spool_dir, output_dir, dead_letter_dir] + ([done_dir] if done_dir else []):
+            if not path.isdir(d):
+                raise FileNotFoundError("Directory `{}` doesn't exist.".format(d))
+        if segmenter.decoder is not None:
+            raise ValueError("A `Segmenter` with a `decoder` can't be shared with worker processes.")
+        if workers < 1:
+            raise ValueError("`workers` must be at least 1, but it is `{}`".format(workers))
+
+        self.segmenter = segmenter
+        self.spool_dir = spool_dir
+        self.output_dir = output_dir
+        self.dead_letter_dir = dead_letter_dir
+        self.done_dir = done_dir
+        self.workers = workers
+        self.poll_interval_s = poll_interval_s
+        self.min_age_s = min_age_s
+        self.output_audio = output_audio
+
+        self._claimed_dir = path.join(spool_dir, CLAIMED_DIR)
+        if not path.isdir(self._claimed_dir):
+            os.mkdir(self._claimed_dir)
+        self._executor = None
+        self._pending = {}  # maps futures to the claimed file they're working on
+        self._attempts = {}  # maps claimed files to the number of times they have been submitted
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _unclaimed(self):
+        """ List the files in the spool which are ready to be claimed, oldest first. """
+        now = time.time()
+        candidates = []
+        for entry in os.listdir(self.spool_dir):
+            fpath = path.join(self.spool_dir, entry)
+            if entry.startswith(".") or not is_format_supported(path.splitext(entry)[1]):
+                continue
+            try:
+                mtime = os.stat(fpath).st_mtime
+            except OSError:
+                continue  # claimed by someone else in the meantime
+            if path.isfile(fpath) and now - mtime >= self.min_age_s:
+                candidates.append((mtime, entry))
+        return [entry for _, entry in sorted(candidates)]
+
+    def _claim(self, entry):
+        """
+        Atomically move `entry` out of the spool, into a new directory of its own under `.claimed`, so that it keeps
+        its name. Returns its new location, or `None` if we lost the race.
+        """
+        claim_dir = tempfile.mkdtemp(dir=self._claimed_dir)
+        claimed = path.join(claim_dir, entry)
+        try:
+            os.rename(path.join(self.spool_dir, entry), claimed)
+        except OSError:
+            os.rmdir(claim_dir)
+            return None
+        return claimed
+
+    def _submit(self, claimed):
+        """
+        Start segmenting a claimed file. If a worker process has died, the pool can't take any more jobs, so a new one
+        is started in its place.
+        """
+        try:
+            future = self._executor.submit(_segment_file, self.segmenter, claimed, self.output_dir, self.output_audio)
+        except BrokenProcessPool:
+            _log.warning("A worker process died, so the pool is being restarted.")
+            self._executor.shutdown(wait=False)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            future = self._executor.submit(_segment_file, self.segmenter, claimed, self.output_dir, self.output_audio)
+        self._pending[future] = claimed
+        self._attempts[claimed] = self._attempts.get(claimed, 0) + 1
+
+    def _finish(self, future, claimed):
+        """
+        Move a claimed file out of the way once its worker has finished with it. A file already in `done_dir` or
+        `dead_letter_dir` with the same name is kept, and this one is numbered instead.
+        """
+        entry = path.basename(claimed)
+        error = future.exception()
+        if error is None:
+            if self.done_dir:
+                shutil.move(claimed, _unused_path(self.done_dir, entry))
+            else:
+                os.remove(claimed)
+        else:
+            dead_fpath = _unused_path(self.dead_letter_dir, entry, suffixes=("", ".error"))
+            shutil.move(claimed, dead_fpath)
+            with open(dead_fpath + ".error", "w") as f:
+                f.write("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+        os.rmdir(path.dirname(claimed))
+
+    def recover(self):
+        """
+        Put any files left claimed by a daemon which was killed back into the spool. Only call this when no other
+        daemon is using the spool.
+        """
+        for entry in os.listdir(self._claimed_dir):
+            claimed = path.join(self._claimed_dir, entry)
+            if not path.isdir(claimed):
+                self._requeue(claimed)
+                continue
+            for name in os.listdir(claimed):
+                self._requeue(path.join(claimed, name))
+            os.rmdir(claimed)
+
+    def _requeue(self, claimed):
+        """
+        Move a claimed file back into the spool. If a newer upload of the same name has arrived in the meantime, it is
+        left alone, and the old file is numbered instead, as in `name-1.wav`.
+        """
+        entry = path.basename(claimed)
+        target = path.join(self.spool_dir, entry)
+        if path.exists(target):
+            target = _unused_path(self.spool_dir, entry)
+            _log.warning("`%s` is already in the spool, so the recovered copy is requeued as `%s`.", entry,
+                         path.basename(target))
+        os.rename(claimed, target)
+
+    def _collect(self, timeout):
+        """
+        Wait up to `timeout` seconds for a running job to finish, then clear away every job which has. Files whose
+        worker process died are submitted again, but no new files are claimed.
+        """
+        if not self._pending:
+            return
+        done, _ = wait(list(self._pending), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            claimed = self._pending.pop(future)
+            if isinstance(future.exception(), BrokenProcessPool) and self._attempts[claimed] < MAX_ATTEMPTS:
+                self._submit(claimed)
+                continue
+            del self._attempts[claimed]
+            try:
+                self._finish(future, claimed)
+            except Exception:
+                _log.exception("Couldn't clear away `%s` once it had been processed.", claimed)
+
+    def poll(self, timeout=0):
+        """
+        Collect finished jobs, then claim and start as many new files as there are free workers. If a worker process
+        has died, the files that were in progress are tried again in a new pool, up to `MAX_ATTEMPTS` times each.
+
+        :param timeout: how long to wait for a running job to finish before looking for new files.
+        :return: the number of jobs still running.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self._collect(timeout)
+
+        # A file with the same name as one in progress waits until that one is done, so that the two don't race to
+        # swap their segments into the same place.
+        in_progress = set(path.basename(claimed) for claimed in self._pending.values())
+        free = self.workers - len(self._pending)
+        for entry in self._unclaimed():
+            if free <= 0:
+                break
+            if entry in in_progress:
+                continue
+            claimed = self._claim(entry)
+            if claimed is None:
+                continue
+            self._submit(claimed)
+            in_progress.add(entry)
+            free -= 1
+
+        return len(self._pending)
+
+    def run(self):
+        """ Process files as they arrive, until `stop` is called. """
+        while not self._stopped.is_set():
+            if self._pending:
+                self.poll(timeout=self.poll_interval_s)
+            else:
+                self.poll()
+                self._stopped.wait(self.poll_interval_s)
+        self.close()
+
+    def drain(self):
+        """ Process everything in the spool, returning once it's empty and all jobs have finished. """
+        while self.poll(timeout=self.poll_interval_s) or self._unclaimed():
+            pass
+
+    def stop(self):
+        """ Ask `run` to return. Jobs already running are allowed to finish. """
+        self._stopped.set()
+
+    def close(self):
+        """
+        Wait for running jobs to finish and shut down the worker processes. Files which arrive in the spool in the
+        meantime are left there for the next run.
+        """
+        while self._pending:
+            self._collect(timeout=None)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment audio files as they arrive in a spool directory.")
+    parser.add_argument("spool_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("dead_letter_dir")
+    parser.add_argument("--done-dir", default=None, help="move files here once segmented, rather than deleting them")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between checks for new files")
+    parser.add_argument("--output-audio", action="store_true", help="save the audio of each segment")
+    args = parser.parse_args()
+
+    daemon = SpoolDaemon(default_segmenter(), args.spool_dir, args.output_dir, args.dead_letter_dir,
+                         done_dir=args.done_dir, workers=args.workers, poll_interval_s=args.poll_interval,
+                         output_audio=args.output_audio)
+    daemon.recover()
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
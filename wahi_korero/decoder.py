@@ -0,0 +1,340 @@
+'''
+Every call out to ffmpeg pays for starting a new process. On machines where that is slow, and on short clips, the
+start-up cost can be larger than the decode itself. A `DecoderPool` keeps a few ffmpeg processes started ahead of time
+which are already waiting for input on stdin; a decode job takes one of the waiting processes, feeds it the file and
+reads raw PCM back, while a replacement is started in the background.
+
+'''
+import os
+import subprocess
+import threading
+import wave
+from .exceptions import FormatError
+
+# These containers usually need a seekable input, so they can't be fed to ffmpeg through a pipe.
+PIPE_UNFRIENDLY_FORMATS = ["m4a", "mp4"]
+
+# How many bytes to move between the pipes at once.
+CHUNK_SIZE = 64 * 1024
+
+
+def _ffmpeg_command(channels, frame_rate, filters=None, input_format=None):
+    """
+    Build an ffmpeg command which reads audio from stdin and writes signed 16 bit little-endian PCM to stdout.
+
+    :param channels: number of channels in the output.
+    :param frame_rate: sample rate of the output.
+    :param filters: optional list of ffmpeg audio filters to apply before converting to the output format.
+    :param input_format: the demuxer for the input, if it shouldn't be left to ffmpeg to guess.
+    :return: a list of arguments.
+    """
+    cmd = ["ffmpeg", "-v", "error"]
+    if input_format:
+        cmd += ["-f", input_format]
+    cmd += ["-i", "pipe:0", "-vn"]
+    if filters:
+        cmd += ["-af", ",".join(filters)]
+    cmd += ["-ac", str(channels), "-ar", str(frame_rate), "-acodec", "pcm_s16le", "-f", "s16le", "pipe:1"]
+    return cmd
+
+
+def _copy_to_pipe(src, pipe, cancel=None):
+    """
+    Copy everything from the file object `src` into `pipe`, a chunk at a time, then close it. Errors reading `src` are
+    raised once the pipe has been closed. If the `CancelToken` `cancel` is cancelled, copying stops early.
+    """
+    try:
+        while cancel is None or not cancel.cancelled:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            try:
+                pipe.write(chunk)
+            except (IOError, OSError):
+                break  # the decoder has gone away; its exit status will tell us why
+    finally:
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
+
+
+def _feed(src, pipe, errors, cancel=None):
+    """ Run `_copy_to_pipe` on a thread, keeping any error so that it can be raised on the caller's thread. """
+    try:
+        _copy_to_pipe(src, pipe, cancel)
+    except Exception as e:
+        errors.append(e)
+
+
+class PcmPipe(object):
+    """
+    The raw PCM of a source, read from ffmpeg's stdout as it is decoded, while a thread feeds ffmpeg the source. Nothing
+    is written to disk, and the start of the audio can be used before the end of the source has arrived.
+
+    Read it to the end with `read`, then call `finish` to find out whether decoding succeeded. `close` stops ffmpeg,
+    if it is still running, and can be called at any time.
+
+    :param proc: an ffmpeg process started with `_ffmpeg_command`.
+    :param src: a file-like object to feed to it. It isn't closed.
+    :param cancel: an optional `CancelToken`. If it is cancelled, feeding stops and ffmpeg is killed.
+    """
+
+    def __init__(self, proc, src, cancel=None):
+        self.bytes_read = 0
+        self._proc = proc
+        self._cancel = cancel
+        self._name = getattr(src, "name", "stream")
+        self._errors = []
+        self._feeder = threading.Thread(target=_feed, args=(src, proc.stdin, self._errors, cancel))
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size):
+        """ Read `size` bytes of PCM, or fewer once the end has been reached. """
+        if self._cancel is not None and self._cancel.cancelled:
+            self._proc.kill()
+            return b""
+        data = self._proc.stdout.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def finish(self):
+        """
+        Wait for ffmpeg to exit, once its output has been read to the end.
+
+        :raise Cancelled: if `cancel` was cancelled.
+        :raise FormatError: if ffmpeg couldn't decode the audio.
+        """
+        self._feeder.join()
+        returncode = self._proc.wait()
+        self.close()
+        if self._cancel is not None:
+            self._cancel.check()
+        if self._errors:
+            raise self._errors[0]
+        if returncode != 0:
+            raise FormatError("ffmpeg couldn't decode `{}`".format(self._name))
+
+    def close(self):
+        """ Kill ffmpeg if it is still running, and wait for it. """
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdout.close()
+        self._proc.wait()
+
+
+def open_pcm(src, channels, frame_rate, filters=None, input_format=None, cancel=None):
+    """
+    Start a fresh ffmpeg process decoding `src`, whose output is read as it is produced.
+
+    :param src: a file-like object holding the audio.
+    :param channels: number of channels in the output.
+    :param frame_rate: sample rate of the output.
+    :param filters: optional list of ffmpeg audio filters.
+    :param input_format: the demuxer for `src`, if ffmpeg shouldn't guess it.
+    :param cancel: an optional `CancelToken`.
+    :return: a `PcmPipe`.
+    """
+    with open(os.devnull, "wb") as DEVNULL:
+        proc = subprocess.Popen(_ffmpeg_command(channels, frame_rate, filters, input_format),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=DEVNULL)
+    return PcmPipe(proc, src, cancel)
+
+
+class _Unclosed(object):
+    """ Lets a file object that belongs to someone else be used in a `with` statement without closing it. """
+
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self, *args):
+        pass
+
+
+class DecoderPool(object):
+    """
+    A pool of warm ffmpeg processes used to transcode audio into PCM wav files.
+
+    Processes are started per output configuration (channels, sample rate and filters), the first time a
+    configuration is used. After that, up to `size` processes for each configuration are kept waiting.
+    """
+
+    def __init__(self, size=2):
+        if type(size) is not int:
+            raise TypeError("`size` must be an `int`, but it's a `{}`".format(type(size)))
+        if size < 1:
+            raise ValueError("`size` must be at least 1, but it is `{}`".format(size))
+        self.size = size
+        self._warm = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def accepts(self, fpath):
+        """
+        Check whether the file at `fpath` can be decoded by this pool.
+
+        :param fpath: location of the audio.
+        :return: bool
+        """
+        ext = os.path.splitext(fpath)[1].lstrip(".").lower()
+        return ext not in PIPE_UNFRIENDLY_FORMATS
+
+    def _spawn(self, key):
+        channels, frame_rate, filters = key
+        with open(os.devnull, "wb") as DEVNULL:
+            return subprocess.Popen(_ffmpeg_command(channels, frame_rate, filters),
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=DEVNULL)
+
+    def _refill(self, key):
+        with self._lock:
+            if self._closed:
+                return
+            waiting = self._warm.setdefault(key, [])
+            missing = self.size - len(waiting)
+        for _ in range(missing):
+            proc = self._spawn(key)
+            with self._lock:
+                if self._closed or len(self._warm[key]) >= self.size:
+                    proc.kill()
+                    proc.wait()
+                else:
+                    self._warm[key].append(proc)
+
+    def _take(self, key):
+        with self._lock:
+            waiting = self._warm.get(key, [])
+            while waiting:
+                proc = waiting.pop()
+                if proc.poll() is None:
+                    break
+                proc.wait()
+            else:
+                proc = None
+        if proc is None:
+            proc = self._spawn(key)
+
+        # Start the replacement off the caller's thread, so it never waits on process start-up.
+        refill = threading.Thread(target=self._refill, args=(key,))
+        refill.daemon = True
+        refill.start()
+        return proc
+
+    def warm(self, channels, frame_rate, filters=None):
+        """
+        Start processes for a configuration now, rather than on its first decode.
+
+        :param channels: number of channels in the output.
+        :param frame_rate: sample rate of the output.
+        :param filters: optional list of ffmpeg audio filters.
+        :return: `None`
+        """
+        self._refill((channels, frame_rate, tuple(filters or ())))
+
+    def open_pcm(self, src, channels, frame_rate, filters=None, cancel=None):
+        """
+        Decode `src` with one of the waiting processes, reading its output as it is produced rather than writing it
+        to a file.
+
+        :param src: a file-like object holding the audio.
+        :param channels: number of channels in the output.
+        :param frame_rate: sample rate of the output.
+        :param filters: optional list of ffmpeg audio filters.
+        :param cancel: an optional `CancelToken`.
+        :return: a `PcmPipe`.
+        """
+        if self._closed:
+            raise ValueError("Trying to decode with a `DecoderPool` that has been closed.")
+        return PcmPipe(self._take((channels, frame_rate, tuple(filters or ()))), src, cancel)
+
+    def decode(self, src_fpath, dst_fpath, channels, frame_rate, filters=None, cancel=None):
+        """
+        Decode the audio at `src_fpath` into a 16 bit PCM wav file at `dst_fpath`.
+
+        :param src_fpath: location of the audio to decode, or a file-like object to read it from.
+        :param dst_fpath: where to write the wav file.
+        :param channels: number of channels in the output.
+        :param frame_rate: sample rate of the output.
+        :param filters: optional list of ffmpeg audio filters to apply before converting to the output format.
+        :param cancel: an optional `CancelToken`. If it is cancelled, the ffmpeg process is killed.
+        :return: the number of PCM frames written.
+        :raise Cancelled: if `cancel` was cancelled.
+        :raise FormatError: if ffmpeg couldn't decode the audio.
+        """
+        if self._closed:
+            raise ValueError("Trying to decode with a `DecoderPool` that has been closed.")
+
+        proc = self._take((channels, frame_rate, tuple(filters or ())))
+        is_path = not hasattr(src_fpath, "read")
+        errors = []
+        try:
+            # The destination is opened before `wave` sees it, since a `Wave_write` that fails to open its own file
+            # complains again from `__del__`.
+            with (open(src_fpath, "rb") if is_path else _Unclosed(src_fpath)) as src, open(dst_fpath, "wb") as dst:
+                feeder = threading.Thread(target=_feed, args=(src, proc.stdin, errors, cancel))
+                feeder.daemon = True
+                feeder.start()
+
+                writer = wave.open(dst, "wb")
+                try:
+                    writer.setnchannels(channels)
+                    writer.setsampwidth(2)
+                    writer.setframerate(frame_rate)
+                    while True:
+                        if cancel is not None and cancel.cancelled:
+                            proc.kill()
+                            break
+                        chunk = proc.stdout.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        writer.writeframesraw(chunk)
+                finally:
+                    writer.close()  # patches the header with the real length
+                feeder.join()
+        except BaseException:
+            proc.kill()  # so that ffmpeg isn't left running, and the feeder's writes to it fail
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if cancel is not None:
+            cancel.check()
+        if errors:
+            raise errors[0]
+        if returncode != 0:
+            raise FormatError("ffmpeg couldn't decode `{}`".format(src_fpath if is_path else
+                                                                   getattr(src_fpath, "name", "stream")))
+
+        with wave.open(dst_fpath, "rb") as reader:
+            return reader.getnframes()
+
+    def close(self):
+        """ Stop all waiting processes. The pool can't be used after it has been closed. """
+        with self._lock:
+            self._closed = True
+            procs = [proc for waiting in self._warm.values() for proc in waiting]
+            self._warm = {}
+        for proc in procs:
+            proc.kill()
+            proc.wait()
@@ -8,3 +8,7 @@ class FormatError(Exception):
     """ Used to signify an error in processing audio data. """
     pass
 
+
+class Cancelled(Exception):
+    """ Used to signify that a job was stopped with its `CancelToken`. """
+    pass
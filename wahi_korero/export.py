@@ -0,0 +1,189 @@
+'''
+Writes the audio of many segments in a compressed format with a single ffmpeg process, rather than one process and
+one burst of writes per segment, and can pack the results into a single archive.
+
+The PCM of each segment is fed, one after another, into ffmpeg's `segment` muxer, which starts a new file at each
+segment boundary. It can only split the encoded stream between packets, so every segment is padded with silence up to
+a whole number of encoder frames. A segment's file may therefore run up to one frame (20ms) past the end recorded in
+`segments.json`.
+'''
+from fractions import Fraction
+import math
+import os
+from os import path
+import struct
+import subprocess
+import tarfile
+import zipfile
+from .exceptions import FormatError
+
+# The compressed formats segments can be saved in.
+EXPORT_FORMATS = ["flac", "opus"]
+
+# The kinds of archive segments can be packed into.
+ARCHIVE_FORMATS = ["tar", "zip"]
+
+# Length of an encoder frame. Segments are padded to a whole number of these.
+FRAME_S = Fraction(1, 50)
+
+# Opus decoders drop this much from the start of every file, to skip the encoder's start-up delay. Only the first
+# file really has that delay, so silence is put in front of each segment for the decoder to drop instead.
+OPUS_PRE_SKIP_S = Fraction(312, 48000)
+
+# The most segments given to one encoder process, so that its list of split points fits on a command line.
+MAX_SEGMENTS_PER_PROCESS = 2000
+
+
+def _frame_samples(format, frame_rate):
+    """ The smallest number of samples at `frame_rate` which makes up a whole number of encoder frames. """
+    samples = FRAME_S * frame_rate
+    if format == "opus":
+        samples = samples * samples.denominator  # Opus frames are fixed in time, so round up to a whole sample
+    return max(16, int(math.ceil(samples)))
+
+
+def _encoder_args(format, frame_samples):
+    if format == "flac":
+        return ["-c:a", "flac", "-frame_size", str(frame_samples), "-segment_format", "flac"]
+    return ["-c:a", "libopus", "-ar", "48000", "-frame_duration", "20", "-segment_format", "opus"]
+
+
+def _patch_flac_header(fpath, num_samples):
+    """
+    Set the length in a FLAC file's STREAMINFO block. The segment muxer leaves it empty in every file but the last,
+    which gets the details of the whole encoded stream instead, so this replaces them all. The frame sizes and MD5
+    are marked as unknown, which the format allows.
+    """
+    with open(fpath, "r+b") as f:
+        header = f.read(42)
+        if header[:4] != b"fLaC":
+            return
+        info = bytearray(header[8:42])
+        info[4:10] = b"\0" * 6  # minimum and maximum frame sizes
+        packed = struct.unpack(">Q", bytes(info[10:18]))[0]
+        packed = (packed & ~((1 << 36) - 1)) | num_samples
+        info[10:18] = struct.pack(">Q", packed)
+        info[18:34] = b"\0" * 16  # MD5 of the audio
+        f.seek(8)
+        f.write(bytes(info))
+
+
+def encode_segments(slices, output_dir, format, first_index=0, verbose=False, cancel=None):
+    """
+    Save the audio of some segments as `seg-%05d.<format>` files in `output_dir`, numbered from `first_index`.
+
+    :param slices: an iterable of `AudioSlice`s. They must all have the same sample rate and number of output
+        channels.
+    :param output_dir: directory to save the files to.
+    :param format: one of `EXPORT_FORMATS`.
+    :param first_index: the number of the first file.
+    :param verbose: if set, print the name of each file.
+    :param cancel: an optional `CancelToken`, checked between segments. If it is cancelled, the encoder is killed.
+    :return: the names of the files written, in order.
+    :raise Cancelled: if `cancel` was cancelled.
+    :raise FormatError: if the audio couldn't be read or encoded.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError("`format` must be one of {}, but it is `{}`".format(EXPORT_FORMATS, format))
+
+    fnames = []
+    batch = []
+    for audio_slice in slices:
+        batch.append(audio_slice)
+        if len(batch) == MAX_SEGMENTS_PER_PROCESS:
+            fnames += _encode_batch(batch, output_dir, format, first_index + len(fnames), verbose, cancel)
+            batch = []
+    if batch:
+        fnames += _encode_batch(batch, output_dir, format, first_index + len(fnames), verbose, cancel)
+    return fnames
+
+
+def _encode_batch(slices, output_dir, format, first_index, verbose, cancel):
+    frame_rate = slices[0].frame_rate
+    channels = slices[0].output_channels
+    frame_samples = _frame_samples(format, frame_rate)
+    lead_samples = int(math.ceil(OPUS_PRE_SKIP_S * frame_rate)) if format == "opus" else 0
+    sample_bytes = 2 * channels
+
+    # Work out where each padded segment ends, so that ffmpeg can be told where to split before it's given any audio.
+    lengths = []
+    padded_lengths = []
+    split_times = []
+    position = 0
+    for audio_slice in slices:
+        length = max(0, int(round(audio_slice.end * frame_rate)) - int(round(audio_slice.start * frame_rate)))
+        padded = max(1, int(math.ceil((lead_samples + length) / float(frame_samples)))) * frame_samples
+        lengths.append(length)
+        padded_lengths.append(padded)
+        position += padded
+        # Split half a frame early, so that rounding can't push the split into the next packet.
+        split_times.append("%.6f" % ((position - frame_samples / 2.0) / frame_rate))
+
+    pattern = path.join(output_dir, "seg-%05d." + format)
+    ffmpeg_cmd = ["ffmpeg", "-y", "-v", "error",
+                  "-f", "s16le", "-ar", str(frame_rate), "-ac", str(channels), "-i", "pipe:0"]
+    ffmpeg_cmd += _encoder_args(format, frame_samples)
+    ffmpeg_cmd += ["-f", "segment", "-reset_timestamps", "1", "-segment_start_number", str(first_index)]
+    if len(slices) > 1:
+        ffmpeg_cmd += ["-segment_times", ",".join(split_times[:-1])]
+    ffmpeg_cmd.append(pattern)
+
+    with open(os.devnull, "w") as DEVNULL:
+        p = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL)
+        try:
+            for audio_slice, length, padded in zip(slices, lengths, padded_lengths):
+                if cancel is not None and cancel.cancelled:
+                    p.kill()
+                    break
+                pcm = audio_slice.read()[:length * sample_bytes]
+                p.stdin.write(b"\0" * (lead_samples * sample_bytes))
+                p.stdin.write(pcm)
+                p.stdin.write(b"\0" * ((padded - lead_samples) * sample_bytes - len(pcm)))
+            p.stdin.close()
+        except (IOError, OSError):
+            pass  # the encoder has gone away; its exit status will tell us why
+        finally:
+            returncode = p.wait()
+    if cancel is not None:
+        cancel.check()
+    if returncode != 0:
+        raise FormatError("ffmpeg couldn't encode the segments as {}".format(format))
+
+    fnames = []
+    for i, padded in enumerate(padded_lengths):
+        fname = path.basename(pattern % (first_index + i))
+        if format == "flac":
+            _patch_flac_header(path.join(output_dir, fname), padded)
+        if verbose:
+            print("Writing {}".format(path.join(output_dir, fname)))
+        fnames.append(fname)
+    return fnames
+
+
+def write_archive(output_dir, fnames, archive):
+    """
+    Move files from `output_dir` into a single archive there, named `segments.tar` or `segments.zip`. Each file is
+    deleted once it has been added, so the disk space needed stays close to the size of the archive.
+
+    :param output_dir: the directory holding the files.
+    :param fnames: names of the files to archive, relative to `output_dir`.
+    :param archive: one of `ARCHIVE_FORMATS`.
+    :return: the location of the archive.
+    """
+    if archive not in ARCHIVE_FORMATS:
+        raise ValueError("`archive` must be one of {}, but it is `{}`".format(ARCHIVE_FORMATS, archive))
+
+    archive_fpath = path.join(output_dir, "segments." + archive)
+    if archive == "tar":
+        with tarfile.open(archive_fpath, "w") as tar:
+            for fname in fnames:
+                tar.add(path.join(output_dir, fname), arcname=fname)
+                os.remove(path.join(output_dir, fname))
+    else:
+        with zipfile.ZipFile(archive_fpath, "w") as zf:
+            for fname in fnames:
+                # Compressed audio doesn't shrink any further, so only the JSON is deflated.
+                compression = zipfile.ZIP_DEFLATED if fname.endswith(".json") else zipfile.ZIP_STORED
+                zf.write(path.join(output_dir, fname), arcname=fname, compress_type=compression)
+                os.remove(path.join(output_dir, fname))
+    return archive_fpath
@@ -0,0 +1,320 @@
+'''
+A compact binary sidecar, written next to `segments.json`, which lets a track be re-segmented or drawn as a waveform
+without decoding its audio again.
+
+It holds the per-frame decisions of the voice-activity detector and an envelope of the audio (the minimum, maximum
+and RMS of each block of samples) at several resolutions. Both are taken from the audio as the segmenter saw it,
+i.e. mixed down to mono and resampled. Everything is stored at fixed offsets in little-endian order, so the file can
+be memory-mapped and read without parsing. The layout is:
+
+    header        magic "WKIX", version, frame duration (ms), aggression, sample rate, number of VAD frames,
+                  number of samples, number of levels, offset of the VAD flags
+    level table   for each level: samples per block, number of blocks, offset of its data
+    VAD flags     one byte per frame, 1 for speech and 0 otherwise
+    levels        for each level: the block minimums (int16), then maximums (int16), then RMS values (float32)
+'''
+import array
+import math
+import mmap
+import operator
+import struct
+import sys
+from .exceptions import FormatError
+
+INDEX_FNAME = "segments.wkix"
+
+# Samples per block at each resolution, finest first. Each is a multiple of the one before.
+INDEX_LEVELS = (256, 1024, 4096, 16384, 65536)
+
+_MAGIC = b"WKIX"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHHBxxxIQQIQ")
+_LEVEL = struct.Struct("<IQQ")
+
+
+def _section_size(num_blocks):
+    return num_blocks * (2 + 2 + 4)
+
+
+def _numpy():
+    """ numpy if it's installed, which works out the envelope many blocks at a time; otherwise `None`. """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class _Level(object):
+    """ Accumulates the envelope of one resolution, writing out blocks as they are finished. """
+
+    def __init__(self, block_samples, num_blocks, offset):
+        self.block_samples = block_samples
+        self.num_blocks = num_blocks
+        self.offset = offset
+        self.written = 0
+        self.mins = array.array("h")
+        self.maxs = array.array("h")
+        self.rms = array.array("f")
+        self._reset()
+
+    def _reset(self):
+        self.min = 32767
+        self.max = -32768
+        self.sum_squares = 0.0
+        self.count = 0
+
+    def add(self, lo, hi, sum_squares, count):
+        """ Add the statistics of a run of samples. Returns `True` when this completes a block. """
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+        self.sum_squares += sum_squares
+        self.count += count
+        if self.count >= self.block_samples:
+            self.emit()
+            return True
+        return False
+
+    def emit(self):
+        if self.count:
+            self.mins.append(self.min)
+            self.maxs.append(self.max)
+            self.rms.append(math.sqrt(self.sum_squares / self.count))
+        self._reset()
+
+    def flush(self, f):
+        """ Write out finished blocks and forget them, so memory use stays bounded. """
+        n = len(self.mins)
+        if not n:
+            return
+        for i, values in enumerate([self.mins, self.maxs, self.rms]):
+            if sys.byteorder != "little":
+                values.byteswap()
+            item_offset = [0, 2 * self.num_blocks, 4 * self.num_blocks][i]
+            f.seek(self.offset + item_offset + self.written * values.itemsize)
+            f.write(values.tobytes())
+        self.written += n
+        self.mins = array.array("h")
+        self.maxs = array.array("h")
+        self.rms = array.array("f")
+
+
+class IndexWriter(object):
+    """
+    Writes an index file a piece at a time. The total number of frames and samples must be known up front, so that
+    every section can be given its place in the file.
+
+    :param fpath: where to write the index.
+    :param sample_rate: sample rate of the audio given to `add_samples`.
+    :param frame_duration_ms: length of the frames that the VAD flags describe.
+    :param aggression: the webrtcvad aggression used to make the flags.
+    :param num_frames: how many VAD flags there will be.
+    :param num_samples: how many samples there will be.
+    """
+
+    def __init__(self, fpath, sample_rate, frame_duration_ms, aggression, num_frames, num_samples,
+                 levels=INDEX_LEVELS):
+        self.num_frames = num_frames
+        self._flags_written = 0
+        self._carry = array.array("h")
+        self._np = _numpy()
+
+        offset = _HEADER.size + _LEVEL.size * len(levels)
+        flags_offset = offset
+        offset += num_frames
+        self._levels = []
+        for block_samples in levels:
+            num_blocks = int(math.ceil(num_samples / float(block_samples)))
+            offset += (-offset) % 4  # keep the RMS values aligned for memory-mapped access
+            self._levels.append(_Level(block_samples, num_blocks, offset))
+            offset += _section_size(num_blocks)
+
+        self._file = open(fpath, "w+b")
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, frame_duration_ms, aggression, sample_rate, num_frames,
+                                      num_samples, len(levels), flags_offset))
+        for level in self._levels:
+            self._file.write(_LEVEL.pack(level.block_samples, level.num_blocks, level.offset))
+        self._file.truncate(offset)
+        self._flags_offset = flags_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_flags(self, flags):
+        """ Append VAD decisions, given as a `bytes`-like object with one byte (0 or 1) per frame. """
+        self._file.seek(self._flags_offset + self._flags_written)
+        self._file.write(flags)
+        self._flags_written += len(flags)
+
+    def add_samples(self, samples):
+        """ Append audio, given as an `array` of 16 bit samples. """
+        samples = self._carry + samples if self._carry else samples
+        finest = self._levels[0].block_samples
+        whole = len(samples) - len(samples) % finest
+        if self._np is not None and whole:
+            np = self._np
+            blocks = np.frombuffer(samples, dtype=np.int16, count=whole).reshape(-1, finest)
+            wide = blocks.astype(np.int64)
+            for lo, hi, sum_squares in zip(blocks.min(axis=1).tolist(), blocks.max(axis=1).tolist(),
+                                           (wide * wide).sum(axis=1).tolist()):
+                self._add_stats(lo, hi, float(sum_squares), finest)
+        else:
+            for start in range(0, whole, finest):
+                self._add_block(samples[start:start + finest])
+        self._carry = samples[whole:]
+        for level in self._levels:
+            if len(level.mins) >= 4096:
+                level.flush(self._file)
+
+    def _add_block(self, block):
+        self._add_stats(min(block), max(block), float(sum(map(operator.mul, block, block))), len(block))
+
+    def _add_stats(self, lo, hi, sum_squares, count):
+        # Each completed block feeds into the next resolution down.
+        for level in self._levels:
+            if not level.add(lo, hi, sum_squares, count):
+                break
+            lo, hi, count = level.mins[-1], level.maxs[-1], level.block_samples
+            sum_squares = level.rms[-1] ** 2 * count
+
+    def close(self):
+        """ Finish any partial blocks and close the file. """
+        if self._file is None:
+            return
+        if self._carry:
+            self._add_block(self._carry)
+            self._carry = array.array("h")
+        for i, level in enumerate(self._levels):
+            if level.count:
+                # Pass the partial block on to the next level, which passes its own on in turn, then emit it.
+                if i + 1 < len(self._levels):
+                    self._levels[i + 1].add(level.min, level.max, level.sum_squares, level.count)
+                level.emit()
+            level.flush(self._file)
+        self._file.close()
+        self._file = None
+
+
+class SegmentIndex(object):
+    """
+    A memory-mapped index file. `flags` and the arrays from `envelope` are views onto the file, so nothing is read
+    until it's used.
+
+    :param fpath: location of the index.
+    :raise FormatError: if the file isn't an index.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._file = open(fpath, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise FormatError("`{}` isn't a segment index.".format(fpath))
+        self._view = memoryview(self._map)
+        self.flags = None
+
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise FormatError("`{}` isn't a segment index.".format(fpath))
+        (magic, version, self.frame_duration_ms, self.aggression, self.sample_rate, self.num_frames,
+         self.num_samples, num_levels, flags_offset) = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise FormatError("`{}` isn't a segment index.".format(fpath))
+
+        self.levels = [_LEVEL.unpack_from(self._map, _HEADER.size + i * _LEVEL.size) for i in range(num_levels)]
+        self.flags = self._view[flags_offset:flags_offset + self.num_frames]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def duration_seconds(self):
+        return self.num_samples / float(self.sample_rate)
+
+    def level_for(self, samples_per_pixel):
+        """
+        Choose the coarsest level that still has at least one block per pixel, for drawing a waveform.
+
+        :param samples_per_pixel: how many samples each pixel of the waveform covers.
+        :return: an index into `levels`.
+        """
+        best = 0
+        for i, (block_samples, _, _) in enumerate(self.levels):
+            if block_samples <= samples_per_pixel:
+                best = i
+        return best
+
+    def envelope(self, level):
+        """
+        Get the envelope at one resolution.
+
+        :param level: an index into `levels`.
+        :return: a tuple `(mins, maxs, rms)` of sequences with one value per block.
+        """
+        block_samples, num_blocks, offset = self.levels[level]
+        sections = [(offset, 2 * num_blocks, "h"), (offset + 2 * num_blocks, 2 * num_blocks, "h"),
+                    (offset + 4 * num_blocks, 4 * num_blocks, "f")]
+        result = []
+        for start, size, typecode in sections:
+            data = self._view[start:start + size]
+            if sys.byteorder == "little":
+                result.append(data.cast(typecode))
+            else:
+                values = array.array(typecode, data.tobytes())
+                values.byteswap()
+                result.append(values)
+        return tuple(result)
+
+    def waveform(self, width, start_s=0.0, end_s=None):
+        """
+        Summarise part of the track for drawing as a waveform `width` pixels wide, using the coarsest level which
+        still gives every pixel at least one block.
+
+        :param width: number of pixels.
+        :param start_s: where the waveform starts, in seconds.
+        :param end_s: where the waveform ends, in seconds. Defaults to the end of the track.
+        :return: a list of `(min, max, rms)` tuples, one per pixel. A pixel past the end of the audio is `(0, 0, 0.0)`.
+        """
+        if width < 1:
+            raise ValueError("`width` must be at least 1, but it is `{}`".format(width))
+        start = int(start_s * self.sample_rate)
+        end = self.num_samples if end_s is None else int(end_s * self.sample_rate)
+        samples_per_pixel = max(1, (end - start) / float(width))
+        level = self.level_for(samples_per_pixel)
+        block_samples, num_blocks, _ = self.levels[level]
+        mins, maxs, rms = self.envelope(level)
+
+        pixels = []
+        for x in range(width):
+            first = int((start + x * samples_per_pixel) // block_samples)
+            last = int(math.ceil((start + (x + 1) * samples_per_pixel) / block_samples))
+            first, last = min(first, num_blocks), min(max(last, first + 1), num_blocks)
+            if first == last:
+                pixels.append((0, 0, 0.0))
+                continue
+            pixels.append((min(mins[first:last]), max(maxs[first:last]),
+                           math.sqrt(sum(r * r for r in rms[first:last]) / (last - first))))
+        for values in (mins, maxs, rms):
+            if isinstance(values, memoryview):
+                values.release()
+        return pixels
+
+    def close(self):
+        """ Unmap the file. Views from `flags` and `envelope` can't be used afterwards, and must be released first. """
+        if self._map is not None:
+            if self.flags is not None:
+                self.flags.release()
+                self.flags = None
+            self._view.release()
+            self._map.close()
+            self._map = None
+        self._file.close()
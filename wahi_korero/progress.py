@@ -0,0 +1,118 @@
+'''
+Progress reports and cancellation for long-running segmentation.
+
+A `_Tracker` is updated from the frame loop of whichever collector is running. It checks a `CancelToken` at every
+update, so that a job can be stopped from another thread, and calls a progress callback at most every
+`REPORT_INTERVAL_S` seconds.
+'''
+import collections
+import subprocess
+import threading
+import time
+from .exceptions import Cancelled
+
+# The shortest time between two calls to a progress callback, in seconds. The final report is always made.
+REPORT_INTERVAL_S = 0.5
+
+# How many VAD frames are processed between updates when frames are handled one at a time.
+CHECK_EVERY_FRAMES = 1000
+
+# What a progress callback is given. `frames_per_second` is the number of VAD frames processed per second of wall
+# time; `eta_seconds` is `None` until there is a rate to estimate it from.
+Progress = collections.namedtuple("Progress", ["processed_seconds", "total_seconds", "frames_per_second",
+                                               "eta_seconds"])
+
+
+class CancelToken(object):
+    """
+    Lets one thread ask for a job running on another to stop. The job raises `Cancelled` the next time it checks,
+    once it has stopped any ffmpeg processes it started and deleted its temporary files.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """ Ask for the job to stop. """
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """ Raise `Cancelled` if the job has been cancelled. """
+        if self._event.is_set():
+            raise Cancelled("The job was cancelled.")
+
+
+class _Tracker(object):
+    """
+    Follows a job through the VAD frames of a track.
+
+    :param total_frames: how many frames the track has.
+    :param frame_seconds: how far through the track each frame moves, in seconds.
+    :param total_seconds: the length of the track, in seconds.
+    :param progress: an optional callback, given a `Progress`.
+    :param cancel: an optional `CancelToken`.
+    """
+
+    def __init__(self, total_frames, frame_seconds, total_seconds, progress=None, cancel=None):
+        self.total_frames = total_frames
+        self.frame_seconds = frame_seconds
+        self.total_seconds = total_seconds
+        self.progress = progress
+        self.cancel = cancel
+        self.started = time.time()
+        self.last_report = None
+
+    def update(self, frames_done):
+        """
+        Record that `frames_done` frames have been processed so far.
+
+        :raise Cancelled: if the job has been cancelled.
+        """
+        if self.cancel is not None:
+            self.cancel.check()
+        if self.progress is None:
+            return
+        now = time.time()
+        done = frames_done >= self.total_frames
+        if not done and self.last_report is not None and now - self.last_report < REPORT_INTERVAL_S:
+            return
+        self.last_report = now
+
+        elapsed = now - self.started
+        rate = frames_done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total_frames - frames_done) / rate if rate > 0 else None
+        processed = self.total_seconds if done else min(frames_done * self.frame_seconds, self.total_seconds)
+        self.progress(Progress(round(processed, 3), round(self.total_seconds, 3), rate, eta))
+
+    def frames(self, frames):
+        """ Pass through a generator of frames, updating every `CHECK_EVERY_FRAMES` of them. """
+        i = 0
+        for i, frame in enumerate(frames, 1):
+            if i % CHECK_EVERY_FRAMES == 0:
+                self.update(i)
+            yield frame
+        self.update(max(i, self.total_frames))
+
+
+def wait(process, cancel=None, poll_interval_s=0.1):
+    """
+    Wait for a subprocess to exit, killing it if `cancel` is cancelled first.
+
+    :return: the exit status of the process.
+    :raise Cancelled: if the job was cancelled.
+    """
+    if cancel is None:
+        return process.wait()
+    while True:
+        try:
+            return process.wait(timeout=poll_interval_s)
+        except subprocess.TimeoutExpired:
+            pass
+        if cancel.cancelled:
+            process.kill()
+            process.wait()
+            cancel.check()
@@ -1,19 +1,92 @@
-from __future__ import absolute_import, division, print_function
-
-if hasattr(__builtins__, "raw_input"):
-    input = raw_input
-
 """
 Adapted from https://github.com/wiseman/py-webrtcvad/blob/master/example.py
 """
 
+import array
+import collections
 from collections import deque
-from .exceptions import ConfigError, FormatError
+import copy
+import hashlib
+from .exceptions import Cancelled, ConfigError, FormatError
+from .export import ARCHIVE_FORMATS, encode_segments, EXPORT_FORMATS, write_archive
+from .index import IndexWriter, INDEX_FNAME, SegmentIndex
+from .progress import _Tracker
 import json
+import math
+import operator
+import os
+import shutil
+import tempfile
+import time
 import wave
 from os import path
-from .utils import open_audio, _quadraphonic_to_mono
-import webrtcvad
+from .audiosegment import _import_numpy
+from .utils import is_local_path, open_audio, _quadraphonic_to_mono
+
+# Only the C extension of `webrtcvad` is used where it can be. The `webrtcvad` module itself looks up its own version
+# with `pkg_resources` when it's imported, which takes longer than importing everything else here put together. The
+# extension is private, so if it isn't there the public `webrtcvad.Vad` is used instead.
+try:
+    import _webrtcvad
+    _vad_process = _webrtcvad.process
+except ImportError:
+    import webrtcvad
+    _webrtcvad = None
+
+    def _vad_process(vad, sample_rate, buf, length):
+        """ Does what `_webrtcvad.process` does, with a `webrtcvad.Vad` as the handle. """
+        return vad.is_speech(buf, sample_rate, length)
+
+try:
+    from . import _collector  # optional compiled version of `Segmenter._vad_collector`
+except ImportError:
+    _collector = None
+
+# Versions of webrtcvad whose `WebRtcVad_Process` has been checked to have the prototype that `_collector.c` calls it
+# with. `webrtcvad` and `webrtcvad-wheels` 2.0.x both build it from the same copy of webrtc.
+_DIRECT_VAD_VERSIONS = ("2.0.",)
+
+
+def _webrtcvad_version():
+    """ The version of the installed webrtcvad distribution, or `None` if it can't be found. """
+    try:
+        from importlib import metadata
+    except ImportError:  # Python 3.7
+        return None
+    for name in ("webrtcvad", "webrtcvad-wheels"):
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            pass
+    return None
+
+
+# The compiled collector is only used when it can call webrtcvad's C function itself, without going through Python for
+# every frame. Otherwise `_PyCollector` is used.
+_direct_vad = bool(_collector is not None and _webrtcvad is not None
+                   and (_webrtcvad_version() or "").startswith(_DIRECT_VAD_VERSIONS)
+                   and _collector.bind_webrtcvad(_webrtcvad))
+
+# How many frames of PCM the compiled collector is given at a time.
+_NATIVE_BLOCK_FRAMES = 4096
+
+# How many frames are read from ffmpeg at a time when a stream is segmented as it is decoded. This is kept small, so
+# that segments aren't held back until a large block has arrived.
+_PIPE_BLOCK_FRAMES = 100
+
+# How much audio before each window the detectors of a `refine_hop_ms` pass are run over, to settle their state.
+REFINE_WARMUP_MS = 1000
+
+# Auto-tuning looks at this fraction of the track, or `_TUNE_MIN_MS` of it if that is more but no more than
+# `_TUNE_MAX_FRACTION` of the track, in up to `_TUNE_EXCERPTS` excerpts spread evenly across it, each at least
+# `_TUNE_EXCERPT_MS` long. The noise floor and speech level are estimated from the energy of every
+# `_TUNE_ENERGY_STRIDE`th frame of those, which is in turn estimated from every `_TUNE_ENERGY_STRIDE`th sample.
+_TUNE_FRACTION = 0.02
+_TUNE_MAX_FRACTION = 0.05
+_TUNE_MIN_MS = 2000
+_TUNE_EXCERPTS = 32
+_TUNE_EXCERPT_MS = 250
+_TUNE_ENERGY_STRIDE = 4
 
 # Default parameters that you can use to create your own `Segmenter` objects.
 DEFAULT_CONFIG = \
@@ -35,6 +108,54 @@ def default_segmenter():
     return Segmenter(**DEFAULT_CONFIG)
 
 
+def warmup(segmenter=None, source_frame_rates=(44100, 48000)):
+    """
+    Do the one-off work that would otherwise slow down the first file segmented: load the voice-activity detector
+    and run it once, and, if the segmenter has a `DecoderPool`, start its ffmpeg processes. This is meant for
+    short-lived processes which want to pay their start-up cost before the first request arrives.
+
+    No `DecoderPool` is made here, since its processes would belong to nobody. A segmenter without one, such as
+    `default_segmenter()`, starts a fresh ffmpeg process for every file, and that start-up can't be paid in advance;
+    attach a pool to `segmenter.decoder` before calling this to have it warmed too.
+
+    :param segmenter: the `Segmenter` that will be used. Defaults to `default_segmenter()`, which only warms the
+        voice-activity detector.
+    :param source_frame_rates: sample rates of the audio expected, which decide how it will be decoded if the
+        segmenter doesn't have a `squash_rate`.
+    :return: how long warming up took, in seconds.
+    """
+    started = time.time()
+    segmenter = segmenter or default_segmenter()
+    sample_rate = 8000
+    if segmenter.decoder is not None:
+        conversions = set(segmenter._target_format(fr) for fr in source_frame_rates)
+        for frame_rate, filters in conversions:
+            segmenter.decoder.warm(1, frame_rate, filters)
+        sample_rate = min(frame_rate for frame_rate, _ in conversions)
+    vad = _Vad(segmenter.aggression)
+    silence = b"\0" * (2 * sample_rate * segmenter.frame_duration_ms // 1000)
+    vad.is_speech(silence, sample_rate)
+    return time.time() - started
+
+
+class _Vad(object):
+    """
+    A webrtcvad voice-activity detector, as made by `webrtcvad.Vad`. `_vad` is the handle which `_vad_process` is
+    given.
+    """
+
+    def __init__(self, mode):
+        if _webrtcvad is None:
+            self._vad = webrtcvad.Vad(mode)
+            return
+        self._vad = _webrtcvad.create()
+        _webrtcvad.init(self._vad)
+        _webrtcvad.set_mode(self._vad, mode)
+
+    def is_speech(self, buf, sample_rate):
+        return _vad_process(self._vad, sample_rate, buf, len(buf) // 2)
+
+
 class _Frame(object):
     """ Represents a single frame of audio data. """
 
@@ -72,12 +193,159 @@ def _frame_generator(frame_duration_ms, audio, overlap_ms=0):
 
     timestamp = 0.0  # location in the PCM data, stepping in seconds
     num_frames = int(audio.frame_rate*frame_duration_ms/1000)
-    fp = audio.get_file_path()
-    frame_position = 0
-    while frame_position <= total_frames:
+    for _ in range(_count_frames(total_frames, num_frames, num_frames)):
         yield _Frame(timestamp, frame_duration_s, wave_reader, num_frames)
         timestamp = round(timestamp + step_duration_s, 3)
-        frame_position = frame_position + num_frames + 1
+
+
+def _count_frames(total_samples, frame_samples, hop_samples):
+    """
+    The number of VAD frames in a track of `total_samples` PCM frames: every whole frame up to the end. webrtcvad
+    won't take a short frame, so a track shorter than a frame has none. Every path through the VAD counts frames this
+    way.
+    """
+    if total_samples < frame_samples:
+        return 0
+    return (total_samples - frame_samples) // hop_samples + 1
+
+
+class _PyCollector(object):
+    """
+    Pure Python stand-in for the compiled `_collector.Collector`, with the same interface. Frames are pushed in a
+    block of PCM at a time and segment boundaries come back as frame indices, which lets several collectors be run
+    side by side over one pass through the audio. `vad` may be a tuple of webrtcvad handles, which take the frames in
+    turn.
+    """
+
+    def __init__(self, process, vad, sample_rate, frame_bytes, buffer_len, threshold_voice, threshold_silence,
+                 hop_bytes=None):
+        self.process = process
+        self.vads = vad if isinstance(vad, tuple) else (vad,)
+        self.next_vad = 0
+        self.sample_rate = sample_rate
+        self.frame_bytes = frame_bytes
+        self.hop_bytes = hop_bytes or frame_bytes  # frames start this far apart, so they overlap if it's smaller
+        self.threshold_voice = threshold_voice
+        self.threshold_silence = threshold_silence
+        self.buffer = deque(maxlen=buffer_len)
+        self.frame_index = 0
+        self.collecting = False
+        self.segment_start = None
+        self.segment_end = None
+
+    def speech_flags(self, pcm, num_frames):
+        """ Run webrtcvad over `num_frames` frames of `pcm`, returning a `bytearray` with a 0 or 1 for each. """
+        flags = bytearray(num_frames)
+        for i in range(num_frames):
+            frame = pcm[i * self.hop_bytes: i * self.hop_bytes + self.frame_bytes]
+            vad = self.vads[self.next_vad]
+            self.next_vad = (self.next_vad + 1) % len(self.vads)
+            flags[i] = 1 if self.process(vad, self.sample_rate, frame, len(frame) // 2) else 0
+        return flags
+
+    def feed(self, pcm, num_frames):
+        return self.feed_flags(self.speech_flags(pcm, num_frames))
+
+    def feed_flags(self, flags):
+        """ Like `feed`, but for frames whose VAD decisions have already been made. """
+        boundaries = []
+        for is_speech in flags:
+            index = self.frame_index
+            self.frame_index += 1
+
+            if not self.collecting:
+                self.buffer.append(is_speech)
+                if sum(self.buffer) > self.threshold_voice:
+                    self.collecting = True
+                    self.segment_start = index - len(self.buffer) + 1
+                    self.segment_end = index
+                    self.buffer.clear()
+            else:
+                self.segment_end = index
+                self.buffer.append(is_speech)
+                if len(self.buffer) - sum(self.buffer) > self.threshold_silence:
+                    self.collecting = False
+                    boundaries.append((self.segment_start, self.segment_end))
+                    self.buffer.clear()
+        return boundaries
+
+    def finish(self):
+        if not self.collecting:
+            return []
+        self.collecting = False
+        return [(self.segment_start, self.segment_end)]
+
+
+def merge_channels(tagged_segments):
+    """
+    Merge segments from several channels into a single timeline, keeping track of where speakers overlap.
+
+    :param tagged_segments: an iterable of `(channel, (start, end))` pairs, like those from
+        `Segmenter.segment_channels`.
+    :return: a list of `(start, end, channels)` tuples, in order, where `channels` is a sorted list of the channels
+        with speech between `start` and `end`. Wherever the set of active channels changes, a new tuple begins, so
+        overlapping speech is exactly the tuples with more than one channel.
+    """
+    events = []
+    for channel, (start, end) in tagged_segments:
+        if end > start:
+            events.append((start, 1, channel))
+            events.append((end, -1, channel))
+    events.sort()
+
+    merged = []
+    active = {}
+    previous = None
+    for t, change, channel in events:
+        if previous is not None and t > previous and active:
+            channels = sorted(active)
+            if merged and merged[-1][1] == previous and merged[-1][2] == channels:
+                merged[-1] = (merged[-1][0], t, channels)
+            else:
+                merged.append((previous, t, channels))
+        active[channel] = active.get(channel, 0) + change
+        if active[channel] == 0:
+            del active[channel]
+        previous = t
+    return merged
+
+
+def _pack(segments, max_chunk_s):
+    """
+    Greedily group consecutive segments into chunks which last no longer than `max_chunk_s` from the start of their
+    first segment to the end of their last. Segments must already be no longer than that.
+
+    :return: a generator of lists of `(start, end)` tuples.
+    """
+    chunk = []
+    for start, end in segments:
+        if chunk and end - chunk[0][0] > max_chunk_s:
+            yield chunk
+            chunk = []
+        chunk.append((start, end))
+    if chunk:
+        yield chunk
+
+
+def _fingerprint(audio):
+    """
+    Hash the PCM of a preprocessed track, along with its sample rate and length. The segments of a track depend only
+    on these, so tracks with the same fingerprint are segmented identically.
+
+    :param audio: a preprocessed `AudioSegment`.
+    :return: the fingerprint, as a hex string.
+    """
+    wave_reader = audio.get_wave_reader()
+    wave_reader.rewind()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("{}:{}:".format(audio.frame_rate, wave_reader.getnframes()).encode("ascii"))
+    while True:
+        pcm = wave_reader.readframes(64 * 1024)
+        if not pcm:
+            break
+        digest.update(pcm)
+    wave_reader.rewind()
+    return digest.hexdigest()
 
 
 def frame_stream(frame_duration_ms, audio_fpath, output_audio=False, overlap_ms=0):
@@ -85,14 +353,14 @@ def frame_stream(frame_duration_ms, audio_fpath, output_audio=False, overlap_ms=
     Produces a generator which yields successive segments of a specified frame size.
     :param frame_duration_ms: the size of the frames (in ms).
     :param audio_fpath: location of the audio to segment.
-    :param output_audio: whether or not the voiced segments should be extracted into separate `AudioSegment` \
-        objects.
+    :param output_audio: whether or not each frame should come with an `AudioSlice` handle on its audio.
     :param overlap_ms: frames are allowed to overlap. If set, then the distance between the start of frames will be \
         `frame_duration_ms - overlap`. Otherwise there will be no overlap between frames.
-    :return: a generator which yields pairs `(segment, audio)`. A segment is a tuple `(start, stop)`, where `start` \
-        and `stop` are timestamps (in seconds) in the track. If `output_audio` is set, then `audio` will be a \
-        `pydub.AudioSegment` containing the appropriate audio, extracted from the input track; otherwise, `audio` \
-        will be `None`.
+    :return: a generator which yields pairs `(segment, audio)`, one for every whole frame in the track. Any audio \
+        after the last whole frame is left out, as is a track shorter than one frame. A segment is a tuple \
+        `(start, stop)`, where `start` and `stop` are timestamps (in seconds) in the track. If `output_audio` is set, \
+        then `audio` will be an `AudioSlice` over that part of the input track, which is only read when you call its \
+        `read`, `as_numpy` or `export` method; otherwise, `audio` will be `None`.
     """
     audio = open_audio(audio_fpath)
     fg = _frame_generator(frame_duration_ms, audio, overlap_ms=overlap_ms)
@@ -139,7 +407,7 @@ def frame_audio(frame_duration_ms, audio_fpath, output_dir, output_audio=True, o
             output_fpath = path.join(output_dir, fname)
             if verbose:
                 print("Writing {}".format(output_fpath))
-            audio.export(output_fpath, format="wav").close()  # export returns an open file handle
+            audio.export(output_fpath, format="wav")
             additional_kvs["fname"] = fname
         start, end = seg
         seg_data.add(start, end, additional_kvs)
@@ -151,13 +419,29 @@ def frame_audio(frame_duration_ms, audio_fpath, output_dir, output_audio=True, o
 
 
 class _SegData(object):
+    """
+    Gathers segments and writes them out as JSON. Segments are spooled to a temporary file as they are added, so
+    memory use doesn't grow with the number of segments.
+    """
 
-    def __init__(self, fpath):
-        self.duration_seconds = round(open_audio(fpath).duration_seconds, 3)  # round to ms
+    def __init__(self, fpath, duration_seconds=None):
+        if duration_seconds is None:
+            duration_seconds = open_audio(fpath).duration_seconds
+        self.duration_seconds = round(duration_seconds, 3)  # round to ms
         self.num_segs = 0
         self.track_name = path.basename(fpath)
-        self.segments = []
         self.kvs = {}
+        self._spool = tempfile.TemporaryFile(mode="w+")
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """ Delete the spooled segments. """
+        self._spool.close()
 
     def add(self, start, end, additional_kvs=None):
         if additional_kvs is None:
@@ -167,23 +451,52 @@ class _SegData(object):
         for key in additional_kvs.keys():
             args[key] = additional_kvs[key]
 
-        self.segments.append(args)
+        self._spool.write(json.dumps(args))
+        self._spool.write("\n")
         self.num_segs += 1
 
+    @property
+    def segments(self):
+        """ A generator over the segments added so far. """
+        self._spool.flush()
+        self._spool.seek(0)
+        for line in self._spool:
+            yield json.loads(line)
+        self._spool.seek(0, 2)  # go back to the end, ready for more segments
+
     def save_to_file(self, output_fpath, verbose=True):
         with open(output_fpath, "w+") as json_file:
             if verbose:
                 print("Writing {}".format(output_fpath))
-            data = self.to_json()
-            json_file.write(json.dumps(data, indent=2))  # pretty prints to the JSON file; might be inefficient
+            self.write(json_file)
 
-    def to_json(self):
-        return {
-            "track_duration": self.duration_seconds,
-            "num_segments": self.num_segs,
-            "track_name": self.track_name,
-            "segments": self.segments,
-        }
+    def write(self, json_file):
+        """
+        Write the JSON to an open file a segment at a time. The output is the same as `json.dumps(self.to_json(),
+        indent=2)`.
+        """
+        header = json.dumps(self.to_json(segments=False), indent=2)
+        json_file.write(header[:-2])  # leave off the closing "\n}"
+        if self.num_segs == 0:
+            json_file.write(',\n  "segments": []\n}')
+            return
+        json_file.write(',\n  "segments": [\n')
+        for i, seg in enumerate(self.segments):
+            if i > 0:
+                json_file.write(",\n")
+            json_file.write("\n".join("    " + line for line in json.dumps(seg, indent=2).split("\n")))
+        json_file.write("\n  ]\n}")
+
+    def to_json(self, segments=True):
+        data = collections.OrderedDict([
+            ("track_duration", self.duration_seconds),
+            ("num_segments", self.num_segs),
+            ("track_name", self.track_name),
+        ])
+        data.update(self.kvs)
+        if segments:
+            data["segments"] = list(self.segments)
+        return data
 
     def __str__(self):
         return self.to_json().__str__()
@@ -213,10 +526,36 @@ class Segmenter(object):
             or 3 (most aggressive).
         - `squash_rate`: the segmenter will transcode the audio to this sample rate before segmenting it. This can \
             help minimise noises not in the frequency of human speech. Can be omitted.
+        - `lookahead_ms`: optional. If set, segments are found by hysteresis on the proportion of voiced frames in \
+            a window of this length, instead of by the buffer thresholds above. A segment starts once the proportion \
+            reaches `onset_ratio` and ends once it falls to `offset_ratio`. Boundaries are back-dated to the first and \
+            last voiced frame, so this is how far past a boundary the segmenter looks before deciding on it. The \
+            value must be a multiple of `frame_duration_ms`.
+        - `onset_ratio`: proportion of voiced frames in the lookahead window needed to start a segment.
+        - `offset_ratio`: proportion of voiced frames in the lookahead window at or below which a segment ends. Must \
+            be less than `onset_ratio`.
+        - `native`: if set (the default), the compiled frame loop is used when it has been built. It gives the same \
+            results as the pure Python one, faster.
+        - `decoder`: an optional `DecoderPool`. If set, transcoding is sent to its warm ffmpeg processes instead of \
+            starting new ones for every file.
+        - `auto_tune`: if set, `aggression`, `threshold_voice_ms` and `threshold_silence_ms` are chosen afresh for \
+            each file from a quick look at excerpts of it, before it is segmented. See `tune`.
+        - `hop_ms`: optional. If set, a frame starts every `hop_ms` rather than every `frame_duration_ms`, so frames \
+            overlap and boundaries fall on a finer grid. The buffer and thresholds keep their length in milliseconds, \
+            so they hold more frames, and each offset within a frame has a detector of its own. Costs \
+            `frame_duration_ms / hop_ms` times as many VAD calls. The value must divide `frame_duration_ms`. A \
+            segment can end earlier than it would without `hop_ms`, at a pause that only just fits \
+            `threshold_silence_ms` once it is measured on the finer grid.
+        - `refine_hop_ms`: optional. If set, each boundary is found again by running VAD at this finer hop, but only \
+            within `buffer_length_ms` either side of it, so the whole track doesn't pay for the finer hop. The value \
+            must divide `frame_duration_ms` and be smaller than the hop. The detectors for each boundary are new, and \
+            don't always agree with those of the full pass, so a boundary can move by up to `buffer_length_ms`.
     """
 
     def __init__(self, frame_duration_ms, threshold_silence_ms, threshold_voice_ms, buffer_length_ms, aggression=1,
-                 squash_rate=None, caption_threshold=None, min_caption_len_ms=None):
+                 squash_rate=None, caption_threshold=None, min_caption_len_ms=None, lookahead_ms=None,
+                 onset_ratio=0.6, offset_ratio=0.2, native=True, decoder=None, auto_tune=False, hop_ms=None,
+                 refine_hop_ms=None):
 
         self.frame_duration_ms = frame_duration_ms
         self.threshold_silence_ms = threshold_silence_ms
@@ -226,6 +565,14 @@ class Segmenter(object):
         self.squash_rate = squash_rate
         self.caption_threshold = caption_threshold
         self.min_caption_len_ms = min_caption_len_ms
+        self.lookahead_ms = lookahead_ms
+        self.onset_ratio = onset_ratio
+        self.offset_ratio = offset_ratio
+        self.native = native
+        self.decoder = decoder
+        self.auto_tune = auto_tune
+        self.hop_ms = hop_ms
+        self.refine_hop_ms = refine_hop_ms
         self._check_parameters()
 
     def _check_parameters(self):
@@ -252,8 +599,27 @@ class Segmenter(object):
                               .format(self.threshold_voice_ms, self.buffer_length_ms))
         if self.min_caption_len_ms and not self.caption_threshold:
             raise ConfigError("min_caption_len_ms is set, but caption_threshold is not.")
-
-    def _preprocess_audio(self, audio):
+        if self.lookahead_ms is not None:
+            if self.lookahead_ms <= 0 or self.lookahead_ms % self.frame_duration_ms != 0:
+                raise ConfigError("lookahead_ms ({}) must be a positive multiple of frame_duration_ms ({})"
+                                  .format(self.lookahead_ms, self.frame_duration_ms))
+            if not 0 <= self.offset_ratio < self.onset_ratio <= 1:
+                raise ConfigError("Must have `0 <= offset_ratio < onset_ratio <= 1`, but have `0 <= {} < {} <= 1`"
+                                  .format(self.offset_ratio, self.onset_ratio))
+        for name in ["hop_ms", "refine_hop_ms"]:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if self.lookahead_ms is not None:
+                raise ConfigError("{} can't be used with lookahead_ms.".format(name))
+            if value <= 0 or self.frame_duration_ms % value != 0:
+                raise ConfigError("{} ({}) must divide frame_duration_ms ({})"
+                                  .format(name, value, self.frame_duration_ms))
+        if self.refine_hop_ms is not None and self.refine_hop_ms >= (self.hop_ms or self.frame_duration_ms):
+            raise ConfigError("refine_hop_ms ({}) must be smaller than the hop ({})"
+                              .format(self.refine_hop_ms, self.hop_ms or self.frame_duration_ms))
+
+    def _preprocess_audio(self, audio, channels=1, cancel=None):
         """
         Process an `AudioSegment`, obtaining a new `AudioSegment` guaranteed to have 1 channel (mono), a sample width \
         of 2, and a sample rate of 8000Hz, 16000Hz, or 32000Hz.
@@ -263,28 +629,145 @@ class Segmenter(object):
         in 8/16/32kHz. If you leave it as `None`, the track will simply convert down to the nearest sample.
 
         :param audio: the `AudioSegment` to process.
+        :param channels: number of channels to keep. If `None`, all the channels of the original are kept rather than \
+            mixing down to mono.
+        :param cancel: an optional `CancelToken`, which stops the transcode.
         :return: the processed `AudioSegment`.
         :raise FormatError: if the audio can't be transcoded to the appropriate format.
         """
 
-        # First turn audio into valid wav pcm
-        audio.set_format(
-            ['-acodec', 'pcm_s16le', '-ac', '1', "-f", "wav"], ext='wav')
+        # Audio which has already been through here, e.g. to be fingerprinted, isn't transcoded again.
+        key = (channels, self.squash_rate)
+        if audio.preprocessed == key:
+            return audio
+
+        # Everything is done in a single transcode to 16 bit PCM wav.
+        new_fr, filters = self._target_format(audio.frame_rate)
+        audio.convert(channels=channels, frame_rate=new_fr, filters=list(filters) if filters else None, cancel=cancel)
+        audio.preprocessed = key
 
+        return audio
+
+    def _target_format(self, frame_rate):
+        """
+        Work out how audio at `frame_rate` is transcoded before it is segmented.
+
+        :param frame_rate: sample rate of the original audio.
+        :return: a tuple `(new_frame_rate, filters)`, where `filters` is a tuple of ffmpeg filters or `None`.
+        :raise FormatError: if `frame_rate` is too low.
+        """
         valid_sample_rates = (32000, 16000, 8000)
 
+        # Squashing is done with a resampling filter ahead of the conversion up to the nearest valid sample rate.
         if self.squash_rate is not None:
-            audio.set_frame_rate(self.squash_rate)
-            new_fr = next(fr for fr in reversed(valid_sample_rates) if fr >= audio.frame_rate)
-            audio.set_frame_rate(new_fr)
-        else:
-            if audio.frame_rate < 8000:
-                raise FormatError("Frame rate `{}` is too low; I don't know what to do. If you want to preprocess this"
-                                  "track, try passing in a `desired_sample_rate`.".format(audio.frame_rate))
-            new_fr = next(fr for fr in valid_sample_rates if fr < audio.frame_rate)
-            audio.set_frame_rate(new_fr)
+            filters = ("aresample={}".format(self.squash_rate),)
+            return next(fr for fr in reversed(valid_sample_rates) if fr >= self.squash_rate), filters
+        if frame_rate < 8000:
+            raise FormatError("Frame rate `{}` is too low; I don't know what to do. If you want to preprocess this"
+                              "track, try passing in a `desired_sample_rate`.".format(frame_rate))
+        return next(fr for fr in valid_sample_rates if fr < frame_rate), None
+
+    def _tune(self, audio):
+        """
+        Choose parameters for a preprocessed track by running the VAD over a sample of short excerpts from it.
 
-        return audio
+        The quietest tenth of the sampled frames gives the noise floor, and the loudest twentieth the level of the
+        speech. The gap between them decides how hard the VAD has to work: the noisier the track, the higher the
+        `aggression` and the more of the buffer must be voiced before a segment starts. The share of frames the VAD
+        then calls speech decides `threshold_silence_ms`: dense speech is split at short pauses, while sparse speech
+        in noise is given more room, since the VAD misses more of its frames.
+
+        :param audio: a preprocessed `AudioSegment`.
+        :return: an `OrderedDict` with the chosen `aggression`, `threshold_voice_ms` and `threshold_silence_ms`, and
+            the `noise_floor_db`, `snr_db` and `speech_ratio` they were based on, and `sampled_seconds`.
+        """
+        wave_reader = audio.get_wave_reader()
+        num_frames = int(audio.frame_rate * self.frame_duration_ms / 1000)
+        frames_total = max(1, wave_reader.getnframes() // num_frames)
+
+        sampled_frames = max(1, int(frames_total * _TUNE_FRACTION),
+                             min(_TUNE_MIN_MS // self.frame_duration_ms, int(frames_total * _TUNE_MAX_FRACTION)))
+        num_excerpts = max(1, min(_TUNE_EXCERPTS, sampled_frames // (_TUNE_EXCERPT_MS // self.frame_duration_ms)))
+        excerpt_frames = sampled_frames // num_excerpts
+        stride = (frames_total - excerpt_frames) / float(num_excerpts)
+
+        excerpts = []
+        energies = []
+        for i in range(num_excerpts):
+            wave_reader.setpos(int((i + 0.5) * stride) * num_frames)
+            pcm = wave_reader.readframes(excerpt_frames * num_frames)
+            excerpts.append(pcm)
+            samples = array.array("h", pcm)
+            for start in range(0, len(samples) - num_frames + 1, num_frames * _TUNE_ENERGY_STRIDE):
+                frame = samples[start:start + num_frames:_TUNE_ENERGY_STRIDE]
+                mean_square = sum(map(operator.mul, frame, frame)) / float(len(frame))
+                energies.append(10 * math.log10(mean_square / 32768.0 ** 2) if mean_square else -100.0)
+        wave_reader.rewind()
+        if not energies:
+            # The track is shorter than a frame, so there is nothing to go on.
+            return collections.OrderedDict([
+                ("aggression", self.aggression),
+                ("threshold_voice_ms", self.threshold_voice_ms),
+                ("threshold_silence_ms", self.threshold_silence_ms),
+                ("noise_floor_db", None),
+                ("snr_db", None),
+                ("speech_ratio", None),
+                ("sampled_seconds", 0.0),
+            ])
+        energies.sort()
+        noise_floor = energies[int(0.1 * (len(energies) - 1))]
+        snr = energies[int(0.95 * (len(energies) - 1))] - noise_floor
+
+        aggression = 3 if snr < 20 else 2 if snr < 30 else 1
+        voice_fraction = 0.9 if snr < 20 else 0.75 if snr < 30 else 0.6
+
+        frame_bytes = num_frames * audio.sample_width
+        vad = _Vad(aggression)
+        scorer = self._new_collector(vad, audio.frame_rate, frame_bytes)
+        num_speech = 0
+        num_scored = 0
+        for pcm in excerpts:
+            count = len(pcm) // frame_bytes
+            num_speech += sum(scorer.speech_flags(pcm, count))
+            num_scored += count
+        speech_ratio = num_speech / float(max(1, num_scored))
+        silence_fraction = 0.1 if speech_ratio >= 0.5 else 0.2 if snr >= 20 else 0.3
+
+        buffer_len = int(self.buffer_length_ms / self.frame_duration_ms)
+        return collections.OrderedDict([
+            ("aggression", aggression),
+            ("threshold_voice_ms", max(1, int(voice_fraction * buffer_len)) * self.frame_duration_ms),
+            ("threshold_silence_ms", max(1, int(silence_fraction * buffer_len)) * self.frame_duration_ms),
+            ("noise_floor_db", round(noise_floor, 1)),
+            ("snr_db", round(snr, 1)),
+            ("speech_ratio", round(speech_ratio, 3)),
+            ("sampled_seconds", round(num_scored * self.frame_duration_ms / 1000.0, 3)),
+        ])
+
+    def _tuned(self, tuning):
+        """ A copy of this `Segmenter` which uses the parameters chosen by `_tune`. """
+        segmenter = copy.copy(self)
+        segmenter.auto_tune = False
+        for key in ["aggression", "threshold_voice_ms", "threshold_silence_ms"]:
+            setattr(segmenter, key, tuning[key])
+        segmenter._check_parameters()
+        return segmenter
+
+    def tune(self, audio_fpath):
+        """
+        Choose `aggression`, `threshold_voice_ms` and `threshold_silence_ms` for the audio at `audio_fpath`, as
+        `auto_tune` does. The VAD is only run over 2% of the track (or two seconds of it, if that is more, up to 5%
+        of the track), in excerpts spread across it, so this costs a small fraction of segmenting the whole track. A
+        track shorter than one frame keeps this segmenter's own parameters.
+
+        :param audio_fpath: location of the audio.
+        :return: an `OrderedDict` of the chosen parameters, along with the statistics they were based on:
+            `noise_floor_db` and `snr_db` (in dB relative to full scale), `speech_ratio` (the share of sampled frames
+            which were voiced) and `sampled_seconds`.
+        :raise FileNotFoundError: if `audio_fpath` doesn't exist.
+        :raise FormatError: if the format of the file at `audio_fpath` isn't supported.
+        """
+        return self._tune(self._preprocess_audio(open_audio(audio_fpath, decoder=self.decoder)))
 
     def _vad_collector(self, sample_rate, vad, frames):
         """
@@ -312,8 +795,10 @@ class Segmenter(object):
         # Track whether or not we are currently gathering frames into a segment.
         collecting_voiced_frames = False
 
-        # Holds the frames being gathered into a segment.
-        voiced_frames = []
+        # Timestamps of the first and latest frames gathered into the current segment. Only these are kept, rather
+        # than the frames themselves, so memory doesn't grow with the length of a segment.
+        segment_start = None
+        segment_end = None
 
         for i, frame in enumerate(frames):
 
@@ -324,75 +809,755 @@ class Segmenter(object):
             # Add frame to the buffer. If enough of the frames are voiced, start collecting frames into a segmenter. Any
             # frames currently in the buffer are part of this new segment.
             if not collecting_voiced_frames:
-                buffer.append((frame, is_speech))
-                num_voiced = len([f for f, spoken in buffer if spoken])
+                buffer.append((frame.timestamp, is_speech))
+                num_voiced = len([t for t, spoken in buffer if spoken])
                 if num_voiced > threshold_voice:
                     collecting_voiced_frames = True
-                    for f, _ in buffer:
-                        voiced_frames.append(f)
+                    segment_start = buffer[0][0]
+                    segment_end = buffer[-1][0]
                     buffer.clear()
             # If enough of the buffer is unvoiced, we've reached the end of this segment. Yield the data we've gathered
             # so far and reset the above variables.
             else:
-                voiced_frames.append(frame)
-                buffer.append((frame, is_speech))
-                num_unvoiced = len([f for f, spoken in buffer if not spoken])
+                segment_end = frame.timestamp
+                buffer.append((frame.timestamp, is_speech))
+                num_unvoiced = len([t for t, spoken in buffer if not spoken])
                 if num_unvoiced > threshold_silence:
                     collecting_voiced_frames = False
-                    yield voiced_frames[0].timestamp, voiced_frames[-1].timestamp
+                    yield segment_start, segment_end
                     buffer.clear()
-                    voiced_frames = []
 
         # If we have any leftover voiced audio when we run out of input, yield it.
-        if voiced_frames:
-            yield voiced_frames[0].timestamp, voiced_frames[-1].timestamp
+        if collecting_voiced_frames:
+            yield segment_start, segment_end
+
+    def _new_collector(self, vad, sample_rate, frame_bytes, hop_bytes=None):
+        """
+        Make a block-fed collector for this segmenter's buffer settings: the compiled one if it has been built, can
+        call webrtcvad directly and `native` is set, or `_PyCollector` otherwise.
+
+        If frames overlap, the buffer and thresholds are scaled to hold the same number of milliseconds, and `vad` is
+        joined by a new detector for each extra frame that starts within one `frame_duration_ms`. They take the frames
+        in turn, so each sees frames that follow on from each other, as it would without the overlap.
+        """
+        hop_bytes = hop_bytes or frame_bytes
+        hop_ms = self.frame_duration_ms * hop_bytes / float(frame_bytes)
+        vads = (vad._vad,) + tuple(_Vad(self.aggression)._vad for _ in range(frame_bytes // hop_bytes - 1))
+        collector_type = _collector.Collector if self.native and _direct_vad else _PyCollector
+        return collector_type(
+            _vad_process, vads, sample_rate, frame_bytes,
+            int(round(self.buffer_length_ms / hop_ms)),
+            int(round(self.threshold_voice_ms / hop_ms)),
+            int(round(self.threshold_silence_ms / hop_ms)),
+            hop_bytes)
+
+    @property
+    def _hop_s(self):
+        """ Time between the starts of successive frames, in seconds. """
+        return (self.hop_ms or self.frame_duration_ms) / 1000.0
+
+    def _frame_layout(self, audio):
+        """
+        Work out how a preprocessed track is cut into VAD frames.
+
+        :param audio: a preprocessed `AudioSegment`.
+        :return: a tuple `(frame_samples, hop_samples, num_frames)`. Without `hop_ms`, the frames are back to back.
+        """
+        frame_samples = int(audio.frame_rate * self.frame_duration_ms / 1000)
+        hop_samples = int(audio.frame_rate * self._hop_s + 0.5)
+        total_samples = audio.get_wave_reader().getnframes()
+        return frame_samples, hop_samples, _count_frames(total_samples, frame_samples, hop_samples)
+
+    def _read_blocks(self, wave_reader, frame_samples, hop_samples, num_frames):
+        """
+        Read `num_frames` frames from `wave_reader`, up to `_NATIVE_BLOCK_FRAMES` of them at a time. Overlapping
+        frames span the blocks, so the end of each block is carried over to the start of the next.
+
+        :return: a generator of `(pcm, block)` pairs, where `block` is the number of frames starting in `pcm`.
+        """
+        overlap_bytes = 2 * (frame_samples - hop_samples)
+        carry = wave_reader.readframes(frame_samples - hop_samples)
+        remaining = num_frames
+        while remaining > 0:
+            block = min(remaining, _NATIVE_BLOCK_FRAMES)
+            pcm = carry + wave_reader.readframes(block * hop_samples)
+            yield pcm, block
+            carry = pcm[len(pcm) - overlap_bytes:] if overlap_bytes else b""
+            remaining -= block
+
+    def _native_vad_collector(self, audio, vad, tracker=None):
+        """
+        Does the same job as `_frame_generator` and `_vad_collector` together, but with the frame loop and ring buffer
+        in the compiled `_collector` module. PCM is read a block at a time, so memory use stays bounded. This is also
+        how overlapping frames are handled when `hop_ms` is set, with `_PyCollector` if the compiled module can't
+        call webrtcvad directly.
+
+        :param audio: a preprocessed `AudioSegment`.
+        :param vad: a webrtcvad voice-activity detector.
+        :param tracker: an optional `_Tracker`, updated after every block.
+        :return: a generator that yields `(start, end)` tuples, identical to those from `_vad_collector` without
+            `hop_ms`.
+        """
+        frame_samples, hop_samples, num_frames = self._frame_layout(audio)
+        step_s = self._hop_s
+        collector = self._new_collector(vad, audio.frame_rate, frame_samples * audio.sample_width,
+                                        hop_samples * audio.sample_width)
+
+        done = 0
+        for pcm, block in self._read_blocks(audio.get_wave_reader(), frame_samples, hop_samples, num_frames):
+            for start, end in collector.feed(pcm, block):
+                yield round(start * step_s, 3), round(end * step_s, 3)
+            done += block
+            if tracker is not None:
+                tracker.update(done)
+        for start, end in collector.finish():
+            yield round(start * step_s, 3), round(end * step_s, 3)
+
+    def _refined(self, segments, audio):
+        """
+        Find each boundary again at the finer `refine_hop_ms`. For every boundary, the ring buffer is run afresh over
+        `buffer_length_ms` either side of it (and one frame more), with detectors of its own, so that only those windows
+        pay for the finer hop. The detectors are not those of the full pass, so they don't always agree with it; a
+        boundary may only move by up to one coarse hop. It stays where it was if the finer pass doesn't find one that
+        close, or if moving it would put the segments out of order.
+
+        :param segments: a generator of `(start, end)` tuples from a collector.
+        :param audio: the preprocessed `AudioSegment` they came from.
+        :return: a generator of `(start, end)` tuples.
+        """
+        reader = wave.open(audio.get_file_path(), "rb")
+        window_s = (self.buffer_length_ms + self.frame_duration_ms) / 1000.0
+        step_s = (self.hop_ms or self.frame_duration_ms) / 1000.0
+        previous_end = 0.0
+        try:
+            for start, end in segments:
+                new_start = self._refine_boundary(reader, max(start - window_s, previous_end), start + window_s,
+                                                  onset=True)
+                new_end = self._refine_boundary(reader, max(end - window_s, start), end + window_s, onset=False)
+                if new_start is None or new_start < previous_end or abs(new_start - start) > step_s:
+                    new_start = start
+                if new_end is None or abs(new_end - end) > step_s:
+                    new_end = end
+                if new_end <= new_start:
+                    new_start, new_end = start, end
+                previous_end = new_end
+                yield new_start, new_end
+        finally:
+            reader.close()
+
+    def _refine_boundary(self, reader, window_start, window_end, onset):
+        """
+        Run the ring buffer over part of the track at `refine_hop_ms`. The detectors are new, so they are run over up
+        to `REFINE_WARMUP_MS` of audio before the window first, for their state to settle.
+
+        :param reader: a `wave` reader on the preprocessed audio.
+        :param window_start: where to start, in seconds.
+        :param window_end: where to stop, in seconds.
+        :param onset: if set, look for the start of a segment; otherwise, the ring buffer starts out inside a segment
+            and looks for its end.
+        :return: the time of the first boundary found, in seconds, or `None` if there isn't one.
+        """
+        rate = reader.getframerate()
+        frame_samples = int(rate * self.frame_duration_ms / 1000)
+        hop_samples = int(rate * self.refine_hop_ms / 1000)
+        first = max(0, int(round(window_start * rate)))
+        last = min(reader.getnframes(), int(round(window_end * rate)))
+        num_frames = (last - first - frame_samples) // hop_samples + 1
+        if num_frames < 1:
+            return None
+        warmup_frames = min(first, int(rate * REFINE_WARMUP_MS / 1000)) // hop_samples
+
+        reader.setpos(first - warmup_frames * hop_samples)
+        pcm = reader.readframes(last - first + warmup_frames * hop_samples)
+        vads = tuple(_Vad(self.aggression)._vad for _ in range(frame_samples // hop_samples))
+        collector = _PyCollector(_vad_process, vads, rate, 2 * frame_samples,
+                                 int(self.buffer_length_ms / self.refine_hop_ms),
+                                 int(self.threshold_voice_ms / self.refine_hop_ms),
+                                 int(self.threshold_silence_ms / self.refine_hop_ms),
+                                 hop_bytes=2 * hop_samples)
+        if not onset:
+            collector.collecting = True
+            collector.segment_start = 0
+
+        flags = collector.speech_flags(pcm, warmup_frames + num_frames)
+        for is_speech in flags[warmup_frames:]:
+            boundaries = collector.feed_flags([is_speech])
+            if onset and collector.collecting:
+                return round((first + collector.segment_start * hop_samples) / float(rate), 3)
+            if not onset and boundaries:
+                return round((first + boundaries[0][1] * hop_samples) / float(rate), 3)
+        return None
+
+    def _indexed_vad_collector(self, audio, vad, index_fpath, tracker=None):
+        """
+        Does the same job as `_native_vad_collector`, while also writing a `SegmentIndex` of the track to
+        `index_fpath`. The VAD decisions for each block are made first so that they can be saved, then put through the
+        ring buffer, both in the compiled collector where it can be used. The audio past the last frame is read too,
+        so the envelope covers the whole track.
+
+        :param audio: a preprocessed `AudioSegment`.
+        :param vad: a webrtcvad voice-activity detector.
+        :param index_fpath: where to write the index.
+        :param tracker: an optional `_Tracker`, updated after every block.
+        :return: a generator that yields `(start, end)` tuples, identical to those from `_vad_collector`.
+        """
+        wave_reader = audio.get_wave_reader()
+        num_frames, _, remaining = self._frame_layout(audio)
+        frame_bytes = num_frames * audio.sample_width
+        step_s = self.frame_duration_ms / 1000.0
+        total_samples = wave_reader.getnframes()
+
+        collector = self._new_collector(vad, audio.frame_rate, frame_bytes)
+
+        with IndexWriter(index_fpath, audio.frame_rate, self.frame_duration_ms, self.aggression, remaining,
+                         total_samples) as writer:
+            while remaining > 0:
+                block = min(remaining, _NATIVE_BLOCK_FRAMES)
+                pcm = wave_reader.readframes(block * num_frames)
+                writer.add_samples(array.array("h", pcm))
+                flags = collector.speech_flags(pcm, block)
+                writer.add_flags(flags)
+                for start, end in collector.feed_flags(flags):
+                    yield round(start * step_s, 3), round(end * step_s, 3)
+                remaining -= block
+                if tracker is not None:
+                    tracker.update(writer.num_frames - remaining)
+            while True:
+                pcm = wave_reader.readframes(_NATIVE_BLOCK_FRAMES * num_frames)
+                if not pcm:
+                    break
+                writer.add_samples(array.array("h", pcm))
+        for start, end in collector.finish():
+            yield round(start * step_s, 3), round(end * step_s, 3)
+
+    def _hysteresis_collector(self, sample_rate, vad, frames):
+        """
+        Construct a generator which will yield segments of voiced audio, smoothing the decisions of a webrtcvad
+        voice-activity detector with hysteresis.
 
-    def segment_stream(self, audio_fpath, output_audio=False):
+        The proportion of voiced frames in the last `lookahead_ms` of audio is kept up to date incrementally with a
+        fixed-size ring of counters. A segment starts when the proportion reaches `onset_ratio` and ends when it falls
+        to `offset_ratio`. Since the decision is only made once the window has filled, the start is back-dated to the
+        first voiced frame in the window, but never into the previous segment, and the end to the last voiced frame
+        seen. Unlike the other collectors, whose segments end at the start of their last frame, a segment here ends
+        where its last voiced frame ends.
+
+        :param sample_rate: the sample rate of the audio being segmented.
+        :param vad: a webrtcvad voice-activity detector.
+        :param frames: a generator which yields successive frames of the audio.
+        :return: a generator that yields `(start, end)` tuples.
+        """
+
+        window_len = int(self.lookahead_ms / self.frame_duration_ms)
+        onset = max(1, int(math.ceil(self.onset_ratio * window_len)))
+        offset = int(math.floor(self.offset_ratio * window_len))
+
+        # The ring holds a 0/1 count and timestamp for each frame in the window, and `num_voiced` their running sum.
+        voiced_ring = [0] * window_len
+        timestamp_ring = [0.0] * window_len
+        num_voiced = 0
+        head = 0  # index of the oldest frame in the ring
+
+        collecting = False
+        start = None
+        last_voiced_end = None
+        previous_end = None
+
+        for frame in frames:
+            is_speech = 1 if vad.is_speech(frame.bytes, sample_rate) else 0
+
+            num_voiced += is_speech - voiced_ring[head]
+            voiced_ring[head] = is_speech
+            timestamp_ring[head] = frame.timestamp
+            head = (head + 1) % window_len
+            if is_speech:
+                last_voiced_end = round(frame.timestamp + frame.duration, 3)
+
+            if not collecting and num_voiced >= onset:
+                collecting = True
+                # Walk from the oldest frame to find the first voiced one since the previous segment ended.
+                for j in range(window_len):
+                    k = (head + j) % window_len
+                    if voiced_ring[k] and (previous_end is None or timestamp_ring[k] >= previous_end):
+                        start = timestamp_ring[k]
+                        break
+            elif collecting and num_voiced <= offset:
+                collecting = False
+                previous_end = last_voiced_end
+                yield start, last_voiced_end
+
+        # If we're in the middle of a segment when we run out of input, it ends at the last voiced frame.
+        if collecting:
+            yield start, last_voiced_end
+
+    def _captioned(self, segments, track_length_ms):
+        """ Wrap a generator of segments with captioning, if that option has been set. """
+        if self.caption_threshold is not None:
+            segments = self._caption_generator(segments, track_length_ms)
+            if self.min_caption_len_ms is not None:
+                segments = self._caption_merger(segments)
+        return segments
+
+    def segment_stream(self, audio_fpath, output_audio=False, index_fpath=None, progress=None, cancel=None):
         """
         Create a generator which segments the audio at `audio_fpath`, yielding successive segments.
 
-        :param audio_fpath: location of the audio to segment.
-        :param output_audio: whether or not the voiced segments should be extracted into separate `AudioSegment`
-            objects.
+        :param audio_fpath: location of the audio to segment. This can also be a URL or a file-like object, which
+            is streamed; see `open_audio`.
+        :param output_audio: whether or not each segment should come with an `AudioSlice` handle on its audio.
+        :param index_fpath: if set, a `SegmentIndex` of the track is written here as it is segmented. It is complete
+            once the generator is exhausted, and can be passed to `resegment`. This can't be used with `lookahead_ms`.
+        :param progress: an optional callback, which is given a `progress.Progress` every so often as the track is
+            segmented.
+        :param cancel: an optional `progress.CancelToken`, checked while decoding and in the frame loop. Once it is
+            cancelled, any ffmpeg process is killed, the temporary files are deleted and `Cancelled` is raised.
         :return: a generator which yields pairs `(segment, audio)`. A segment is a tuple `(start, stop)`, where `start`
-            and `stop` are timestamps (in seconds) in the track. If `output_audio` is set, then `audio` will be a
-            `pydub.AudioSegment` containing the appropriate audio, extracted from the input track; otherwise, `audio`
-            will be `None`.
+            and `stop` are timestamps (in seconds) in the track. If `output_audio` is set, then `audio` will be an
+            `AudioSlice` over that part of the original input track. It records where the segment is, and is only
+            read when you call its `read`, `as_numpy` or `export` method; otherwise, `audio` will be `None`.
+        :raise Cancelled: if `cancel` was cancelled.
         :raise ConfigError: if invalid parameters have been specified for the `Segmenter`.
         :raise FileNotFoundError: if `audio_fpath` doesn't exist.
         :raise FormatError: if the format of the file at `audio_fpath` isn't supported.
         :raise TypeError: if arguments of the wrong type have been passed to this function.
         """
+        return self._segment_stream(audio_fpath, output_audio, index_fpath, progress=progress, cancel=cancel)
 
-        # Preprocess the audio so we can send it to VAD. This usually tarnishes the quality, so keep the original
-        # around so at the end we can extract the segments from it and retain their quality.
-        og_audio = open_audio(audio_fpath)
-        audio = self._preprocess_audio(og_audio)
+    def _segment_stream(self, audio_fpath, output_audio=False, index_fpath=None, tuning=None, progress=None,
+                        cancel=None):
+        """
+        Does the work of `segment_stream`. If `auto_tune` is set and a `tuning` dict is given, the parameters chosen
+        for the track are put into it once the first segment has been asked for.
+        """
+        if index_fpath is not None and self.lookahead_ms is not None:
+            raise ConfigError("An index can't be written when lookahead_ms is set.")
+        if index_fpath is not None and self.hop_ms is not None:
+            raise ConfigError("An index can't be written when hop_ms is set.")
+
+        # Preprocess the audio so we can send it to VAD. This usually tarnishes the quality, but slicing `og_audio`
+        # always refers back to the original file, so the segments retain their quality.
+        og_audio = open_audio(audio_fpath, decoder=self.decoder, keep_source=output_audio)
+        try:
+            if self._can_pipe(og_audio, output_audio, index_fpath, progress):
+                for segment in self._piped_segments(og_audio, cancel):
+                    yield segment, None
+                return
+
+            audio = self._preprocess_audio(og_audio, cancel=cancel)
+
+            segmenter = self
+            if self.auto_tune:
+                chosen = self._tune(audio)
+                if tuning is not None:
+                    tuning.update(chosen)
+                segmenter = self._tuned(chosen)
+
+            for segment in segmenter._segments(audio, index_fpath, self._tracker(audio, progress, cancel)):
+                if not output_audio:
+                    yield segment, None
+                else:
+                    yield segment, og_audio[segment[0] * 1000: segment[1] * 1000]
+        except Cancelled:
+            og_audio.close()
+            raise
+        finally:
+            # Audio handed in by the caller is theirs to close. The slices already yielded still need a saved stream.
+            if og_audio is not audio_fpath:
+                og_audio.close(keep_source=output_audio)
+
+    def _can_pipe(self, audio, output_audio, index_fpath, progress):
+        """
+        Whether `audio` can be segmented from ffmpeg's output as it is decoded, by `_piped_segments`. Only a stream
+        which hasn't been read yet is, and only when nothing needs the whole decoded track: not the audio of the
+        segments, an index, progress reports (whose total isn't known), auto-tuning, hysteresis, refinement or
+        captioning.
+        """
+        return (audio._unread_stream() is not None and not output_audio and index_fpath is None and progress is None
+                and not self.auto_tune and self.lookahead_ms is None and self.refine_hop_ms is None
+                and self.caption_threshold is None)
 
-        # Set up the VAD, frame generator, and segment generator. Wrap with captioning, if that option has been set.
-        frames = _frame_generator(self.frame_duration_ms, audio)
-        vad = webrtcvad.Vad(self.aggression)
-        segments = self._vad_collector(audio.frame_rate, vad, frames)
-        if self.caption_threshold is not None:
-            segments = self._caption_generator(segments, audio.duration_milliseconds)
-            if self.min_caption_len_ms is not None:
-                segments = self._caption_merger(segments)
+    def _piped_segments(self, audio, cancel=None):
+        """
+        Segment an unread stream as ffmpeg decodes it. Frames go to the collector a block at a time straight from
+        ffmpeg's stdout, so the first segments are found while the stream is still arriving, and no temporary wav is
+        written. The segments are the same as those `_native_vad_collector` finds in the decoded track. Once the
+        stream has been read, its length is recorded on `audio`.
+
+        :param audio: an `AudioSegment` over a stream which hasn't been read yet.
+        :param cancel: an optional `CancelToken`.
+        :return: a generator that yields `(start, end)` tuples.
+        :raise Cancelled: if `cancel` was cancelled.
+        :raise FormatError: if ffmpeg couldn't decode the stream. Segments found before it failed have already been
+            yielded.
+        """
+        frame_rate, filters = self._target_format(audio.frame_rate)
+        frame_samples = int(frame_rate * self.frame_duration_ms / 1000)
+        hop_samples = int(frame_rate * self._hop_s + 0.5)
+        step_s = self._hop_s
+        collector = self._new_collector(_Vad(self.aggression), frame_rate, 2 * frame_samples, 2 * hop_samples)
+
+        pipe = audio.open_pcm(1, frame_rate, list(filters) if filters else None, cancel)
+        try:
+            for pcm, block in self._read_pipe_blocks(pipe, frame_samples, hop_samples):
+                for start, end in collector.feed(pcm, block):
+                    yield round(start * step_s, 3), round(end * step_s, 3)
+            pipe.finish()
+        finally:
+            pipe.close()
+            audio.stream.close()
+        audio.set_decoded_length(pipe.bytes_read // 2, frame_rate)
+        for start, end in collector.finish():
+            yield round(start * step_s, 3), round(end * step_s, 3)
+
+    def _read_pipe_blocks(self, pipe, frame_samples, hop_samples):
+        """
+        Like `_read_blocks`, but for mono PCM whose length isn't known until it runs out. Each block is
+        `_PIPE_BLOCK_FRAMES` frames, except the last, which holds every whole frame that is left, as counted by
+        `_count_frames`.
 
-        for segment in segments:
-            if not output_audio:
-                yield segment, None
-            else:
-                yield segment, og_audio[segment[0] * 1000: segment[1] * 1000]
+        :return: a generator of `(pcm, block)` pairs, where `block` is the number of frames starting in `pcm`.
+        """
+        overlap_bytes = 2 * (frame_samples - hop_samples)
+        block_bytes = 2 * _PIPE_BLOCK_FRAMES * hop_samples
+        carry = pipe.read(overlap_bytes) if overlap_bytes else b""
+        while True:
+            data = pipe.read(block_bytes)
+            pcm = carry + data
+            if len(data) < block_bytes:
+                block = _count_frames(len(pcm) // 2, frame_samples, hop_samples)
+                if block > 0:
+                    yield pcm, block
+                return
+            yield pcm, _PIPE_BLOCK_FRAMES
+            carry = pcm[len(pcm) - overlap_bytes:] if overlap_bytes else b""
+
+    def _tracker(self, audio, progress, cancel):
+        """ Make a `_Tracker` for segmenting the preprocessed `audio`, or `None` if nothing needs one. """
+        if progress is None and cancel is None:
+            return None
+        _, hop_samples, total = self._frame_layout(audio)
+        num_samples = audio.get_wave_reader().getnframes()
+        return _Tracker(total, hop_samples / float(audio.frame_rate), num_samples / float(audio.frame_rate),
+                        progress, cancel)
+
+    def _segments(self, audio, index_fpath=None, tracker=None):
+        """ Segment a preprocessed track, yielding `(start, end)` tuples. `tracker` is updated from the frame loop. """
+
+        # Set up the VAD, frame generator, and segment generator. Use the compiled collector if it has been built.
+        # Wrap with captioning, if that option has been set.
+        vad = _Vad(self.aggression)
+        if self.lookahead_ms is not None:
+            frames = _frame_generator(self.frame_duration_ms, audio)
+            segments = self._hysteresis_collector(audio.frame_rate, vad, tracker.frames(frames) if tracker else frames)
+        elif index_fpath is not None:
+            segments = self._indexed_vad_collector(audio, vad, index_fpath, tracker)
+        elif self.hop_ms is not None or (self.native and _direct_vad):
+            segments = self._native_vad_collector(audio, vad, tracker)
+        else:
+            frames = _frame_generator(self.frame_duration_ms, audio)
+            segments = self._vad_collector(audio.frame_rate, vad, tracker.frames(frames) if tracker else frames)
+        if self.refine_hop_ms is not None:
+            segments = self._refined(segments, audio)
+        return self._captioned(segments, audio.duration_milliseconds)
+
+    def resegment(self, index_path):
+        """
+        Segment a track again from the VAD decisions saved in its `SegmentIndex`, without decoding the audio. This is
+        much faster than `segment_stream`, so it suits trying out different buffer and threshold settings. The
+        segments are the same as `segment_stream` would give, as long as the audio was preprocessed the same way.
+
+        :param index_path: location of an index written by `segment_audio` or `segment_stream`.
+        :return: a generator which yields `(start, end)` tuples.
+        :raise ConfigError: if this `Segmenter` uses `lookahead_ms`, `auto_tune`, `hop_ms` or `refine_hop_ms`, or a
+            different `frame_duration_ms` or `aggression` from the one which wrote the index.
+        :raise FormatError: if the file at `index_path` isn't an index.
+        """
+        if self.lookahead_ms is not None:
+            raise ConfigError("resegment doesn't support lookahead_ms.")
+        if self.refine_hop_ms is not None:
+            raise ConfigError("resegment doesn't support refine_hop_ms, which needs the audio.")
+        index = self._open_index(index_path, "resegment")
+
+        def segments():
+            step_s = self.frame_duration_ms / 1000.0
+            collector = _PyCollector(None, None, index.sample_rate, 0,
+                                     int(self.buffer_length_ms / self.frame_duration_ms),
+                                     int(self.threshold_voice_ms / self.frame_duration_ms),
+                                     int(self.threshold_silence_ms / self.frame_duration_ms))
+            try:
+                for start in range(0, index.num_frames, _NATIVE_BLOCK_FRAMES):
+                    flags = index.flags[start:start + _NATIVE_BLOCK_FRAMES]
+                    boundaries = collector.feed_flags(flags)
+                    flags.release()
+                    for seg_start, seg_end in boundaries:
+                        yield round(seg_start * step_s, 3), round(seg_end * step_s, 3)
+                for seg_start, seg_end in collector.finish():
+                    yield round(seg_start * step_s, 3), round(seg_end * step_s, 3)
+            finally:
+                index.close()
+
+        return self._captioned(segments(), index.duration_seconds * 1000)
+
+    def _open_index(self, index_path, caller):
+        """
+        Open a `SegmentIndex`, checking that its VAD decisions are the ones this `Segmenter` would make.
+
+        :raise ConfigError: if `auto_tune` is set, or the index was made with a different `frame_duration_ms` or
+            `aggression`.
+        """
+        if self.auto_tune:
+            raise ConfigError("{} doesn't support auto_tune. Use the parameters saved in `segments.json`."
+                              .format(caller))
+        if self.hop_ms is not None:
+            raise ConfigError("{} can't use an index when hop_ms is set, as the index has one frame per "
+                              "frame_duration_ms.".format(caller))
+        index = SegmentIndex(index_path)
+        if index.frame_duration_ms != self.frame_duration_ms or index.aggression != self.aggression:
+            index.close()
+            raise ConfigError("The index at `{}` was made with frame_duration_ms {} and aggression {}, but this "
+                              "Segmenter has {} and {}.".format(index_path, index.frame_duration_ms, index.aggression,
+                                                                self.frame_duration_ms, self.aggression))
+        return index
+
+    def speech_flags(self, audio_fpath, packed=False):
+        """
+        Get the voice-activity detector's decision for every frame of a track, rather than the segments made from
+        them. The track is read a block at a time and each block is run through the detector in one call, without
+        the ring buffer. Requires numpy.
+
+        :param audio_fpath: location of the audio, a URL, or a file-like object. The path of a `SegmentIndex` (ending
+            in `.wkix`) can be given instead, in which case its saved decisions are returned without decoding anything.
+        :param packed: if set, the flags are packed eight to a byte with `numpy.packbits`.
+        :return: a tuple `(flags, hop_s)`. `flags` is a `numpy.bool_` array with one entry per frame, or a `uint8`
+            array if `packed` is set. Frame `i` starts `i * hop_s` seconds into the track, on the same timeline as
+            the segments from `segment_stream`.
+        :raise ConfigError: if an index was made with a different `frame_duration_ms` or `aggression`.
+        :raise FormatError: if the audio can't be decoded.
+        :raise ImportError: if numpy isn't installed.
+        """
+        np = _import_numpy("speech_flags")
+
+        if is_local_path(audio_fpath) and audio_fpath.endswith(path.splitext(INDEX_FNAME)[1]):
+            index = self._open_index(audio_fpath, "speech_flags")
+            try:
+                flags = np.frombuffer(index.flags, dtype=np.uint8).copy()
+            finally:
+                index.close()
+        else:
+            og_audio = open_audio(audio_fpath, decoder=self.decoder)
+            try:
+                audio = self._preprocess_audio(og_audio)
+                segmenter = self._tuned(self._tune(audio)) if self.auto_tune else self
+                frame_samples, hop_samples, total = segmenter._frame_layout(audio)
+                collector = segmenter._new_collector(_Vad(segmenter.aggression), audio.frame_rate,
+                                                     frame_samples * audio.sample_width,
+                                                     hop_samples * audio.sample_width)
+                flags = np.empty(total, dtype=np.uint8)
+                start = 0
+                for pcm, block in segmenter._read_blocks(audio.get_wave_reader(), frame_samples, hop_samples,
+                                                         total):
+                    flags[start:start + block] = np.frombuffer(collector.speech_flags(pcm, block), dtype=np.uint8)
+                    start += block
+            finally:
+                og_audio.close()
+
+        return (np.packbits(flags) if packed else flags.view(np.bool_)), self._hop_s
+
+    def segment_channels(self, audio_fpath, output_audio=False, progress=None, cancel=None):
+        """
+        Segment each channel of the audio at `audio_fpath` separately, rather than mixing them down to mono first.
+        This suits recordings with a microphone per speaker.
+
+        The audio is decoded once, keeping its channels, and read a block at a time. Each block is split into its
+        channels, and every channel is fed to its own collector, so the channels are segmented side by side in a
+        single pass through the file. Captioning and `lookahead_ms` don't apply here.
+
+        :param audio_fpath: location of the audio to segment. This can also be a URL or a file-like object, which
+            is streamed; see `open_audio`.
+        :param output_audio: whether or not each segment should come with an `AudioSlice` handle on its channel's
+            audio.
+        :param progress: an optional progress callback, as for `segment_stream`.
+        :param cancel: an optional `progress.CancelToken`, as for `segment_stream`.
+        :return: a generator which yields triples `(channel, segment, audio)`, where `channel` counts from 0 and the
+            rest are as for `segment_stream`. Within a channel, segments come in order; segments from different
+            channels are yielded roughly in the order they end. Pass `(channel, segment)` pairs to `merge_channels`
+            to get a single timeline.
+        :raise Cancelled: if `cancel` was cancelled.
+        :raise ConfigError: if `lookahead_ms`, `auto_tune`, `hop_ms` or `refine_hop_ms` is set.
+        :raise FileNotFoundError: if `audio_fpath` doesn't exist.
+        :raise FormatError: if the format of the file at `audio_fpath` isn't supported.
+        """
+        if self.lookahead_ms is not None:
+            raise ConfigError("segment_channels doesn't support lookahead_ms.")
+        if self.auto_tune:
+            raise ConfigError("segment_channels doesn't support auto_tune.")
+        if self.hop_ms is not None or self.refine_hop_ms is not None:
+            raise ConfigError("segment_channels doesn't support hop_ms or refine_hop_ms.")
+        if is_local_path(audio_fpath) and not path.exists(audio_fpath):
+            raise FileNotFoundError("Input file `{}` doesn't exist.".format(audio_fpath))
 
-    def segment_audio(self, audio_fpath, output_dir, output_audio=True, verbose=True):
+        og_audio = open_audio(audio_fpath, decoder=self.decoder, keep_source=output_audio)
+        try:
+            for item in self._segment_channels(og_audio, output_audio, progress, cancel):
+                yield item
+        except Cancelled:
+            og_audio.close()
+            raise
+        finally:
+            if og_audio is not audio_fpath:
+                og_audio.close(keep_source=output_audio)
+
+    def _segment_channels(self, og_audio, output_audio, progress, cancel):
+        """ Does the work of `segment_channels`, once the audio has been opened. """
+        audio = self._preprocess_audio(og_audio, channels=None, cancel=cancel)
+        num_channels = audio.channels
+        tracker = self._tracker(audio, progress, cancel)
+
+        wave_reader = audio.get_wave_reader()
+        num_frames, _, remaining = self._frame_layout(audio)
+        frame_bytes = num_frames * audio.sample_width
+        step_s = self.frame_duration_ms / 1000.0
+
+        # webrtcvad detectors keep state between frames, so each channel needs its own.
+        vads = [_Vad(self.aggression) for _ in range(num_channels)]
+        collectors = [self._new_collector(vad, audio.frame_rate, frame_bytes) for vad in vads]
+
+        def tagged(channel, boundaries):
+            for start, end in boundaries:
+                segment = round(start * step_s, 3), round(end * step_s, 3)
+                if output_audio:
+                    audio_slice = og_audio[segment[0] * 1000: segment[1] * 1000]
+                    audio_slice.channel = channel
+                    yield channel, segment, audio_slice
+                else:
+                    yield channel, segment, None
+
+        while remaining > 0:
+            block = min(remaining, _NATIVE_BLOCK_FRAMES)
+            samples = array.array("h", wave_reader.readframes(block * num_frames))
+            finished = []
+            for channel, collector in enumerate(collectors):
+                pcm = samples[channel::num_channels].tobytes()
+                finished.extend(tagged(channel, collector.feed(pcm, block)))
+            for item in sorted(finished, key=lambda item: item[1]):
+                yield item
+            remaining -= block
+            if tracker is not None:
+                tracker.update(tracker.total_frames - remaining)
+
+        finished = []
+        for channel, collector in enumerate(collectors):
+            finished.extend(tagged(channel, collector.finish()))
+        for item in sorted(finished, key=lambda item: item[1]):
+            yield item
+
+    def pack_stream(self, audio_fpath, max_chunk_s=30.0, batch_size=8, frame_rate=16000):
+        """
+        Segment a track and pack the segments into chunks for batched speech recognition. Consecutive segments are
+        packed greedily into chunks lasting no longer than `max_chunk_s`, from the start of their first segment to the
+        end of their last. A segment longer than that on its own is split at its quietest frame. The audio of each
+        chunk is read once, mixed down to mono at `frame_rate`. Requires numpy.
+
+        :param audio_fpath: location of the audio, a URL, or a file-like object.
+        :param max_chunk_s: the longest a chunk may be, in seconds.
+        :param batch_size: how many chunks to yield at a time.
+        :param frame_rate: sample rate of the PCM in each chunk.
+        :return: a generator of lists of up to `batch_size` `(boundaries, pcm)` tuples. `boundaries` is a list of the
+            `(start, end)` segments in the chunk, in seconds from the start of the track, and `pcm` is a 1-D `int16`
+            numpy array of the audio from the start of the first segment to the end of the last.
+        :raise ConfigError: if `max_chunk_s` is shorter than two frames, or `batch_size` is less than 1.
+        :raise ImportError: if numpy isn't installed.
+        """
+        if max_chunk_s * 1000 < 2 * self.frame_duration_ms:
+            raise ConfigError("max_chunk_s must be at least two frames long, but it is `{}`".format(max_chunk_s))
+        if batch_size < 1:
+            raise ConfigError("batch_size must be at least 1, but it is `{}`".format(batch_size))
+
+        _import_numpy("pack_stream")
+
+        og_audio = open_audio(audio_fpath, decoder=self.decoder, keep_source=True)
+        audio = None
+        energy_reader = None
+        try:
+            audio = self._preprocess_audio(og_audio)
+            segmenter = self._tuned(self._tune(audio)) if self.auto_tune else self
+
+            # The quietest frames are found in the preprocessed audio, with a reader of its own so as not to disturb
+            # the one the collector is using.
+            energy_reader = wave.open(audio.get_file_path(), "rb")
+            pieces = self._split_long(segmenter._segments(audio), energy_reader, max_chunk_s)
+            batch = []
+            for boundaries in _pack(pieces, max_chunk_s):
+                chunk = og_audio[boundaries[0][0] * 1000: boundaries[-1][1] * 1000]
+                batch.append((boundaries, chunk.as_numpy(channels=1, frame_rate=frame_rate)[:, 0]))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            if energy_reader is not None:
+                energy_reader.close()
+            if audio is not None:
+                audio.close()
+            og_audio.close()
+
+    def _split_long(self, segments, reader, max_chunk_s):
+        """
+        Split any segment longer than `max_chunk_s` at the frame with the least energy, looking in the second half of
+        the longest piece allowed so that no piece is very short.
+
+        :param segments: an iterable of `(start, end)` tuples.
+        :param reader: a `wave` reader on the preprocessed audio.
+        :param max_chunk_s: the longest a piece may be, in seconds.
+        :return: a generator of `(start, end)` tuples.
+        """
+        frame_s = self.frame_duration_ms / 1000.0
+        frame_samples = int(reader.getframerate() * frame_s)
+        for start, end in segments:
+            while end - start > max_chunk_s:
+                window_start = start + max_chunk_s / 2.0
+                num_frames = int((max_chunk_s / 2.0) / frame_s)
+                reader.setpos(min(int(round(window_start * reader.getframerate())), reader.getnframes()))
+                pcm = array.array("h", reader.readframes(num_frames * frame_samples))
+                energies = [sum(map(operator.mul, pcm[i:i + frame_samples], pcm[i:i + frame_samples]))
+                            for i in range(0, len(pcm) - frame_samples + 1, frame_samples)]
+                if energies:
+                    quietest = energies.index(min(energies))
+                    split = round(window_start + (quietest + 0.5) * frame_s, 3)
+                else:
+                    split = round(start + max_chunk_s, 3)
+                yield start, split
+                start = split
+            yield start, end
+
+    def segment_audio(self, audio_fpath, output_dir, output_audio=True, verbose=True, per_channel=False,
+                      write_index=False, audio_format="wav", archive=None, progress=None, cancel=None):
         """
         Segments the audio at the given filepath.
 
-        :param audio_fpath: location of the audio to segment.
+        :param audio_fpath: location of the audio to segment. This can also be a URL or a file-like object, which
+            is streamed; see `open_audio`.
         :param output_dir: directory where the segmentation tracks and data should be output.
         :param output_audio: if set, the segments will be extracted from the audio and saved separately.
         :param verbose: if set, this function will print to stdout.
-        :return: `None`
+        :param per_channel: if set, each channel is segmented separately with `segment_channels`. Every segment in
+            the JSON gets a `channel`, and a `merged` list gives the combined timeline from `merge_channels`.
+        :param write_index: if set, a `SegmentIndex` is saved next to `segments.json`, as `segments.wkix`. It can be
+            passed to `resegment`, or used to draw a waveform of the track. This can't be used with `per_channel` or
+            `lookahead_ms`.
+        :param audio_format: the format to save segments in: `"wav"`, or one of `export.EXPORT_FORMATS` (`"flac"` or
+            `"opus"`). Compressed segments are all encoded by a single ffmpeg process once the track has been
+            segmented, and are padded with up to 20ms of silence.
+        :param archive: if set to one of `export.ARCHIVE_FORMATS` (`"tar"` or `"zip"`), `segments.json` and the
+            segments' audio are packed into a single `segments.tar` or `segments.zip` in `output_dir`, instead of
+            being left as separate files.
+        :param progress: an optional progress callback, as for `segment_stream`.
+        :param cancel: an optional `progress.CancelToken`, as for `segment_stream`. It is also checked between
+            segments as their audio is saved. Files already written to `output_dir` are left there.
+        :return: `None`. If `auto_tune` is set, the parameters chosen for the track are saved in the JSON under
+            `auto_tune`.
+        :raise Cancelled: if `cancel` was cancelled.
         :raise ConfigError: if invalid parameters have been specified for the `Segmenter`.
         :raise FileNotFoundError: if `audio_fpath` or `output_dir` don't exist.
         :raise FormatError: if the format of the file at `audio_fpath` isn't supported.
@@ -402,32 +1567,173 @@ class Segmenter(object):
             raise TypeError("Output directory must be a `str`, but it's a `{}`".format(type(output_dir)))
         if not path.exists(output_dir):
             raise FileNotFoundError("Output directory `{}` doesn't exist.".format(output_dir))
-        if not path.exists(audio_fpath):
+        if is_local_path(audio_fpath) and not path.exists(audio_fpath):
             raise FileNotFoundError("Input file `{}` doesn't exist.".format(audio_fpath))
         if type(output_audio) is not bool:
             raise TypeError("`output_audio` flag must be a `bool`, but it's a `{}`".format(type(output_audio)))
         if type(verbose) is not bool:
             raise TypeError("`verbose` flag must be a `bool`, but it's a `{}`".format(type(verbose)))
 
-        stream = self.segment_stream(audio_fpath, output_audio)
-
-        seg_data = _SegData(audio_fpath)
-        for i, (seg, audio) in enumerate(stream):
-            additional_kvs = {}
-            if output_audio:
-                fname = "seg-%005d.wav" % i
-                output_fpath = path.join(output_dir, fname)
+        if write_index and per_channel:
+            raise ConfigError("An index can't be written when per_channel is set.")
+        if audio_format != "wav" and audio_format not in EXPORT_FORMATS:
+            raise ConfigError("audio_format must be `wav` or one of {}, but it is `{}`"
+                              .format(EXPORT_FORMATS, audio_format))
+        if archive is not None and archive not in ARCHIVE_FORMATS:
+            raise ConfigError("archive must be one of {}, but it is `{}`".format(ARCHIVE_FORMATS, archive))
+
+        # The audio is opened once here and handed on, so that a URL or stream is only read once.
+        source = open_audio(audio_fpath, decoder=self.decoder, keep_source=output_audio)
+        tuning = collections.OrderedDict()
+        if per_channel:
+            stream = ((seg, audio, {"channel": channel})
+                      for channel, seg, audio in self.segment_channels(source, output_audio, progress, cancel))
+        else:
+            index_fpath = path.join(output_dir, INDEX_FNAME) if write_index else None
+            stream = ((seg, audio, {})
+                      for seg, audio in self._segment_stream(source, output_audio, index_fpath, tuning, progress,
+                                                             cancel))
+
+        seg_data = _SegData(source.base_name, duration_seconds=0.0)
+        try:
+            for i, (seg, audio, additional_kvs) in enumerate(stream):
+                if cancel is not None:
+                    cancel.check()
+                if output_audio:
+                    fname = "seg-%005d.%s" % (i, audio_format)
+                    if audio_format == "wav":
+                        output_fpath = path.join(output_dir, fname)
+                        if verbose:
+                            print("Writing {}".format(output_fpath))
+                        audio.export(output_fpath, format="wav")
+                    additional_kvs["fname"] = fname
+                start, end = seg
+                seg_data.add(start, end, additional_kvs)
+
+            if output_audio and audio_format != "wav":
+                encode_segments(self._saved_slices(source, seg_data), output_dir, audio_format, verbose=verbose,
+                                cancel=cancel)
+
+            if per_channel:
+                merged = merge_channels((seg["channel"], (seg["start"], seg["end"])) for seg in seg_data.segments)
+                seg_data.kvs["merged"] = [{"start": start, "end": end, "channels": channels}
+                                          for start, end, channels in merged]
+            # A stream's duration is only known once it has been decoded.
+            seg_data.duration_seconds = round(source.source_duration_ms / 1000.0, 3)
+            if tuning:
+                seg_data.kvs["auto_tune"] = tuning
+
+            seg_data.save_to_file(
+                output_fpath=path.join(output_dir, "segments.json"),
+                verbose=verbose,
+            )
+
+            if archive is not None:
+                fnames = ["segments.json"] + ([seg["fname"] for seg in seg_data.segments] if output_audio else [])
+                archive_fpath = write_archive(output_dir, fnames, archive)
                 if verbose:
-                    print("Writing {}".format(output_fpath))
-                audio.export(output_fpath, format="wav").close()  # export returns an open file handle
-                additional_kvs["fname"] = fname
-            start, end = seg
-            seg_data.add(start, end, additional_kvs)
-
-        seg_data.save_to_file(
-            output_fpath=path.join(output_dir, "segments.json"),
-            verbose=verbose,
-        )
+                    print("Writing {}".format(archive_fpath))
+        except Cancelled:
+            source.close()
+            raise
+        finally:
+            seg_data.close()
+            if source is not audio_fpath:
+                source.close()
+
+    def segment_batch(self, audio_fpaths, output_dir, output_audio=False, verbose=True, dedupe=True):
+        """
+        Segment many files, each into a directory of its own under `output_dir`, named after the file.
+
+        With `dedupe` set, each file is fingerprinted from the PCM of its preprocessing transcode, which has to be done
+        anyway. Only the first file with a given fingerprint is segmented; for the rest, that file's segments are
+        copied into their own `segments.json`, with their own `track_name` and a `duplicate_of` naming the file
+        the segments came from. Re-uploads of the same recording under another name or in another lossless
+        container are therefore only segmented once. With `output_audio`, every file's segments are still cut from its
+        own source.
+
+        :param audio_fpaths: locations of the audio files to segment. They must all have different names.
+        :param output_dir: directory in which to make a directory for each file.
+        :param output_audio: if set, the segments will be extracted from the audio and saved separately.
+        :param verbose: if set, this function will print to stdout.
+        :param dedupe: if set, files with identical audio are only segmented once.
+        :return: a list of groups of files with identical audio, each a list of paths in the order given. Without
+            `dedupe`, every file is in a group of its own.
+        :raise ConfigError: if two files have the same name.
+        :raise FileNotFoundError: if a file or `output_dir` doesn't exist.
+        :raise FormatError: if the format of a file isn't supported.
+        """
+        audio_fpaths = list(audio_fpaths)
+        names = [path.basename(fpath) for fpath in audio_fpaths]
+        if len(set(names)) != len(names):
+            raise ConfigError("Every file in a batch must have a different name.")
+        if not path.exists(output_dir):
+            raise FileNotFoundError("Output directory `{}` doesn't exist.".format(output_dir))
+
+        groups = collections.OrderedDict()  # maps fingerprints to the files that have them
+        for fpath, name in zip(audio_fpaths, names):
+            track_dir = path.join(output_dir, name)
+            made_dir = False
+            source = None
+            try:
+                if dedupe:
+                    source = open_audio(fpath, decoder=self.decoder, keep_source=output_audio)
+                    fingerprint = _fingerprint(self._preprocess_audio(source))
+                if not path.exists(track_dir):
+                    os.mkdir(track_dir)
+                    made_dir = True
+
+                if not dedupe:
+                    self.segment_audio(fpath, track_dir, output_audio=output_audio, verbose=verbose)
+                    groups[len(groups)] = [fpath]
+                elif fingerprint in groups:
+                    first = path.join(output_dir, path.basename(groups[fingerprint][0]))
+                    self._copy_segments(first, source, track_dir, output_audio, verbose)
+                    groups[fingerprint].append(fpath)
+                else:
+                    self.segment_audio(source, track_dir, output_audio=output_audio, verbose=verbose)
+                    groups[fingerprint] = [fpath]
+            except BaseException:
+                # A file which fails shouldn't leave an empty or half-written directory behind.
+                if made_dir:
+                    shutil.rmtree(track_dir, ignore_errors=True)
+                raise
+            finally:
+                if source is not None:
+                    source.close()
+        return list(groups.values())
+
+    def _copy_segments(self, first_dir, source, output_dir, output_audio, verbose):
+        """
+        Give `source` the segments already found for a track with identical audio, whose results are in `first_dir`.
+        """
+        with open(path.join(first_dir, "segments.json")) as f:
+            first = json.load(f, object_pairs_hook=collections.OrderedDict)
+
+        seg_data = _SegData(source.base_name, duration_seconds=source.source_duration_ms / 1000.0)
+        try:
+            for key, value in first.items():
+                if key not in ("track_duration", "num_segments", "track_name", "segments"):
+                    seg_data.kvs[key] = value
+            seg_data.kvs["duplicate_of"] = first["track_name"]
+            for seg in first["segments"]:
+                additional_kvs = collections.OrderedDict((k, v) for k, v in seg.items() if k not in ("start", "end"))
+                if output_audio:
+                    output_fpath = path.join(output_dir, seg["fname"])
+                    if verbose:
+                        print("Writing {}".format(output_fpath))
+                    source[seg["start"] * 1000: seg["end"] * 1000].export(output_fpath, format="wav")
+                seg_data.add(seg["start"], seg["end"], additional_kvs)
+            seg_data.save_to_file(output_fpath=path.join(output_dir, "segments.json"), verbose=verbose)
+        finally:
+            seg_data.close()
+
+    def _saved_slices(self, source, seg_data):
+        """ Generate an `AudioSlice` for each segment saved in `seg_data`, in order. """
+        for seg in seg_data.segments:
+            audio_slice = source[seg["start"] * 1000: seg["end"] * 1000]
+            audio_slice.channel = seg.get("channel")
+            yield audio_slice
 
     def _caption_generator(self, segment_stream, track_length_ms):
 
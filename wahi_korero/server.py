@@ -0,0 +1,510 @@
+'''
+A small HTTP server which segments audio for programs that can't call `wahi_korero` directly.
+
+    POST /segment?aggression=2&format=mp3    with the audio as the request body
+    POST /segment                            with a JSON body `{"path": "/shared/audio.wav", "config": {...}}`,
+                                             and optionally `"stream": true`
+
+Both reply with the same JSON that `segment_audio` saves to `segments.json`. Query parameters (or `config`) override
+`DEFAULT_CONFIG`. Paths are only accepted if they are inside one of the server's `shared_roots`.
+
+Short clips are queued and sent to a pool of worker processes in batches, each of which keeps a warm `Segmenter` for
+every configuration it has seen, and a `DecoderPool` of waiting ffmpeg processes which they all share. Tracks longer than `stream_threshold_s` (or any track, with `?stream=1`) are
+segmented as they are read and the JSON is sent back in chunks, with `num_segments` at the end, or `error` if
+segmenting failed part way through.
+
+It can be run from the command line with `python3 -m wahi_korero.server --port 8080`.
+'''
+import argparse
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import logging
+import os
+from os import path
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+import time
+from urllib.parse import parse_qsl, urlparse
+from .decoder import DecoderPool
+from .exceptions import ConfigError, FormatError
+from .segment import DEFAULT_CONFIG, Segmenter, _SegData, warmup
+from .utils import CONTENT_TYPE_FORMATS, is_format_supported, open_audio
+
+_log = logging.getLogger(__name__)
+
+
+class _BadRequest(Exception):
+    """ Raised when a request can't be understood, to answer it with a 400. """
+    pass
+
+
+def _flag(value):
+    """ Read a boolean parameter, which may be a JSON `bool` or a query string value like `1` or `false`. """
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("1", "true", "yes"):
+        return True
+    if str(value).lower() in ("0", "false", "no", ""):
+        return False
+    raise ValueError(value)
+
+
+# Types of the parameters which can be passed to a `Segmenter` over HTTP.
+CONFIG_TYPES = {
+    "frame_duration_ms": int,
+    "threshold_silence_ms": int,
+    "threshold_voice_ms": int,
+    "buffer_length_ms": int,
+    "aggression": int,
+    "squash_rate": int,
+    "caption_threshold": float,
+    "min_caption_len_ms": float,
+    "lookahead_ms": int,
+    "onset_ratio": float,
+    "offset_ratio": float,
+    "auto_tune": _flag,
+    "hop_ms": int,
+    "refine_hop_ms": int,
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# How many times a batch is sent to the worker processes when one of them dies while it is being segmented. The pool
+# is restarted each time.
+MAX_ATTEMPTS = 2
+
+# Segmenters kept warm in each process, by configuration, and the `DecoderPool` they share.
+_segmenters = {}
+_decoder = None
+
+
+def _parse_config(params):
+    """
+    Turn request parameters into a complete `Segmenter` configuration.
+
+    :param params: a `dict` of parameter names to values, which may be strings.
+    :return: a `dict`.
+    :raise ConfigError: if a parameter is unknown or has the wrong type.
+    """
+    config = dict(DEFAULT_CONFIG)
+    for key, value in params.items():
+        if key not in CONFIG_TYPES:
+            raise ConfigError("Unknown parameter `{}`".format(key))
+        try:
+            config[key] = CONFIG_TYPES[key](value) if value is not None else None
+        except (TypeError, ValueError):
+            type_name = "bool" if CONFIG_TYPES[key] is _flag else CONFIG_TYPES[key].__name__
+            raise ConfigError("Parameter `{}` must be a `{}`, but it is `{}`".format(key, type_name, value))
+    return config
+
+
+def _warm_segmenter(config):
+    """
+    Get the `Segmenter` for a configuration, making it the first time it is asked for. It is given this process's
+    `DecoderPool`, whose ffmpeg processes are started straight away.
+    """
+    global _decoder
+    key = tuple(sorted(config.items()))
+    if key not in _segmenters:
+        if _decoder is None:
+            _decoder = DecoderPool()
+        segmenter = Segmenter(decoder=_decoder, **config)
+        warmup(segmenter)
+        _segmenters[key] = segmenter
+    return _segmenters[key]
+
+
+def _segment_to_json(config, fpath, track_name, duration):
+    """
+    Segment the file at `fpath`, returning the JSON that `segment_audio` would save. `duration` is the length of the
+    track in seconds, which the caller has already had to find out.
+    """
+    seg_data = _SegData(fpath, duration_seconds=duration)
+    seg_data.track_name = track_name
+    tuning = collections.OrderedDict()
+    for (start, end), _ in _warm_segmenter(config)._segment_stream(fpath, tuning=tuning):
+        seg_data.add(start, end)
+    if tuning:
+        seg_data.kvs["auto_tune"] = tuning
+    return seg_data.to_json()
+
+
+def _segment_batch(jobs):
+    """
+    Segment a batch of files in a worker process.
+
+    :param jobs: a list of `(config, fpath, track_name, duration)` tuples.
+    :return: a list with an `(ok, result)` pair for each job, where `result` is the JSON if `ok` is set and the
+        exception that was raised otherwise.
+    """
+    results = []
+    for config, fpath, track_name, duration in jobs:
+        try:
+            results.append((True, _segment_to_json(config, fpath, track_name, duration)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class _Batcher(object):
+    """
+    Gathers jobs submitted around the same time into batches and sends them to a pool of `workers` processes. If a
+    worker process dies, the pool is replaced with a new one.
+    """
+
+    def __init__(self, workers, batch_size, batch_window_s):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.batch_size = batch_size
+        self.batch_window_s = batch_window_s
+        self._executor_lock = threading.Lock()
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, config, fpath, track_name, duration):
+        """
+        Queue a job.
+
+        :return: a `Future` which resolves to the job's JSON.
+        """
+        future = Future()
+        self._queue.put(((config, fpath, track_name, duration), future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.batch_window_s
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # finish this batch, then stop
+                    break
+                batch.append(item)
+            self._send(batch)
+
+    def _restart(self, broken):
+        """ Replace the pool `broken`, unless another thread has already done so. """
+        with self._executor_lock:
+            if self.executor is broken:
+                _log.warning("A worker process died, so the pool is being restarted.")
+                broken.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def _send(self, batch, attempt=1):
+        futures = [future for _, future in batch]
+        jobs = [job for job, _ in batch]
+        executor = self.executor
+        try:
+            try:
+                batch_future = executor.submit(_segment_batch, jobs)
+            except BrokenProcessPool:
+                executor = self._restart(executor)
+                batch_future = executor.submit(_segment_batch, jobs)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        def distribute(batch_future):
+            error = batch_future.exception()
+            if isinstance(error, BrokenProcessPool) and attempt < MAX_ATTEMPTS:
+                self._restart(executor)
+                self._send(batch, attempt + 1)
+                return
+            if isinstance(error, BrokenProcessPool):
+                self._restart(executor)
+            for i, future in enumerate(futures):
+                if error is not None:
+                    future.set_exception(error)
+                elif batch_future.result()[i][0]:
+                    future.set_result(batch_future.result()[i][1])
+                else:
+                    future.set_exception(batch_future.result()[i][1])
+        batch_future.add_done_callback(distribute)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # needed for chunked responses and keep-alive
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self._responded = True
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self.close_connection = True  # the request body might not have been read
+        self._send_json(status, {"error": message})
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+
+    def _stream_json(self, segmenter, audio, track_name):
+        """
+        Segment the already opened `audio` in this thread, sending each segment back as soon as it is found.
+        """
+        duration = audio.duration_seconds
+        stream = segmenter.segment_stream(audio)
+        seg = next(stream, None)  # so that errors in preprocessing can still get a proper status code
+
+        self._responded = True
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._write_chunk('{{"track_duration": {}, "track_name": {}, "segments": ['
+                          .format(json.dumps(round(duration, 3)), json.dumps(track_name)))
+        num_segs = 0
+        try:
+            while seg is not None:
+                (start, end), _ = seg
+                self._write_chunk((", " if num_segs else "") + json.dumps({"start": start, "end": end}))
+                num_segs += 1
+                seg = next(stream, None)
+        except Exception as e:
+            # The status has already been sent, so the error goes in the body in place of `num_segments`, which
+            # tells the client that the segments are incomplete.
+            _log.exception("Segmenting `%s` failed part way through the response.", track_name)
+            self.close_connection = True
+            self._write_chunk('], "error": {}}}'.format(json.dumps(str(e))))
+        else:
+            self._write_chunk('], "num_segments": {}}}'.format(num_segs))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _read_body(self):
+        """ Read the whole request body, which is expected to be small. """
+        length = int(self.headers.get("Content-Length"))
+        body = self.rfile.read(length)
+        if len(body) < length:
+            raise _BadRequest("The body ended after {} of its {} bytes.".format(len(body), length))
+        return body
+
+    def _read_upload(self, fmt):
+        """ Save the request body to a temporary file, a chunk at a time. """
+        length = int(self.headers.get("Content-Length"))
+        fd, fpath = tempfile.mkstemp(suffix="." + fmt)
+        remaining = length
+        with os.fdopen(fd, "wb") as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining > 0:
+            # The client went away part way through, so what we have is only part of the file.
+            os.remove(fpath)
+            raise _BadRequest("The body ended after {} of its {} bytes.".format(length - remaining, length))
+        return fpath
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/segment":
+            self._send_error(404, "Unknown endpoint `{}`".format(url.path))
+            return
+        if self.headers.get("Content-Length") is None:
+            self._send_error(411, "A Content-Length header is required.")
+            return
+        if not self.headers.get("Content-Length").isdigit():
+            self._send_error(400, "Content-Length must be a whole number of bytes.")
+            return
+
+        params = dict(parse_qsl(url.query))
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        tmp_fpath = None
+        self._responded = False
+        try:
+            if content_type == "application/json":
+                try:
+                    body = json.loads(self._read_body().decode("utf-8"))
+                except ValueError as e:
+                    raise _BadRequest("The body isn't valid JSON: {}".format(e))
+                if not isinstance(body, dict):
+                    raise _BadRequest("The JSON body must be an object.")
+                config = body.get("config", {})
+                if not isinstance(config, dict):
+                    raise _BadRequest("`config` must be an object.")
+                if not body.get("path") or not isinstance(body["path"], str):
+                    raise _BadRequest("JSON requests must have a `path`, as a string.")
+                fpath = self.server.check_shared_path(body["path"])
+                params.update(config)
+                if "stream" in body:
+                    params["stream"] = body["stream"]
+                track_name = path.basename(fpath)
+            else:
+                fmt = params.pop("format", None) or CONTENT_TYPE_FORMATS.get(content_type, "wav")
+                if not is_format_supported(fmt):
+                    raise FormatError("File format {} not supported".format(fmt))
+                fpath = tmp_fpath = self._read_upload(fmt.lstrip(".").lower())
+                track_name = params.pop("name", path.basename(fpath))
+            try:
+                stream = _flag(params.pop("stream", False))
+            except ValueError as e:
+                raise _BadRequest("Parameter `stream` must be a `bool`, but it is `{}`".format(e))
+            config = _parse_config(params)
+            segmenter = self.server.warm_segmenter(config)  # bad configurations raise `ConfigError` here, for a 400
+
+            # The file is only probed here. A streamed track is segmented from this same `AudioSegment`, and a
+            # batched one is sent off with its duration.
+            audio = open_audio(fpath, decoder=segmenter.decoder)
+            try:
+                if stream or audio.duration_seconds > self.server.stream_threshold_s:
+                    self._stream_json(segmenter, audio, track_name)
+                else:
+                    future = self.server.batcher.submit(config, fpath, track_name, audio.duration_seconds)
+                    self._send_json(200, future.result())
+            finally:
+                audio.close()
+        except (_BadRequest, ConfigError) as e:
+            self._send_error(400, str(e))
+        except PermissionError as e:
+            self._send_error(403, str(e))
+        except FileNotFoundError as e:
+            self._send_error(404, str(e))
+        except FormatError as e:
+            self._send_error(415, str(e))
+        except Exception as e:
+            _log.exception("Couldn't segment the audio for %s.", self.path)
+            if self._responded:
+                self.close_connection = True  # the response can't be finished properly
+            else:
+                self._send_error(500, "{}: {}".format(type(e).__name__, e))
+        finally:
+            if tmp_fpath is not None:
+                os.remove(tmp_fpath)
+
+
+class SegmentationServer(ThreadingHTTPServer):
+    """
+    An HTTP server which segments audio. See the module documentation for the API.
+
+    :param host: address to listen on. Defaults to localhost only.
+    :param port: port to listen on. If 0, a free port is chosen; see `port`.
+    :param workers: number of worker processes for short clips.
+    :param batch_size: the most jobs sent to a worker at once.
+    :param batch_window_ms: how long to wait for more jobs to join a batch.
+    :param stream_threshold_s: tracks longer than this are streamed back in chunks.
+    :param shared_roots: directories which clients may ask for files from by path.
+    :param verbose: if set, requests are logged to stderr.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, workers=None, batch_size=16, batch_window_ms=2,
+                 stream_threshold_s=60, shared_roots=(), verbose=False):
+        ThreadingHTTPServer.__init__(self, (host, port), _RequestHandler)
+        self.stream_threshold_s = stream_threshold_s
+        self.shared_roots = [path.realpath(root) for root in shared_roots]
+        self.verbose = verbose
+        self.batcher = _Batcher(workers or os.cpu_count() or 1, batch_size, batch_window_ms / 1000.0)
+        self._segmenters_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def executor(self):
+        """ The pool of worker processes. It is replaced if one of its processes dies. """
+        return self.batcher.executor
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(self.server_address[0], self.port)
+
+    def warm_segmenter(self, config):
+        with self._segmenters_lock:
+            return _warm_segmenter(config)
+
+    def check_shared_path(self, fpath):
+        """
+        Check a client is allowed to segment the file at `fpath`.
+
+        :return: the real path of the file.
+        :raise PermissionError: if the file isn't inside one of the `shared_roots`.
+        :raise FileNotFoundError: if the file doesn't exist.
+        :raise ValueError: if `fpath` isn't a non-empty string.
+        """
+        if not fpath or not isinstance(fpath, str):
+            raise ValueError("JSON requests must have a `path`, as a string.")
+        real = path.realpath(fpath)
+        if not any(path.commonpath([real, root]) == root for root in self.shared_roots):
+            raise PermissionError("`{}` isn't in a shared directory.".format(fpath))
+        if not path.isfile(real):
+            raise FileNotFoundError("Input file `{}` doesn't exist.".format(fpath))
+        return real
+
+    def start(self):
+        """ Serve requests on a background thread. """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """ Stop serving and shut down the worker processes. """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+        self.batcher.close()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve audio segmentation over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shared-root", action="append", default=[], help="allow segmenting files under here by path")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = SegmentationServer(host=args.host, port=args.port, workers=args.workers, shared_roots=args.shared_root,
+                                verbose=args.verbose)
+    print("Listening on {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,10 @@
 from .exceptions import FormatError
 import os
 from os import path
-from .audiosegment import MyAudioSegment as AudioSegment
+from .audiosegment import AudioStream, MyAudioSegment as AudioSegment
 import subprocess
 import tempfile
+from urllib.parse import unquote, urlparse
 
 # The segmenter is capable of loading these formats. We could probably support more, it depends on ffmpeg.
 SUPPORTED_FORMATS = [
@@ -13,6 +14,16 @@ SUPPORTED_FORMATS = [
 ]
 
 
+# Formats to assume for these content types, when the format can't be sniffed from the audio itself.
+CONTENT_TYPE_FORMATS = {
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/wave": "wav", "audio/mpeg": "mp3", "audio/mp3": "mp3",
+    "audio/ogg": "ogg", "audio/flac": "flac", "audio/x-flac": "flac", "audio/aac": "aac", "audio/mp4": "m4a",
+}
+
+# URL schemes which `open_audio` streams from.
+URL_SCHEMES = ["http", "https"]
+
+
 def _quadraphonic_to_mono(audio):
     """
     Converts the given quadraphonic audio track to a mono track.
@@ -53,17 +64,65 @@ def is_format_supported(ext):
     return ext.lstrip(".").lower() in SUPPORTED_FORMATS
 
 
-def open_audio(fpath):
+def is_url(source):
+    """
+    Check if `source` is a URL that `open_audio` can stream from, rather than a local path.
+
+    :param source: anything that can be passed to `open_audio`.
+    :return: bool
+    """
+    return isinstance(source, str) and urlparse(source).scheme in URL_SCHEMES
+
+
+def is_local_path(source):
     """
-    Open the file located at `fpath` as an `AudioSegment`.
+    Check if `source` is the path of a local file, rather than a URL or a file-like object.
 
-    :param fpath:
+    :param source: anything that can be passed to `open_audio`.
+    :return: bool
+    """
+    return isinstance(source, str) and not is_url(source)
+
+
+def open_audio(fpath, decoder=None, keep_source=False):
+    """
+    Open the audio at `fpath` as an `AudioSegment`.
+
+    Besides a local path, `fpath` can be an HTTP(S) URL or a file-like object with a `read` method. These are
+    streamed: nothing is downloaded up front, and the audio is fed into ffmpeg as it arrives when it is first
+    converted. Their format is sniffed from the first few bytes, falling back on the extension in the URL or file
+    name, or the `Content-Type` of the response.
+
+    :param fpath: a local path, URL or file-like object. An `AudioSegment` is returned as it is.
+    :param decoder: an optional `DecoderPool`. If given, any transcoding of the audio is sent to it rather than to a \
+        freshly started ffmpeg process.
+    :param keep_source: if set, a copy of a URL or file-like object is saved as it is streamed, so that the original \
+        audio can be sliced afterwards. It is deleted along with the `AudioSegment`.
     :return: an `AudioSegment` object.
     :raises FormatError: if the file is in an unrecognisable format.
     """
+    if isinstance(fpath, AudioSegment):
+        return fpath
+
+    if is_url(fpath):
+        from urllib.request import urlopen  # slow to import, and only needed for URLs
+        response = urlopen(fpath)
+        name = path.basename(unquote(urlparse(fpath).path)) or "stream"
+        content_type = (response.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        fallback = path.splitext(name)[1].lstrip(".").lower() or CONTENT_TYPE_FORMATS.get(content_type)
+        stream = AudioStream(response, name, format=fallback, owns_stream=True)
+    elif hasattr(fpath, "read"):
+        name = getattr(fpath, "name", None)
+        name = path.basename(name) if isinstance(name, str) else "stream"
+        stream = AudioStream(fpath, name, format=path.splitext(name)[1].lstrip(".").lower() or None)
+    else:
+        _, ext = path.splitext(fpath)  # Determine file type from extension.
+        if not is_format_supported(ext):
+            raise FormatError("File format {} not supported".format(ext))
+        audio_segment = AudioSegment(fpath, decoder=decoder)
+        return audio_segment
 
-    _, ext = path.splitext(fpath)  # Determine file type from extension.
-    if not is_format_supported(ext):
-        raise FormatError("File format {} not supported".format(ext))
-    audio_segment = AudioSegment(fpath)
-    return audio_segment
+    if stream.format is None or not is_format_supported(stream.format):
+        stream.close()
+        raise FormatError("Couldn't tell the format of `{}`".format(stream.name))
+    return AudioSegment(stream, decoder=decoder, keep_source=keep_source)